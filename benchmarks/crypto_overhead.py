@@ -0,0 +1,115 @@
+"""
+Crypto overhead benchmark: cost of the encrypted request envelope vs plain JSON.
+
+Run from the repository root (needs pycryptodome):
+
+    python benchmarks/crypto_overhead.py
+    python benchmarks/crypto_overhead.py --requests 500 --evidence-size 4000000
+
+Compares, per request, the plain JSON body, the per-request key setup of
+poc-encryption.py (import key, RSA-encrypt a password, PBKDF2, AES) and a reused
+EnvelopeSession; then decrypting an imageevidence-sized response the POC way and
+with EnvelopeSession.decrypt(). A throwaway RSA key pair is generated, so no
+server is involved.
+"""
+
+import argparse
+import base64
+import json
+import os
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from Crypto.Cipher import AES, PKCS1_OAEP  # noqa: E402
+from Crypto.PublicKey import RSA  # noqa: E402
+from Crypto.Util.Padding import pad, unpad  # noqa: E402
+
+import envelope  # noqa: E402
+
+PAYLOAD = {
+    "citizen": "1234567890123",
+    "ticketNo": "123400000001",
+    "reqDtm": "20260101120000",
+    "uuid": "0f8fad5b-d9cb-469f-a165-70867728950e",
+}
+
+
+def _timeit(fn, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+
+def _peak_alloc(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+def naive_encode(public_pem, payload):
+    # What poc-encryption.py does for every request
+    cipher = PKCS1_OAEP.new(RSA.import_key(public_pem))
+    password = envelope.generate_password()
+    key = base64.b64encode(cipher.encrypt(password.encode())).decode()
+    salt, iv = os.urandom(16), os.urandom(16)
+    aes = AES.new(envelope.derive_key(password, salt), AES.MODE_CBC, iv=iv)
+    ciphertext = aes.encrypt(pad(json.dumps(payload).encode(), AES.block_size))
+    combined = f"{iv.hex()}::{salt.hex()}::{base64.b64encode(ciphertext).decode()}"
+    return {"key": key, "value": base64.b64encode(combined.encode()).decode()}
+
+
+def naive_decrypt(value, password):
+    # poc-encryption.py's aes_decrypt(): str round trips and a fresh PBKDF2 each time
+    parts = base64.b64decode(value).decode().split("::")
+    iv, salt, ciphertext = bytes.fromhex(parts[0]), bytes.fromhex(parts[1]), parts[2]
+    aes = AES.new(envelope.derive_key(password, salt), AES.MODE_CBC, iv=iv)
+    return json.loads(unpad(aes.decrypt(base64.b64decode(ciphertext)), AES.block_size).decode())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--requests", type=int, default=200, help="requests per encode variant")
+    parser.add_argument("--evidence-size", type=int, default=2_000_000, help="bytes of images")
+    parser.add_argument("--decrypts", type=int, default=10, help="evidence decrypts per variant")
+    parser.add_argument("--key-bits", type=int, default=4096, choices=(2048, 3072, 4096))
+    args = parser.parse_args()
+
+    public_pem = RSA.generate(args.key_bits).public_key().export_key().decode()
+    client = envelope.Envelope(public_pem)
+    session = client.current_session()
+
+    plain = _timeit(lambda: json.dumps(PAYLOAD), args.requests)
+    naive = _timeit(lambda: naive_encode(public_pem, PAYLOAD), args.requests)
+    cached = _timeit(lambda: client.encode(PAYLOAD), args.requests)
+
+    images = base64.b64encode(os.urandom(args.evidence_size)).decode()
+    response = {"status": "000", "upImage1": images}
+    value = session.encrypt(json.dumps(response).encode())
+    assert naive_decrypt(value, session.password) == envelope.decode_value(value, session)
+
+    naive_dec = _timeit(lambda: naive_decrypt(value, session.password), args.decrypts)
+    session_dec = _timeit(lambda: envelope.decode_value(value, session), args.decrypts)
+    naive_peak = _peak_alloc(lambda: naive_decrypt(value, session.password))
+    session_peak = _peak_alloc(lambda: envelope.decode_value(value, session))
+
+    mib = 1024 * 1024
+    print(f"Request body, {args.requests} requests, RSA-{args.key_bits}:")
+    print(f"  {'plain JSON':<28}{plain * 1e6:>10.1f} us/request")
+    print(f"  {'per-request key setup':<28}{naive * 1e6:>10.1f} us/request")
+    print(f"  {'reused session':<28}{cached * 1e6:>10.1f} us/request")
+    print(f"Evidence response, {len(value) / mib:.1f} MiB encrypted value:")
+    print(f"  {'POC decrypt':<28}{naive_dec * 1e3:>10.1f} ms{naive_peak / mib:>10.1f} MiB peak")
+    print(
+        f"  {'session decrypt':<28}{session_dec * 1e3:>10.1f} ms{session_peak / mib:>10.1f} MiB peak"
+    )
+
+
+if __name__ == "__main__":
+    main()
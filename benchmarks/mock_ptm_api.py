@@ -0,0 +1,313 @@
+"""
+Local stand-in for the PTM API (ptmapi.police.go.th).
+
+Speaks the same contract as the real endpoints: JSON POSTs answered with the
+double-encoded {"value": "<json string>"} envelope, bearer tokens from
+authenticate/refreshaccesstoken, and base64 upImageN fields from imageevidence,
+holding real PNG and JPEG images (generated once at startup with Pillow).
+Ticket counts, image sizes, latency and injected errors are configurable.
+
+Run standalone and point the app at it:
+
+    python benchmarks/mock_ptm_api.py --port 8099 --tickets 200
+    PTM_API_BASE=http://127.0.0.1:8099 python src/main.py
+
+or start it in-process with start(). POSTs to /notify are accepted as well, so
+APPRISE_URL=json://127.0.0.1:8099/notify exercises notification delivery too.
+"""
+
+import argparse
+import base64
+import io
+import json
+import random
+import struct
+import threading
+import time
+import zlib
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+def _photo(rng, size, fmt):
+    """
+    Encode a camera-like image (smooth gradients plus sensor noise) as PNG or JPEG,
+    sized to come out at roughly `size` bytes.
+    """
+    width = 640
+    for _ in range(3):
+        height = width * 3 // 4
+        gradient = Image.linear_gradient("L").resize((width, height))
+        noise = Image.frombytes("L", (width, height), rng.randbytes(width * height))
+        noise = Image.blend(gradient, noise, 0.3)
+        image = Image.merge("RGB", (gradient, noise, gradient.transpose(Image.FLIP_LEFT_RIGHT)))
+        out = io.BytesIO()
+        image.save(out, fmt, quality=90)
+        data = out.getvalue()
+        # Encoded size grows with the pixel count; converge on the requested size
+        width = max(16, int(width * (size / len(data)) ** 0.5))
+    return data
+
+
+def _tag(blob, text):
+    # Makes an image unique without breaking it: a comment segment (JPEG) or a tEXt
+    # chunk after the header (PNG), both ignored by decoders
+    if blob.startswith(b"\xff\xd8"):
+        return blob[:2] + b"\xff\xfe" + struct.pack(">H", len(text) + 2) + text + blob[2:]
+    chunk = b"tEXt" + b"ticket\0" + text
+    chunk = struct.pack(">I", len(chunk) - 4) + chunk + struct.pack(">I", zlib.crc32(chunk))
+    return blob[:33] + chunk + blob[33:]
+
+
+class MockPtmApi(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(
+        self,
+        port=0,
+        tickets=20,
+        images=3,
+        image_size=200_000,
+        latency_ms=0.0,
+        jitter_ms=0.0,
+        error_rate=0.0,
+        throttle_rate=0.0,
+        expires_in=3600,
+        unique_images=False,
+        seed=1,
+    ):
+        super().__init__(("127.0.0.1", port), _Handler)
+        self.tickets = tickets
+        self.images = min(9, images)
+        self.image_size = image_size
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.expires_in = expires_in
+        self.unique_images = unique_images
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {}
+        self.tokens = set()
+        # Real PNG and JPEG images, alternated so format detection, thumbnails and
+        # recompression all have actual work to do
+        rng = random.Random(seed)
+        self.blobs = [_photo(rng, image_size, fmt) for fmt in ("PNG", "JPEG")]
+        self.evidence_body = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] = self.stats.get(name, 0) + 1
+
+    def issue_token(self):
+        with self.lock:
+            token = f"token-{len(self.tokens) + 1}-{self.random.getrandbits(32):08x}"
+            self.tokens.add(token)
+        return token
+
+    def roll(self, rate):
+        with self.lock:
+            return rate and self.random.random() < rate
+
+    def delay(self):
+        if self.latency_ms or self.jitter_ms:
+            with self.lock:
+                jitter = self.random.uniform(-self.jitter_ms, self.jitter_ms)
+            time.sleep(max(0.0, self.latency_ms + jitter) / 1000)
+
+    def ticket_list(self, citizen):
+        start = datetime(2026, 1, 1)
+        return [
+            {
+                "ticketNo": f"{citizen[-4:]}{i:08d}",
+                "dateHappen": (start + timedelta(hours=7 * i)).strftime("%d/%m/%Y %H:%M:%S"),
+                "createDate": (start + timedelta(hours=7 * i + 30)).strftime("%d/%m/%Y"),
+                "paidStatus": "PENDING",
+                "fineAmount": "500.0",
+            }
+            for i in range(self.tickets)
+        ]
+
+    def ticket_detail(self, ticketNo):
+        i = int(ticketNo[-8:])
+        start = datetime(2026, 1, 1)
+        return {
+            "dateHappen": (start + timedelta(hours=7 * i)).strftime("%d/%m/%Y %H:%M:%S"),
+            "createDate": (start + timedelta(hours=7 * i + 30)).strftime("%d/%m/%Y"),
+            "fineAmount": "500.0",
+            "plate": "กข-1234 กรุงเทพมหานคร",
+            "road": "ทล.1 0+100",
+            "accuse1Desc": "ขับรถเร็วเกินกว่าอัตราที่กำหนด",
+            "paidStatus": "PENDING",
+            "limitSpeed": "90",
+            "speed": "120",
+            "lane": "2",
+            "orderDivision": "บก.จร.",
+            "orderName": "ใบสั่งจราจร",
+        }
+
+    def evidence(self, ticketNo):
+        if not self.unique_images and self.evidence_body is not None:
+            return self.evidence_body
+        data = {"status": "000", "msgEn": "Success"}
+        for index in range(1, 10):
+            blob = b""
+            if index <= self.images:
+                blob = self.blobs[index % 2]
+                if self.unique_images:
+                    blob = _tag(blob, ticketNo.encode())
+            data[f"upImage{index}"] = base64.b64encode(blob).decode()
+        body = envelope(data)
+        if not self.unique_images:
+            self.evidence_body = body
+        return body
+
+
+def _in_range(tickets, fromDate, toDate):
+    # allTickets filters on the offence date, both bounds inclusive
+    def day(value):
+        return datetime.strptime(value.split(" ")[0], "%d/%m/%Y")
+
+    low = day(fromDate) if fromDate else datetime.min
+    high = day(toDate) if toDate else datetime.max
+    return [t for t in tickets if low <= day(t["dateHappen"]) <= high]
+
+
+def envelope(data):
+    # The real API double-encodes its payload and escapes forward slashes
+    inner = json.dumps(data, ensure_ascii=False).replace("/", "\\/")
+    return json.dumps({"value": inner}).encode()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, body=b"", headers=()):
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        server = self.server
+        length = int(self.headers.get("Content-Length", 0))
+        try:
+            payload = json.loads(self.rfile.read(length) or b"{}")
+        except ValueError:
+            return self._reply(400)
+        endpoint = self.path.rstrip("/").rsplit("/", 1)[-1]
+        server.count(endpoint)
+        if endpoint == "notify":
+            # Apprise json:// target, so notification delivery can be measured too
+            return self._reply(200)
+        server.delay()
+
+        if server.roll(server.throttle_rate):
+            server.count("throttled")
+            return self._reply(429, headers=(("Retry-After", "1"),))
+        if server.roll(server.error_rate):
+            server.count("errors")
+            return self._reply(500)
+
+        if endpoint == "authenticate":
+            if not self.headers.get("Authorization", "").startswith("Basic "):
+                return self._reply(401)
+            return self._reply(200, self._token_body(server))
+        if endpoint == "refreshaccesstoken":
+            return self._reply(200, self._token_body(server))
+
+        token = self.headers.get("Authorization", "")[len("Bearer ") :]
+        if token not in server.tokens:
+            return self._reply(401)
+
+        if endpoint == "allTickets":
+            tickets = server.ticket_list(str(payload.get("citizen", "0000")))
+            tickets = _in_range(tickets, payload.get("fromDate"), payload.get("toDate"))
+            if not tickets:
+                data = {"status": "001", "msgEn": "Not found Ticket"}
+            else:
+                data = {"status": "000", "msgEn": "Success", "tickets": tickets}
+            return self._reply(200, envelope(data))
+        if endpoint == "ticketDetail":
+            data = {"status": "000", "ticketDetail": server.ticket_detail(payload["ticketNo"])}
+            return self._reply(200, envelope(data))
+        if endpoint == "imageevidence":
+            return self._reply(200, server.evidence(payload["ticketNo"]))
+        return self._reply(404)
+
+    def _token_body(self, server):
+        data = {
+            "status": "000",
+            "accessToken": server.issue_token(),
+            "refreshToken": server.issue_token(),
+            "expiresIn": server.expires_in,
+        }
+        return envelope(data)
+
+
+def start(port=0, **options):
+    """
+    Start a MockPtmApi on a background thread and return it; stop with shutdown().
+    """
+    server = MockPtmApi(port, **options)
+    threading.Thread(target=server.serve_forever, name="mock-ptm-api", daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument("--tickets", type=int, default=20, help="tickets per account")
+    parser.add_argument("--images", type=int, default=3, help="images per ticket (max 9)")
+    parser.add_argument("--image-size", type=int, default=200_000, help="bytes per image")
+    parser.add_argument("--latency-ms", type=float, default=0.0, help="added latency")
+    parser.add_argument("--jitter-ms", type=float, default=0.0, help="± random latency")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of 500s")
+    parser.add_argument("--throttle-rate", type=float, default=0.0, help="fraction of 429s")
+    parser.add_argument("--unique-images", action="store_true", help="distinct image bytes")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def options_from(args):
+    return {
+        "tickets": args.tickets,
+        "images": args.images,
+        "image_size": args.image_size,
+        "latency_ms": args.latency_ms,
+        "jitter_ms": args.jitter_ms,
+        "error_rate": args.error_rate,
+        "throttle_rate": args.throttle_rate,
+        "unique_images": args.unique_images,
+        "seed": args.seed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--port", type=int, default=8099)
+    add_arguments(parser)
+    args = parser.parse_args()
+
+    server = MockPtmApi(args.port, **options_from(args))
+    print(f"Mock PTM API listening on {server.base_url}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        print(json.dumps(server.stats), flush=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,256 @@
+"""
+Pipeline benchmark: full runs of main.main() against the local mock PTM API.
+
+Run from the repository root:
+
+    python benchmarks/pipeline.py
+    python benchmarks/pipeline.py --backend file --tickets 500 --latency-ms 20
+
+Every scenario runs in a fresh interpreter with empty state and storage, so all
+tickets are new. Reports tickets/sec, p50/p99 latency per stage and peak RSS.
+The s3 scenario needs a local S3 stand-in: pass --s3-endpoint, or have moto
+installed (`pip install "moto[server]"`) and one is started automatically.
+Application settings such as TICKET_CONCURRENCY are taken from the environment.
+"""
+
+import argparse
+import functools
+import json
+import os
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import mock_ptm_api
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+
+def _percentile(samples, p):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _start_s3():
+    """
+    Start moto_server on a free port; returns (process, endpoint) or (None, None).
+    """
+    try:
+        import moto  # noqa: F401
+    except ImportError:
+        return None, None
+    port = _free_port()
+    command = shutil.which("moto_server")
+    command = [command] if command else [sys.executable, "-m", "moto.server"]
+    process = subprocess.Popen(
+        command + ["-p", str(port)], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    deadline = time.monotonic() + 15
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return process, f"http://127.0.0.1:{port}"
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    return None, None
+
+
+# ---------------------------------------------------------------------------
+# Scenario worker: runs inside the child interpreter
+
+
+def _run_scenario(accounts):
+    sys.path.insert(0, SRC_DIR)
+    samples = {}
+
+    def timed(owner, name, stage):
+        original = getattr(owner, name)
+
+        @functools.wraps(original)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return original(*args, **kwargs)
+            finally:
+                samples.setdefault(stage, []).append(time.perf_counter() - started)
+
+        setattr(owner, name, wrapper)
+
+    import notifier
+    import storage
+    import ticket_processor
+    import token_manager
+
+    timed(token_manager.TokenManager, "get_valid_token", "token")
+    timed(ticket_processor.TicketProcessor, "get_all_tickets", "allTickets")
+    timed(ticket_processor.TicketProcessor, "get_ticket_detail", "ticketDetail")
+    timed(ticket_processor.TicketProcessor, "get_image_evidence", "imageevidence")
+    timed(ticket_processor.TicketProcessor, "stream_image_evidence", "imageevidence+store")
+    timed(notifier.Notifier, "send", "notify")
+
+    # Time storage on the instance main() uses, so wrappers like dedup count once
+    get_storage = storage.get_storage
+
+    def timed_storage():
+        backend = get_storage()
+        timed(backend, "upload_images", "store")
+        return backend
+
+    storage.get_storage = timed_storage
+
+    processed = []
+    process_tickets = ticket_processor.TicketProcessor.process_tickets
+
+    def counting_process_tickets(self):
+        count = process_tickets(self)
+        processed.append(count)
+        return count
+
+    ticket_processor.TicketProcessor.process_tickets = counting_process_tickets
+
+    import main
+
+    started = time.perf_counter()
+    main.main(["--fleet"] if accounts > 1 else [])
+    seconds = time.perf_counter() - started
+
+    print(
+        json.dumps(
+            {
+                "tickets": sum(processed),
+                "seconds": seconds,
+                # ru_maxrss is in KiB on Linux
+                "peakRssMiB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+                "peakChildRssMiB": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+                "stages": {
+                    stage: {
+                        "count": len(values),
+                        "p50Ms": _percentile(values, 0.5) * 1000,
+                        "p99Ms": _percentile(values, 0.99) * 1000,
+                    }
+                    for stage, values in samples.items()
+                },
+            }
+        )
+    )
+
+
+# ---------------------------------------------------------------------------
+# Driver
+
+
+def _scenario_env(args, api, backend, workdir, s3_endpoint):
+    env = dict(os.environ)
+    accounts = [f"{1000000000000 + i}" for i in range(args.accounts)]
+    env.update(
+        {
+            "PTM_API_BASE": api.base_url,
+            "CITIZEN_ID": accounts[0],
+            "USER_PASSWORD": "benchmark",
+            "ACCOUNTS": ",".join(f"{cid}:benchmark" for cid in accounts),
+            "STATE_FILE": os.path.join(workdir, "state.json"),
+            "STORAGE_BACKEND": backend,
+            "FILE_STORAGE_PATH": os.path.join(workdir, "images"),
+            "APPRISE_URL": (
+                f"json://127.0.0.1:{api.server_address[1]}/notify" if args.notify else ""
+            ),
+            "LOG_LEVEL": args.log_level,
+            # Ignore any developer .env so runs are comparable
+            "DOTENV_PATH": os.devnull + ".missing",
+        }
+    )
+    if backend == "s3":
+        env.update(
+            {
+                "S3_ENDPOINT": s3_endpoint,
+                "S3_ACCESS_KEY": "benchmark",
+                "S3_SECRET_KEY": "benchmark",
+                "S3_BUCKET_NAME": f"benchmark-{os.getpid()}-{int(time.time())}",
+                "AWS_DEFAULT_REGION": "us-east-1",
+            }
+        )
+    return env
+
+
+def _report(name, result):
+    rate = result["tickets"] / result["seconds"] if result["seconds"] else 0
+    print(
+        f"\n{name}: {result['tickets']} tickets in {result['seconds']:.2f} s, "
+        f"{rate:.1f} tickets/s, peak RSS {result['peakRssMiB']:.0f} MiB "
+        f"(image workers {result['peakChildRssMiB']:.0f} MiB)"
+    )
+    print(f"  {'stage':<22}{'count':>7}{'p50 ms':>10}{'p99 ms':>10}")
+    for stage, stats in result["stages"].items():
+        print(f"  {stage:<22}{stats['count']:>7}{stats['p50Ms']:>10.1f}{stats['p99Ms']:>10.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--backend", choices=("file", "s3", "all"), default="all")
+    parser.add_argument("--accounts", type=int, default=1, help="run in fleet mode if > 1")
+    parser.add_argument("--s3-endpoint", help="existing S3 stand-in, e.g. MinIO")
+    parser.add_argument("--notify", action="store_true", help="deliver notifications too")
+    parser.add_argument("--log-level", default="WARNING")
+    parser.add_argument("--json", action="store_true", help="print raw results as JSON")
+    parser.add_argument("--run-scenario", action="store_true", help=argparse.SUPPRESS)
+    mock_ptm_api.add_arguments(parser)
+    args = parser.parse_args()
+
+    if args.run_scenario:
+        _run_scenario(args.accounts)
+        return
+
+    api = mock_ptm_api.start(**mock_ptm_api.options_from(args))
+    backends = ("file", "s3") if args.backend == "all" else (args.backend,)
+    s3_process, s3_endpoint = None, args.s3_endpoint
+    if "s3" in backends and not s3_endpoint:
+        s3_process, s3_endpoint = _start_s3()
+        if not s3_endpoint:
+            print("Skipping s3: no --s3-endpoint given and moto is not installed")
+            backends = tuple(b for b in backends if b != "s3")
+
+    results = {}
+    try:
+        for backend in backends:
+            workdir = tempfile.mkdtemp(prefix=f"ptm-bench-{backend}-")
+            try:
+                completed = subprocess.run(
+                    [sys.executable, os.path.abspath(__file__), "--run-scenario"]
+                    + ["--accounts", str(args.accounts)],
+                    env=_scenario_env(args, api, backend, workdir, s3_endpoint),
+                    stdout=subprocess.PIPE,
+                    text=True,
+                    check=True,
+                )
+            finally:
+                shutil.rmtree(workdir, ignore_errors=True)
+            results[backend] = json.loads(completed.stdout.strip().splitlines()[-1])
+    finally:
+        api.shutdown()
+        if s3_process is not None:
+            s3_process.terminate()
+            s3_process.wait()
+
+    if args.json:
+        print(json.dumps({"api": api.stats, "results": results}, indent=2))
+        return
+    print(f"Mock API requests: {json.dumps(api.stats)}")
+    for backend, result in results.items():
+        _report(backend, result)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+"""
+Startup benchmark: how long `import main` takes in a fresh interpreter.
+
+Run from the repository root:
+
+    python benchmarks/startup.py
+
+Fails (exit code 1) when the median import time exceeds the budget or when a
+heavy optional dependency is imported although its backend is not selected.
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+
+# Budget for `import main` on top of a bare interpreter start, file storage, no notifier
+BUDGET_MS = float(os.getenv("STARTUP_BUDGET_MS", "250"))
+
+# Must not be imported at startup with STORAGE_BACKEND=file and no APPRISE_URL
+FORBIDDEN_MODULES = ("boto3", "botocore", "apprise", "dotenv")
+
+
+def _env():
+    env = dict(os.environ)
+    env.update(
+        {
+            "STORAGE_BACKEND": "file",
+            "APPRISE_URL": "",
+            # Ignore any developer .env so runs are comparable
+            "DOTENV_PATH": os.devnull + ".missing",
+        }
+    )
+    return env
+
+
+def _wall_time(code, runs):
+    samples = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], cwd=SRC_DIR, env=_env(), check=True)
+        samples.append((time.perf_counter() - started) * 1000)
+    return statistics.median(samples)
+
+
+def _import_profile():
+    """
+    Parse `-X importtime` output into {module: cumulative_us}. Empty on interpreters
+    without importtime support (e.g. PyPy).
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=SRC_DIR,
+        env=_env(),
+        capture_output=True,
+        text=True,
+    )
+    profile = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        profile[name.strip()] = int(cumulative)
+    return profile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=7)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    baseline_ms = _wall_time("pass", args.runs)
+    main_ms = _wall_time("import main", args.runs)
+    import_ms = main_ms - baseline_ms
+    print(f"interpreter start: {baseline_ms:.1f} ms")
+    print(f"import main:       {import_ms:.1f} ms (budget {BUDGET_MS:.0f} ms)")
+
+    failed = import_ms > BUDGET_MS
+    profile = _import_profile()
+    if profile:
+        print(f"top {args.top} imports by cumulative time:")
+        ranked = sorted(profile.items(), key=lambda item: item[1], reverse=True)
+        for name, cumulative in ranked[: args.top]:
+            print(f"  {cumulative / 1000:8.1f} ms  {name}")
+        for name in FORBIDDEN_MODULES:
+            if name in profile:
+                print(f"FAIL: {name} imported at startup")
+                failed = True
+
+    if failed:
+        print("FAIL: startup budget exceeded")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
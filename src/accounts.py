@@ -0,0 +1,55 @@
+import json
+import os
+
+from config import Config
+
+
+class Account:
+    def __init__(self, citizen_id, password, state_file):
+        self.citizen_id = citizen_id
+        self.password = password
+        self.state_file = state_file
+
+    def __repr__(self):
+        return f"Account({self.citizen_id})"
+
+
+def default_account():
+    return Account(Config.CITIZEN_ID, Config.USER_PASSWORD, Config.STATE_FILE)
+
+
+def _fleet_state_file(citizen_id):
+    return os.path.join(Config.STATE_DIR, f"state-{citizen_id}.json")
+
+
+def load_accounts():
+    """
+    Load the fleet account list.
+    ACCOUNTS_FILE points to a JSON list of {"citizenId", "password"} objects;
+    ACCOUNTS holds "citizenId:password" pairs separated by commas.
+    Falls back to the single CITIZEN_ID/USER_PASSWORD account.
+    """
+    entries = []
+    if Config.ACCOUNTS_FILE:
+        with open(Config.ACCOUNTS_FILE, "r") as f:
+            for item in json.load(f):
+                entries.append((item["citizenId"], item["password"]))
+    if Config.ACCOUNTS:
+        for pair in Config.ACCOUNTS.split(","):
+            pair = pair.strip()
+            if not pair:
+                continue
+            citizen_id, _, password = pair.partition(":")
+            entries.append((citizen_id.strip(), password))
+
+    if not entries:
+        return [default_account()]
+
+    accounts = []
+    seen = set()
+    for citizen_id, password in entries:
+        if citizen_id in seen:
+            continue
+        seen.add(citizen_id)
+        accounts.append(Account(citizen_id, password, _fleet_state_file(citizen_id)))
+    return accounts
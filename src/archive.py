@@ -0,0 +1,218 @@
+import json
+import os
+import threading
+from datetime import datetime
+
+from config import Config
+from logger import log_json
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS tickets (
+    ticket_no TEXT PRIMARY KEY,
+    citizen_id TEXT NOT NULL,
+    plate TEXT,
+    date_happen TEXT,
+    create_date TEXT,
+    fine_amount REAL,
+    paid_status TEXT,
+    location TEXT,
+    offense TEXT,
+    limit_speed REAL,
+    speed REAL,
+    lane TEXT,
+    order_division TEXT,
+    order_name TEXT,
+    images TEXT,
+    first_seen TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tickets_citizen ON tickets (citizen_id, date_happen);
+CREATE INDEX IF NOT EXISTS tickets_plate ON tickets (plate, paid_status);
+CREATE INDEX IF NOT EXISTS tickets_date ON tickets (date_happen);
+CREATE INDEX IF NOT EXISTS tickets_status ON tickets (paid_status, plate);
+"""
+
+# Export column order; also the order of the record_ticket() upsert
+COLUMNS = (
+    "ticket_no",
+    "citizen_id",
+    "plate",
+    "date_happen",
+    "create_date",
+    "fine_amount",
+    "paid_status",
+    "location",
+    "offense",
+    "limit_speed",
+    "speed",
+    "lane",
+    "order_division",
+    "order_name",
+    "images",
+    "first_seen",
+    "updated_at",
+)
+
+_DETAIL_UPSERT = f"""
+INSERT INTO tickets ({", ".join(COLUMNS)})
+VALUES ({", ".join("?" * len(COLUMNS))})
+ON CONFLICT (ticket_no) DO UPDATE SET
+    {", ".join(f"{c} = coalesce(excluded.{c}, {c})" for c in COLUMNS[1:15])},
+    updated_at = excluded.updated_at
+"""
+
+# allTickets headers only carry a few fields; they never overwrite detail fields
+_HEADER_UPSERT = """
+INSERT INTO tickets (ticket_no, citizen_id, date_happen, create_date, fine_amount,
+                     paid_status, first_seen, updated_at)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (ticket_no) DO UPDATE SET
+    paid_status = coalesce(excluded.paid_status, paid_status),
+    fine_amount = coalesce(excluded.fine_amount, fine_amount),
+    updated_at = excluded.updated_at
+WHERE paid_status IS NOT coalesce(excluded.paid_status, paid_status)
+   OR fine_amount IS NOT coalesce(excluded.fine_amount, fine_amount)
+"""
+
+
+def _iso(value):
+    """
+    "dd/mm/YYYY[ HH:MM:SS]" -> ISO 8601, so dates sort and range-query as text.
+    """
+    if not value:
+        return None
+    for fmt in ("%d/%m/%Y %H:%M:%S", "%d/%m/%Y"):
+        try:
+            return datetime.strptime(value, fmt).isoformat()
+        except ValueError:
+            continue
+    return value
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class Archive:
+    """
+    SQLite archive of every processed ticket, indexed on account, plate, offence
+    date and paid status for reports (see report.py). Rows are upserted as tickets
+    are processed and change. The database runs in WAL mode, so reports can read
+    while the notifier writes, and several processes can share it.
+    """
+
+    def __init__(self, filename=None):
+        import sqlite3
+
+        self.filename = filename or Config.ARCHIVE_DB
+        self.connection = sqlite3.connect(
+            self.filename, timeout=Config.ARCHIVE_BUSY_TIMEOUT, check_same_thread=False
+        )
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.executescript(SCHEMA)
+        self.lock = threading.Lock()
+        self.error = sqlite3.Error
+
+    def record_ticket(self, citizen_id, ticket_info, images=None):
+        """
+        Insert or update a ticket from its ticketDetail fields (see
+        TicketProcessor._ticket_info). Fields missing from ticket_info keep their
+        stored values.
+        """
+        now = datetime.now().isoformat()
+        row = (
+            ticket_info["ticketNo"],
+            citizen_id,
+            ticket_info.get("licensePlate"),
+            _iso(ticket_info.get("dateHappen")),
+            _iso(ticket_info.get("createDate")),
+            _number(ticket_info.get("fineAmount")),
+            ticket_info.get("paidStatus"),
+            ticket_info.get("location"),
+            ticket_info.get("offense"),
+            _number(ticket_info.get("limitSpeed")),
+            _number(ticket_info.get("speed")),
+            ticket_info.get("lane"),
+            ticket_info.get("orderDivision"),
+            ticket_info.get("orderName"),
+            json.dumps(images, ensure_ascii=False) if images is not None else None,
+            now,
+            now,
+        )
+        self._write(self.connection.execute, _DETAIL_UPSERT, row)
+
+    def record_headers(self, citizen_id, tickets):
+        """
+        Upsert a poll's allTickets entries in one transaction, so tickets processed
+        before the archive existed are listed and paid status stays current.
+        """
+        now = datetime.now().isoformat()
+        rows = [
+            (
+                t["ticketNo"],
+                citizen_id,
+                _iso(t.get("dateHappen")),
+                _iso(t.get("createDate")),
+                _number(t.get("fineAmount")),
+                t.get("paidStatus"),
+                now,
+                now,
+            )
+            for t in tickets
+        ]
+        self._write(self.connection.executemany, _HEADER_UPSERT, rows)
+
+    def _write(self, execute, *args):
+        # The archive is a by-product of processing; a failed write must not stop it
+        try:
+            with self.lock, self.connection:
+                execute(*args)
+        except self.error as e:
+            log_json(40, "Ticket archive write failed", file=self.filename, error=str(e))
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def connect_readonly(filename=None):
+    """
+    Open the archive for reports without taking write locks or creating it.
+    """
+    import sqlite3
+
+    filename = os.path.abspath(filename or Config.ARCHIVE_DB)
+    if not os.path.exists(filename):
+        raise Exception(f"Archive {filename} does not exist")
+    return sqlite3.connect(f"file:{filename}?mode=ro", uri=True)
+
+
+_archive = None
+_archive_lock = threading.Lock()
+
+
+def get_archive():
+    """
+    Return the process-wide Archive, or None when ARCHIVE_ENABLED is false.
+    """
+    global _archive
+    if not Config.ARCHIVE_ENABLED:
+        return None
+    if _archive is None:
+        with _archive_lock:
+            if _archive is None:
+                _archive = Archive()
+                log_json(10, "Ticket archive opened", file=_archive.filename)
+    return _archive
+
+
+def close_archive():
+    global _archive
+    with _archive_lock:
+        if _archive is not None:
+            _archive.close()
+            _archive = None
@@ -1,34 +1,173 @@
 import os
 
-from dotenv import load_dotenv
 
-load_dotenv()
+def _find_dotenv():
+    if os.getenv("DOTENV_PATH"):
+        return os.getenv("DOTENV_PATH")
+    # Same lookup as python-dotenv's find_dotenv(): this directory, then its parents
+    path = os.path.dirname(os.path.abspath(__file__))
+    while True:
+        candidate = os.path.join(path, ".env")
+        if os.path.isfile(candidate):
+            return candidate
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def _load_dotenv():
+    # Containers get their environment from env_file, so only pay for python-dotenv
+    # when there is actually a .env file to read
+    dotenv_path = _find_dotenv()
+    if dotenv_path and os.path.isfile(dotenv_path):
+        from dotenv import load_dotenv
+
+        load_dotenv(dotenv_path)
+
+
+_load_dotenv()
 
 
 class Config:
     CITIZEN_ID = os.getenv("CITIZEN_ID")
     USER_PASSWORD = os.getenv("USER_PASSWORD")
     NEAR_EXPIRY_THRESHOLD = int(os.getenv("NEAR_EXPIRY_THRESHOLD", "60"))
+    # Daemon mode refreshes tokens this many seconds before NEAR_EXPIRY_THRESHOLD
+    TOKEN_REFRESH_AHEAD = int(os.getenv("TOKEN_REFRESH_AHEAD", "300"))
     APPRISE_URL = os.getenv("APPRISE_URL")
+    LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+    # Write log lines from a background thread instead of the caller's
+    LOG_ASYNC = os.getenv("LOG_ASYNC", "true").lower() == "true"
+
+    # Combine the tickets of one poll (or of NOTIFY_DIGEST_WINDOW seconds) into one message
+    NOTIFY_DIGEST = os.getenv("NOTIFY_DIGEST", "false").lower() == "true"
+    NOTIFY_DIGEST_WINDOW = float(os.getenv("NOTIFY_DIGEST_WINDOW", "0"))
+    NOTIFY_MAX_ATTACHMENTS = int(os.getenv("NOTIFY_MAX_ATTACHMENTS", "10"))
+    NOTIFY_MAX_ATTACHMENT_BYTES = int(
+        os.getenv("NOTIFY_MAX_ATTACHMENT_BYTES", str(8 * 1024 * 1024))
+    )
 
     STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "s3").lower()  # 'file' or 's3'
     FILE_STORAGE_PATH = os.getenv("FILE_STORAGE_PATH", "./images")
+    # 'sharded' (YYYY/MM/ subdirectories, flat archives migrated on start) or 'flat'
+    FILE_STORAGE_LAYOUT = os.getenv("FILE_STORAGE_LAYOUT", "sharded").lower()
+    FILE_STORAGE_FSYNC = os.getenv("FILE_STORAGE_FSYNC", "true").lower() == "true"
 
     # Generic S3 configs (works with AWS S3, Minio, R2, GCS S3-compatible endpoints)
     S3_ENDPOINT = os.getenv("S3_ENDPOINT", "")  # If empty, boto3 uses AWS directly.
     S3_ACCESS_KEY = os.getenv("S3_ACCESS_KEY")
     S3_SECRET_KEY = os.getenv("S3_SECRET_KEY")
     S3_BUCKET_NAME = os.getenv("S3_BUCKET_NAME")
+    S3_MAX_CONCURRENCY = int(os.getenv("S3_MAX_CONCURRENCY", "8"))
+    S3_MULTIPART_THRESHOLD = int(os.getenv("S3_MULTIPART_THRESHOLD", str(8 * 1024 * 1024)))
+    S3_MULTIPART_CHUNKSIZE = int(os.getenv("S3_MULTIPART_CHUNKSIZE", str(8 * 1024 * 1024)))
+    S3_PRESIGN_EXPIRY = int(os.getenv("S3_PRESIGN_EXPIRY", "3600"))  # seconds, max 7 days
 
     USERNAME = os.getenv("USERNAME", "fooClientIdPassword")
     PASSWORD = os.getenv("PASSWORD", "secret")
 
-    BASE_URL_AUTH = "https://ptmapi.police.go.th/ETKServiceLogin/api/v1/user/authenticate"
-    BASE_URL_ALLTICKETS = "https://ptmapi.police.go.th/ETKServiceTicket/api/v1/user/allTickets"
-    BASE_URL_TICKETDETAIL = "https://ptmapi.police.go.th/ETKServiceTicket/api/v1/user/ticketDetail"
-    BASE_URL_IMAGEEVIDENCE = (
-        "https://ptmapi.police.go.th/ETKServiceTicket/api/v1/user/imageevidence"
-    )
-    BASE_URL_REFRESH = "https://ptmapi.police.go.th/ETKServiceTicket/api/v1/user/refreshaccesstoken"
+    # Point at a local stand-in (e.g. benchmarks/mock_ptm_api.py) instead of the real API
+    PTM_API_BASE = os.getenv("PTM_API_BASE", "https://ptmapi.police.go.th").rstrip("/")
+    BASE_URL_AUTH = f"{PTM_API_BASE}/ETKServiceLogin/api/v1/user/authenticate"
+    BASE_URL_ALLTICKETS = f"{PTM_API_BASE}/ETKServiceTicket/api/v1/user/allTickets"
+    BASE_URL_TICKETDETAIL = f"{PTM_API_BASE}/ETKServiceTicket/api/v1/user/ticketDetail"
+    BASE_URL_IMAGEEVIDENCE = f"{PTM_API_BASE}/ETKServiceTicket/api/v1/user/imageevidence"
+    BASE_URL_REFRESH = f"{PTM_API_BASE}/ETKServiceTicket/api/v1/user/refreshaccesstoken"
+
+    # Shared HTTP client
+    HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+    HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "60"))
+    HTTP_MAX_RETRIES = int(os.getenv("HTTP_MAX_RETRIES", "3"))
+    HTTP_BACKOFF_BASE = float(os.getenv("HTTP_BACKOFF_BASE", "0.5"))
+    HTTP_BACKOFF_MAX = float(os.getenv("HTTP_BACKOFF_MAX", "10"))
+    HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+
+    # Encrypted request envelope (RSA-OAEP + PBKDF2/AES-CBC, see poc-encryption.py)
+    PTM_ENCRYPTION = os.getenv("PTM_ENCRYPTION", "false").lower() == "true"
+    PTM_PUBLIC_KEY_FILE = os.getenv("PTM_PUBLIC_KEY_FILE", "")
+    ENCRYPTION_KEY_TTL = float(os.getenv("ENCRYPTION_KEY_TTL", "300"))
+
+    # Client-side governor, per endpoint: token bucket pacing plus AIMD concurrency
+    RATE_LIMIT_RPS = float(os.getenv("RATE_LIMIT_RPS", "0"))  # 0: no pacing
+    RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "5"))
+    RATE_LIMITS = os.getenv("RATE_LIMITS", "")  # "ticketDetail=5,imageevidence=2"
+    AIMD_INITIAL_CONCURRENCY = int(os.getenv("AIMD_INITIAL_CONCURRENCY", "2"))
+    AIMD_MIN_CONCURRENCY = int(os.getenv("AIMD_MIN_CONCURRENCY", "1"))
+    # 0: follow the worker count (TICKET_CONCURRENCY per account processed in parallel)
+    AIMD_MAX_CONCURRENCY = int(os.getenv("AIMD_MAX_CONCURRENCY", "0"))
+    AIMD_LATENCY_TARGET = float(os.getenv("AIMD_LATENCY_TARGET", "2"))
+
+    # allTickets window: "full" always queries the last year, "incremental" only
+    # queries since the newest ticket seen, with a periodic full reconciliation sweep
+    SYNC_MODE = os.getenv("SYNC_MODE", "full").lower()
+    SYNC_OVERLAP_DAYS = int(os.getenv("SYNC_OVERLAP_DAYS", "7"))
+    FULL_SYNC_INTERVAL_HOURS = float(os.getenv("FULL_SYNC_INTERVAL_HOURS", "24"))
+    # First sync of an account: BACKFILL_DAYS of history in BACKFILL_WINDOW_DAYS windows
+    BACKFILL_DAYS = int(os.getenv("BACKFILL_DAYS", "365"))
+    BACKFILL_WINDOW_DAYS = int(os.getenv("BACKFILL_WINDOW_DAYS", "30"))
+    BACKFILL_CONCURRENCY = int(os.getenv("BACKFILL_CONCURRENCY", "4"))
+
+    # Tickets fetched/stored concurrently within one account
+    TICKET_CONCURRENCY = int(os.getenv("TICKET_CONCURRENCY", "4"))
+
+    # Stream imageevidence responses straight into storage instead of buffering them
+    STREAM_EVIDENCE = os.getenv("STREAM_EVIDENCE", "false").lower() == "true"
+    STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", "65536"))
+    STREAM_SPOOL_SIZE = int(os.getenv("STREAM_SPOOL_SIZE", str(1024 * 1024)))
+
+    # Image processing (recompression and thumbnails need Pillow)
+    IMAGE_RECOMPRESS = os.getenv("IMAGE_RECOMPRESS", "false").lower() == "true"
+    IMAGE_THUMBNAILS = os.getenv("IMAGE_THUMBNAILS", "false").lower() == "true"
+    IMAGE_FORMAT = os.getenv("IMAGE_FORMAT", "jpeg").lower()  # 'jpeg', 'webp' or 'png'
+    IMAGE_QUALITY = int(os.getenv("IMAGE_QUALITY", "80"))
+    THUMBNAIL_SIZE = int(os.getenv("THUMBNAIL_SIZE", "640"))
+    IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
 
     STATE_FILE = os.getenv("STATE_FILE", "state.json")
+    STATE_COMPACT_EVERY = int(os.getenv("STATE_COMPACT_EVERY", "500"))
+    STATE_FSYNC = os.getenv("STATE_FSYNC", "true").lower() == "true"
+    STATE_DIR = os.getenv("STATE_DIR", os.path.dirname(STATE_FILE) or ".")
+
+    # Content-addressed image storage: identical images are stored (and uploaded) once
+    STORAGE_DEDUP = os.getenv("STORAGE_DEDUP", "false").lower() == "true"
+    DEDUP_INDEX_FILE = os.getenv("DEDUP_INDEX_FILE", os.path.join(STATE_DIR, "image_index.json"))
+
+    # Durable notification outbox with retry and dead letters
+    OUTBOX_DIR = os.getenv("OUTBOX_DIR", os.path.join(STATE_DIR, "outbox"))
+
+    # SQLite archive of processed tickets, queried with report.py
+    ARCHIVE_ENABLED = os.getenv("ARCHIVE_ENABLED", "false").lower() == "true"
+    ARCHIVE_DB = os.getenv("ARCHIVE_DB", os.path.join(STATE_DIR, "archive.db"))
+    ARCHIVE_BUSY_TIMEOUT = float(os.getenv("ARCHIVE_BUSY_TIMEOUT", "10"))
+    OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+    OUTBOX_BACKOFF_BASE = float(os.getenv("OUTBOX_BACKOFF_BASE", "30"))
+    OUTBOX_BACKOFF_MAX = float(os.getenv("OUTBOX_BACKOFF_MAX", "3600"))
+    OUTBOX_CLAIM_TIMEOUT = float(os.getenv("OUTBOX_CLAIM_TIMEOUT", "600"))
+
+    # Prometheus metrics: an HTTP endpoint in daemon mode and/or a textfile per run
+    METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))
+    METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+    METRICS_TEXTFILE = os.getenv("METRICS_TEXTFILE", "")
+    METRICS_ENABLED = bool(METRICS_PORT or METRICS_TEXTFILE)
+
+    # Embedded image server (file storage); notifications link to PUBLIC_BASE_URL if set
+    IMAGE_SERVER_PORT = int(os.getenv("IMAGE_SERVER_PORT", "0"))
+    IMAGE_SERVER_HOST = os.getenv("IMAGE_SERVER_HOST", "127.0.0.1")
+    IMAGE_SERVER_SECRET = os.getenv("IMAGE_SERVER_SECRET", "")
+    IMAGE_SERVER_MAX_AGE = int(os.getenv("IMAGE_SERVER_MAX_AGE", "86400"))
+    PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", "").rstrip("/")
+
+    # Fleet mode: many accounts processed concurrently in one run
+    ACCOUNTS_FILE = os.getenv("ACCOUNTS_FILE", "")  # JSON list of {"citizenId", "password"}
+    ACCOUNTS = os.getenv("ACCOUNTS", "")  # "citizenId:password,citizenId:password"
+    FLEET_WORKERS = int(os.getenv("FLEET_WORKERS", "4"))
+
+    # Daemon mode scheduling (seconds)
+    POLL_INTERVAL = float(os.getenv("POLL_INTERVAL", "1800"))
+    POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", "7200"))
+    POLL_BACKOFF_FACTOR = float(os.getenv("POLL_BACKOFF_FACTOR", "1.5"))
+    POLL_FAST_INTERVAL = float(os.getenv("POLL_FAST_INTERVAL", "300"))
+    POLL_FAST_WINDOW = float(os.getenv("POLL_FAST_WINDOW", "3600"))
+    POLL_JITTER = float(os.getenv("POLL_JITTER", "0.1"))
+    POLL_START_SPREAD = float(os.getenv("POLL_START_SPREAD", "60"))
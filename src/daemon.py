@@ -0,0 +1,144 @@
+import heapq
+import queue
+import random
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import image_server
+import metrics
+from config import Config
+from fleet import run_account
+from http_client import get_client
+from logger import log_json
+from token_manager import TokenManager
+
+
+class Daemon:
+    """
+    Long-running poller. Keeps the HTTP client, storage backend and per-account
+    state warm and schedules each account's next poll adaptively:
+    - no new tickets: the interval grows by POLL_BACKOFF_FACTOR up to POLL_MAX_INTERVAL
+    - new tickets: poll every POLL_FAST_INTERVAL for POLL_FAST_WINDOW seconds
+    Tokens are refreshed in the background TOKEN_REFRESH_AHEAD seconds before they
+    would need refreshing on demand, so polls do not wait on authentication.
+    """
+
+    def __init__(self, accounts, storage):
+        self.accounts = accounts
+        self.storage = storage
+        self.events = queue.Queue()
+        self.stopping = False
+        self.stopped = threading.Event()
+        self.intervals = {}
+        self.fast_until = {}
+
+    def install_signal_handlers(self):
+        signal.signal(signal.SIGTERM, self._handle_signal)
+        signal.signal(signal.SIGINT, self._handle_signal)
+
+    def _handle_signal(self, signum, frame):
+        log_json(20, "Shutdown requested", signal=signum)
+        self.stop()
+
+    def stop(self):
+        self.stopping = True
+        self.stopped.set()
+        self.events.put(None)
+
+    def run(self):
+        workers = max(1, min(Config.FLEET_WORKERS, len(self.accounts)))
+        log_json(20, "Daemon started", accounts=len(self.accounts), workers=workers)
+        get_client().governor.set_accounts(workers)
+        if Config.METRICS_PORT:
+            metrics.start_server()
+        if Config.IMAGE_SERVER_PORT:
+            image_server.start_server(self.storage)
+
+        # Spread the first polls over the start window so accounts don't fire together
+        now = time.monotonic()
+        schedule = [
+            (now + random.uniform(0, Config.POLL_START_SPREAD), index, account)
+            for index, account in enumerate(self.accounts)
+        ]
+        heapq.heapify(schedule)
+        running = 0
+
+        refresher = threading.Thread(target=self._refresh_tokens, name="token-refresh", daemon=True)
+        refresher.start()
+
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="poll") as pool:
+            while not self.stopping:
+                now = time.monotonic()
+                while schedule and schedule[0][0] <= now and running < workers:
+                    _, index, account = heapq.heappop(schedule)
+                    pool.submit(self._poll, index, account)
+                    running += 1
+
+                timeout = None
+                if schedule and running < workers:
+                    timeout = max(0, schedule[0][0] - now)
+                try:
+                    event = self.events.get(timeout=timeout)
+                except queue.Empty:
+                    continue
+                if event is None:
+                    continue
+
+                index, account, stats = event
+                running -= 1
+                delay = self._next_delay(account, stats)
+                heapq.heappush(schedule, (time.monotonic() + delay, index, account))
+                log_json(
+                    20, "Next poll scheduled", citizenId=account.citizen_id, seconds=round(delay)
+                )
+            log_json(20, "Waiting for running polls to finish", running=running)
+        refresher.join()
+        log_json(20, "Daemon stopped")
+
+    def _poll(self, index, account):
+        stats = run_account(account, self.storage)
+        self.events.put((index, account, stats))
+
+    def _refresh_tokens(self):
+        min_remaining = Config.NEAR_EXPIRY_THRESHOLD + Config.TOKEN_REFRESH_AHEAD
+        while not self.stopping:
+            wait = Config.POLL_MAX_INTERVAL
+            for account in self.accounts:
+                if self.stopping:
+                    return
+                try:
+                    _, _, expiresAt = TokenManager(account).get_valid_token(min_remaining)
+                except Exception as e:
+                    log_json(
+                        40,
+                        "Background token refresh failed",
+                        citizenId=account.citizen_id,
+                        error=str(e),
+                    )
+                    wait = min(wait, Config.POLL_FAST_INTERVAL)
+                    continue
+                due = (expiresAt - datetime.utcnow()).total_seconds() - min_remaining
+                wait = min(wait, due)
+            # Tokens shorter-lived than the margin would otherwise be refreshed in a loop
+            self.stopped.wait(max(30, wait))
+
+    def _next_delay(self, account, stats):
+        key = account.citizen_id
+        now = time.monotonic()
+        if stats["tickets"]:
+            self.fast_until[key] = now + Config.POLL_FAST_WINDOW
+        if now < self.fast_until.get(key, 0):
+            interval = Config.POLL_FAST_INTERVAL
+            self.intervals[key] = Config.POLL_INTERVAL
+        else:
+            previous = self.intervals.get(key)
+            if previous is None:
+                interval = Config.POLL_INTERVAL
+            else:
+                interval = min(previous * Config.POLL_BACKOFF_FACTOR, Config.POLL_MAX_INTERVAL)
+            self.intervals[key] = interval
+        jitter = interval * Config.POLL_JITTER
+        return max(1, interval + random.uniform(-jitter, jitter))
@@ -0,0 +1,151 @@
+import base64
+import binascii
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from config import Config
+from logger import log_json
+
+_PASSWORD_CHARS = "ABCDEFGHIJKLMNOPQRSTUVWXYZ1234567890abcdefghijklmnopqrstuvwxyz$&+#"
+_BLOCK_SIZE = 16
+
+# Public key from poc-encryption.py, used unless PTM_PUBLIC_KEY_FILE is set
+DEFAULT_PUBLIC_KEY = """-----BEGIN PUBLIC KEY-----
+MIICIjANBgkqhkiG9w0BAQEFAAOCAg8AMIICCgKCAgEAl6g7wvj+fxKlksLzSeURkbEDUWz87SI9PTI9tCRd6G38Vnsu3FnSCrNciYr8N1IkOWMMGlzabMB4NUziHo0Z8VlaBuS8rk6q5Np03WeOVydnProlt1YIC620NkI45FbV0fuGKdzr4Tpj4YYQnkihps5pvtCdu5G+eXfGo6pktL5EnDZVD2hqOib8iwCmdKC6nKJzAguF9GfavmTEbMysBtt3URQh6VhE+wK7ImJ5F7bodNl/9Lgfl8X71S1tFIvC8p0/VTXyK3imxkj1g5DuSvQUKUTuHkEO/V3w25bgCUhBR5KLuSWusnUZT2bxFjjyj7cC28mjQ5OReo//7rCxepu7z7smNAKWqqVazBYSV9BPLCxZUBE5MplwPLvV2/V021kyEd620x3MU3jKEt9dEEtfidUUI95KVccQLTQ5xdC1eajJqKwPu4gOErr07EsJ/vJQddrL5zalhtn3k4c71+C+t/fo4pAhoFe5xGCcYZUFl2z3EKjyHW/TYKz40GE0TXGqb3V+OoGWJLtvb2hm1fYY84ElYlrZid1VWEtS+uMPTtomo87EjOfEErRTiw3WnB4KFkvWlVOB9GqRv/1ABx5DZ4uZ/YfMYDO5aiTvlhH38mtaj8aPOzblg/vNf5VY97PtixhCKD3GGGo2Iwpig8XkoFMmkewgoL1uVriteQ0CAwEAAQ==
+-----END PUBLIC KEY-----
+"""
+
+
+def generate_password(length=32):
+    return "".join(_PASSWORD_CHARS[b % len(_PASSWORD_CHARS)] for b in os.urandom(length))
+
+
+def derive_key(password, salt):
+    from Crypto.Hash import SHA1
+    from Crypto.Protocol.KDF import PBKDF2
+
+    return PBKDF2(password, salt, dkLen=16, count=1000, hmac_hash_module=SHA1)
+
+
+def load_public_key():
+    if Config.PTM_PUBLIC_KEY_FILE:
+        with open(Config.PTM_PUBLIC_KEY_FILE, "r") as f:
+            return f.read()
+    return DEFAULT_PUBLIC_KEY
+
+
+class EnvelopeSession:
+    """
+    One random AES password, RSA-encrypted once, with its PBKDF2 key derived once.
+    Requests in the same session reuse the encrypted password ("key") and salt, and
+    each gets a fresh IV, so the per-request cost is one AES-CBC pass.
+    """
+
+    def __init__(self, rsa_cipher):
+        self.password = generate_password()
+        self.key = base64.b64encode(rsa_cipher.encrypt(self.password.encode())).decode()
+        self.salt = os.urandom(16)
+        self.aes_key = derive_key(self.password, self.salt)
+        self.created = time.monotonic()
+        # Response salt -> derived key, in case the server reuses its salts
+        self.response_keys = OrderedDict()
+        self.lock = threading.Lock()
+
+    def encrypt(self, plaintext):
+        """
+        Encrypt bytes into the base64("iv_hex::salt_hex::ciphertext_b64") format.
+        """
+        from Crypto.Cipher import AES
+
+        iv = os.urandom(16)
+        padding = _BLOCK_SIZE - len(plaintext) % _BLOCK_SIZE
+        ciphertext = AES.new(self.aes_key, AES.MODE_CBC, iv=iv).encrypt(
+            plaintext + bytes([padding]) * padding
+        )
+        combined = b"::".join(
+            (iv.hex().encode(), self.salt.hex().encode(), base64.b64encode(ciphertext))
+        )
+        return base64.b64encode(combined).decode()
+
+    def decrypt(self, value):
+        """
+        Decrypt a value produced with this session's password and return the plaintext
+        as a bytearray (json.loads() accepts it directly). Large evidence responses
+        are decoded straight from the base64 layers into one output buffer, which is
+        then unpadded in place.
+        """
+        from Crypto.Cipher import AES
+
+        combined = binascii.a2b_base64(value)
+        first = combined.index(b"::")
+        second = combined.index(b"::", first + 2)
+        iv = bytes.fromhex(combined[:first].decode())
+        salt = bytes.fromhex(combined[first + 2 : second].decode())
+        ciphertext = binascii.a2b_base64(memoryview(combined)[second + 2 :])
+        del combined
+
+        plaintext = bytearray(len(ciphertext))
+        AES.new(self._key_for(salt), AES.MODE_CBC, iv=iv).decrypt(ciphertext, output=plaintext)
+        del plaintext[len(plaintext) - plaintext[-1] :]
+        return plaintext
+
+    def _key_for(self, salt):
+        if salt == self.salt:
+            return self.aes_key
+        with self.lock:
+            key = self.response_keys.get(salt)
+            if key is not None:
+                self.response_keys.move_to_end(salt)
+                return key
+        key = derive_key(self.password, salt)
+        with self.lock:
+            self.response_keys[salt] = key
+            if len(self.response_keys) > 32:
+                self.response_keys.popitem(last=False)
+        return key
+
+
+class Envelope:
+    """
+    Client side of the encrypted {"key", "value"} transport (see poc-encryption.py).
+    The RSA public key is parsed once; sessions are reused for ENCRYPTION_KEY_TTL
+    seconds and then replaced, so the RSA and PBKDF2 work is paid once per session
+    rather than once per request.
+    """
+
+    def __init__(self, public_key_pem=None):
+        from Crypto.Cipher import PKCS1_OAEP
+        from Crypto.PublicKey import RSA
+
+        self.rsa_cipher = PKCS1_OAEP.new(RSA.import_key(public_key_pem or load_public_key()))
+        self.session = None
+        self.lock = threading.Lock()
+
+    def current_session(self):
+        with self.lock:
+            session = self.session
+            if session is None or time.monotonic() - session.created >= Config.ENCRYPTION_KEY_TTL:
+                session = self.session = EnvelopeSession(self.rsa_cipher)
+                log_json(10, "New encryption session")
+            return session
+
+    def encode(self, payload):
+        """
+        Return (request body, session); the session decrypts the matching response.
+        """
+        session = self.current_session()
+        value = session.encrypt(json.dumps(payload).encode())
+        return {"key": session.key, "value": value}, session
+
+
+def decode_value(value, session):
+    """
+    Parse an envelope "value": decrypted with the request's session when it is
+    encrypted, plain JSON otherwise.
+    """
+    if session is not None and not value.lstrip().startswith("{"):
+        return json.loads(session.decrypt(value))
+    return json.loads(value)
@@ -0,0 +1,301 @@
+import base64
+import codecs
+import json
+import re
+
+import metrics
+
+IMAGE_KEY = re.compile(r"upImage(\d+)$")
+
+_SPECIAL = re.compile(r'[\\"]')
+_VALUE_START = re.compile(r'"value"\s*:\s*"')
+# Bytes needed to tell the image formats apart (RIFF....WEBP is the longest signature)
+SNIFF_BYTES = 12
+_ESCAPES = {'"': '"', "\\": "\\", "/": "/", "b": "\b", "f": "\f", "n": "\n", "r": "\r", "t": "\t"}
+
+
+class JsonStringDecoder:
+    """
+    Incrementally unescapes the body of a JSON string literal (after the opening quote).
+    """
+
+    def __init__(self):
+        self.pending = ""
+
+    def feed(self, text):
+        """
+        Return (decoded, rest). rest is None while the string is still open,
+        otherwise the text following the closing quote.
+        """
+        if self.pending:
+            text = self.pending + text
+            self.pending = ""
+        out = []
+        pos = 0
+        while True:
+            match = _SPECIAL.search(text, pos)
+            if not match:
+                out.append(text[pos:])
+                return "".join(out), None
+            out.append(text[pos : match.start()])
+            if match.group() == '"':
+                return "".join(out), text[match.end() :]
+
+            escape = match.end()
+            if escape >= len(text) or (text[escape] == "u" and escape + 5 > len(text)):
+                # Escape sequence split across chunks
+                self.pending = text[match.start() :]
+                return "".join(out), None
+            if text[escape] == "u":
+                code = int(text[escape + 1 : escape + 5], 16)
+                pos = escape + 5
+                if 0xD800 <= code < 0xDC00:
+                    # Characters outside the BMP are escaped as a surrogate pair
+                    if pos + 6 > len(text):
+                        self.pending = text[match.start() :]
+                        return "".join(out), None
+                    if text[pos : pos + 2] == "\\u":
+                        low = int(text[pos + 2 : pos + 6], 16)
+                        if 0xDC00 <= low < 0xE000:
+                            code = 0x10000 + ((code - 0xD800) << 10) + (low - 0xDC00)
+                            pos += 6
+                out.append(chr(code))
+            else:
+                out.append(_ESCAPES[text[escape]])
+                pos = escape + 1
+
+
+def iter_text(byte_chunks):
+    decoder = codecs.getincrementaldecoder("utf-8")()
+    for chunk in byte_chunks:
+        text = decoder.decode(chunk)
+        if text:
+            yield text
+    text = decoder.decode(b"", final=True)
+    if text:
+        yield text
+
+
+def iter_envelope_value(text_chunks):
+    """
+    Yield the unescaped contents of the "value" string in a {"value": "..."} envelope.
+    """
+    head = ""
+    decoder = None
+    for text in text_chunks:
+        if decoder is None:
+            head += text
+            match = _VALUE_START.search(head)
+            if not match:
+                continue
+            decoder = JsonStringDecoder()
+            text = head[match.end() :]
+            head = ""
+        decoded, rest = decoder.feed(text)
+        if decoded:
+            yield decoded
+        if rest is not None:
+            return
+    raise ValueError("Envelope value not found or truncated")
+
+
+class Base64Sink:
+    """
+    Decodes base64 text in chunks and writes the bytes to a writer opened with the
+    first SNIFF_BYTES decoded bytes (or fewer, if the image is smaller).
+    """
+
+    def __init__(self, open_writer):
+        self.open_writer = open_writer
+        self.writer = None
+        self.head = b""
+        self.remainder = ""
+        self.size = 0
+
+    def feed(self, text):
+        text = self.remainder + text
+        if "\n" in text or "\r" in text:
+            text = text.replace("\n", "").replace("\r", "")
+        usable = len(text) - len(text) % 4
+        self.remainder = text[usable:]
+        if usable:
+            self._write(base64.b64decode(text[:usable]))
+
+    def _write(self, data, final=False):
+        if self.writer is None:
+            self.head += data
+            if len(self.head) < SNIFF_BYTES and not final:
+                return
+            data, self.head = self.head, b""
+            if not data:
+                return
+            self.writer = self.open_writer(data)
+        self.writer.write(data)
+        self.size += len(data)
+
+    def close(self):
+        self._write(base64.b64decode(self.remainder), final=True)
+        self.remainder = ""
+        if self.writer is None:
+            return False
+        self.writer.commit()
+        metrics.inc("ptm_images_decoded_total")
+        metrics.inc("ptm_image_bytes_decoded_total", self.size)
+        return True
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.abort()
+
+
+class EvidenceScanner:
+    """
+    Streaming parser for the inner imageevidence object.
+    upImageN strings are handed to sinks from open_sink(index); every other
+    top-level field is collected into self.fields.
+    """
+
+    def __init__(self, open_sink):
+        self.open_sink = open_sink
+        self.fields = {}
+        self.stored = {}
+        self.state = "start"
+        self.key = None
+        self.buffer = []
+        self.decoder = None
+        self.sink = None
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+
+    def feed(self, text):
+        pos = 0
+        while pos < len(text):
+            pos = getattr(self, "_" + self.state)(text, pos)
+
+    def finish(self):
+        if self.state != "end":
+            raise ValueError("Evidence response truncated")
+        return self.fields
+
+    def abort(self):
+        if self.sink is not None:
+            self.sink.abort()
+            self.sink = None
+
+    def _skip_ws(self, text, pos):
+        while pos < len(text) and text[pos] in " \t\r\n":
+            pos += 1
+        return pos
+
+    def _start(self, text, pos):
+        pos = self._skip_ws(text, pos)
+        if pos < len(text):
+            if text[pos] != "{":
+                raise ValueError("Evidence value is not an object")
+            self.state = "key_or_end"
+            pos += 1
+        return pos
+
+    def _key_or_end(self, text, pos):
+        pos = self._skip_ws(text, pos)
+        if pos < len(text):
+            char = text[pos]
+            if char == '"':
+                self.decoder = JsonStringDecoder()
+                self.buffer = []
+                self.state = "key"
+            elif char == "}":
+                self.state = "end"
+            elif char != ",":
+                raise ValueError(f"Unexpected {char!r} in evidence object")
+            pos += 1
+        return pos
+
+    def _key(self, text, pos):
+        decoded, rest = self.decoder.feed(text[pos:])
+        self.buffer.append(decoded)
+        if rest is None:
+            return len(text)
+        self.key = "".join(self.buffer)
+        self.state = "colon"
+        return len(text) - len(rest)
+
+    def _colon(self, text, pos):
+        pos = self._skip_ws(text, pos)
+        if pos < len(text):
+            if text[pos] != ":":
+                raise ValueError("Expected ':' in evidence object")
+            self.state = "value"
+            pos += 1
+        return pos
+
+    def _value(self, text, pos):
+        pos = self._skip_ws(text, pos)
+        if pos >= len(text):
+            return pos
+        char = text[pos]
+        if char == '"':
+            self.decoder = JsonStringDecoder()
+            self.buffer = []
+            match = IMAGE_KEY.match(self.key)
+            self.sink = self.open_sink(int(match.group(1))) if match else None
+            self.state = "string"
+            return pos + 1
+        self.buffer = []
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.state = "scalar"
+        return pos
+
+    def _string(self, text, pos):
+        decoded, rest = self.decoder.feed(text[pos:])
+        if self.sink is not None:
+            if decoded:
+                self.sink.feed(decoded)
+        else:
+            self.buffer.append(decoded)
+        if rest is None:
+            return len(text)
+
+        if self.sink is not None:
+            self.stored[self.key] = self.sink.close()
+            self.sink = None
+        else:
+            self.fields[self.key] = "".join(self.buffer)
+        self.state = "key_or_end"
+        return len(text) - len(rest)
+
+    def _scalar(self, text, pos):
+        # Numbers, literals and (rare) nested containers are small; scan them char by char
+        start = pos
+        while pos < len(text):
+            char = text[pos]
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "[{":
+                self.depth += 1
+            elif char in "]}" and self.depth:
+                self.depth -= 1
+            elif char in ",}" and not self.depth:
+                self.buffer.append(text[start:pos])
+                self.fields[self.key] = json.loads("".join(self.buffer))
+                self.state = "key_or_end"
+                return pos
+            pos += 1
+        self.buffer.append(text[start:pos])
+        return pos
+
+    def _end(self, text, pos):
+        pos = self._skip_ws(text, pos)
+        if pos < len(text):
+            raise ValueError("Trailing data after evidence object")
+        return pos
@@ -0,0 +1,63 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from config import Config
+from http_client import get_client
+from logger import log_json
+from ticket_processor import TicketProcessor
+from token_manager import TokenManager
+
+
+def run_account(account, storage):
+    """
+    Run token acquisition and ticket processing for one account.
+    Returns a stats dict; errors are caught so one account cannot stop the fleet.
+    """
+    started = time.monotonic()
+    stats = {"citizenId": account.citizen_id, "tickets": 0, "ok": True}
+    try:
+        token_manager = TokenManager(account)
+        accessToken, refreshToken, expiresAt = token_manager.get_valid_token()
+
+        processor = TicketProcessor(accessToken, storage, account)
+        stats["tickets"] = processor.process_tickets()
+    except Exception as e:
+        stats["ok"] = False
+        stats["error"] = str(e)
+        log_json(40, "Account run failed", citizenId=account.citizen_id, error=str(e))
+    stats["seconds"] = round(time.monotonic() - started, 3)
+    return stats
+
+
+def run_fleet(accounts, storage, workers=None):
+    workers = max(1, min(workers or Config.FLEET_WORKERS, len(accounts)))
+    log_json(20, "Fleet run started", accounts=len(accounts), workers=workers)
+    get_client().governor.set_accounts(workers)
+
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fleet") as pool:
+        results = list(pool.map(lambda account: run_account(account, storage), accounts))
+    elapsed = time.monotonic() - started
+
+    for stats in results:
+        seconds = stats["seconds"]
+        log_json(
+            20,
+            "Account summary",
+            ticketsPerSecond=round(stats["tickets"] / seconds, 3) if seconds else None,
+            **stats,
+        )
+
+    tickets = sum(stats["tickets"] for stats in results)
+    failed = sum(1 for stats in results if not stats["ok"])
+    log_json(
+        20,
+        "Fleet summary",
+        accounts=len(results),
+        failed=failed,
+        tickets=tickets,
+        seconds=round(elapsed, 3),
+        accountsPerSecond=round(len(results) / elapsed, 3) if elapsed else None,
+        ticketsPerSecond=round(tickets / elapsed, 3) if elapsed else None,
+    )
+    return results
@@ -0,0 +1,146 @@
+import random
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from config import Config
+from envelope import Envelope, decode_value
+from logger import log_json
+from rate_limiter import Governor, retry_after
+from utils import current_req_dtm, random_uuid
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class PtmClient:
+    """
+    Shared HTTP client for the PTM API.
+    Owns one pooled keep-alive session so every caller reuses the same connections,
+    and a Governor that paces and bounds the requests to each endpoint.
+    """
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=Config.HTTP_POOL_SIZE, pool_maxsize=Config.HTTP_POOL_SIZE
+        )
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.timeout = (Config.HTTP_CONNECT_TIMEOUT, Config.HTTP_READ_TIMEOUT)
+        self.governor = Governor()
+        # Encrypted {"key", "value"} transport; pycryptodome is only loaded when enabled
+        self.envelope = Envelope() if Config.PTM_ENCRYPTION else None
+
+    def headers(self, accessToken=None):
+        headers = {
+            "reqBy": "ETICKET",
+            "reqDtm": current_req_dtm(),
+            "reqID": random_uuid(),
+            "src": "ETICKET",
+            "Content-Type": "application/json",
+        }
+        if accessToken:
+            headers["Authorization"] = f"Bearer {accessToken}"
+        return headers
+
+    def post(self, url, payload, accessToken=None, auth=None, idempotent=True, stream=False):
+        """
+        POST a JSON payload and return the response.
+        Connection errors, timeouts and 429/5xx responses are retried with jittered
+        exponential backoff, but only for idempotent calls.
+        """
+        attempts = Config.HTTP_MAX_RETRIES + 1 if idempotent else 1
+        endpoint = self.governor.endpoint(url)
+        session = None
+        if self.envelope is not None:
+            payload, session = self.envelope.encode(payload)
+        for attempt in range(1, attempts + 1):
+            started = self.governor.acquire(endpoint)
+            try:
+                response = self.session.post(
+                    url,
+                    headers=self.headers(accessToken),
+                    json=payload,
+                    auth=auth,
+                    timeout=self.timeout,
+                    stream=stream,
+                )
+            except (requests.ConnectionError, requests.Timeout) as e:
+                self.governor.release(endpoint, started)
+                if attempt >= attempts:
+                    raise
+                log_json(30, "Request failed, retrying", url=url, attempt=attempt, error=str(e))
+            except BaseException:
+                self.governor.release(endpoint, started)
+                raise
+            else:
+                delay = None
+                if response.status_code in (429, 503):
+                    delay = retry_after(response)
+                finish = self.governor.release(
+                    endpoint, started, response.status_code, delay, hold=stream
+                )
+                if finish is not None:
+                    self._release_on_close(response, finish)
+                if response.status_code not in RETRY_STATUSES or attempt >= attempts:
+                    # unwrap() needs the session that encrypted the request
+                    response.envelope_session = session
+                    return response
+                response.close()
+                log_json(
+                    30,
+                    "Request failed, retrying",
+                    url=url,
+                    attempt=attempt,
+                    status=response.status_code,
+                )
+            self._backoff(attempt)
+
+    def _release_on_close(self, response, finish):
+        # A streamed body is still being downloaded after the headers arrive, so the
+        # request keeps its concurrency slot until the response is closed, which also
+        # happens once the body has been read to the end through iter_content()
+        close = response.close
+        iter_content = response.iter_content
+
+        def close_and_release():
+            try:
+                close()
+            finally:
+                finish()
+
+        def iter_and_release(*args, **kwargs):
+            yield from iter_content(*args, **kwargs)
+            finish()
+
+        response.close = close_and_release
+        response.iter_content = iter_and_release
+
+    def _backoff(self, attempt):
+        # Full jitter: sleep a random time up to the exponential cap
+        delay = min(Config.HTTP_BACKOFF_MAX, Config.HTTP_BACKOFF_BASE * 2 ** (attempt - 1))
+        time.sleep(random.uniform(0, delay))
+
+
+def unwrap(response):
+    """
+    Decode the {"value": "<json string>"} envelope used by every PTM endpoint,
+    decrypting it first when the request went out encrypted.
+    """
+    outer = response.json()
+    return decode_value(outer["value"], getattr(response, "envelope_session", None))
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                _client = PtmClient()
+    return _client
@@ -0,0 +1,300 @@
+import hashlib
+import hmac
+import html
+import json
+import mimetypes
+import os
+import threading
+import time
+from email.utils import formatdate, parsedate_to_datetime
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+import metrics
+from config import Config
+from logger import log_json
+
+# Links replace attachments only where the server can read the archive, and only
+# signed: unsigned gallery ids are guessable from ticket numbers
+LINKS_ENABLED = (
+    bool(Config.PUBLIC_BASE_URL)
+    and bool(Config.IMAGE_SERVER_SECRET)
+    and Config.STORAGE_BACKEND == "file"
+)
+
+
+def gallery_id(images):
+    """
+    Derive a ticket's gallery id from its stored image names:
+    "20240131_<ticketNo>_1.jpg" -> "20240131_<ticketNo>".
+    """
+    if not images:
+        return None
+    return os.path.basename(images[0]).rsplit("_", 1)[0]
+
+
+def gallery_name(gallery):
+    return f"galleries/{gallery}.json"
+
+
+def gallery_manifest(ticket_info, images, previews):
+    """
+    Render the manifest stored next to a ticket's images for its gallery page.
+    :param previews: Names shown on the page (thumbnails where present).
+    """
+    manifest = {"ticket": ticket_info, "images": images, "previews": previews}
+    return json.dumps(manifest, ensure_ascii=False).encode()
+
+
+def _signature(path):
+    digest = hmac.new(Config.IMAGE_SERVER_SECRET.encode(), path.encode(), hashlib.sha256)
+    return digest.hexdigest()[:32]
+
+
+def _link(path):
+    # Signed when IMAGE_SERVER_SECRET is set, so links cannot be guessed from ticket numbers;
+    # without it the server only listens on loopback (see start_server())
+    path = quote(path)
+    if Config.IMAGE_SERVER_SECRET:
+        return f"{path}?s={_signature(path)}"
+    return path
+
+
+def gallery_url(gallery):
+    return Config.PUBLIC_BASE_URL + _link(f"/t/{gallery}")
+
+
+def _safe_name(name):
+    parts = name.split("/")
+    if not name or any(part in ("", ".", "..") or part.startswith(".") for part in parts):
+        return None
+    return name
+
+
+def _image_name(name):
+    # /i/ serves evidence and thumbnails only, never gallery manifests or other files
+    name = _safe_name(name)
+    if name is None or name.startswith("galleries/"):
+        return None
+    if not (mimetypes.guess_type(name)[0] or "").startswith("image/"):
+        return None
+    return name
+
+
+class _ImageRequestHandler:
+    """
+    Mixin holding the request logic; combined with BaseHTTPRequestHandler in
+    start_server() so http.server is only imported when the server runs.
+    """
+
+    storage = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self._handle(head=True)
+
+    def do_GET(self):
+        self._handle(head=False)
+
+    def _handle(self, head):
+        url = urlsplit(self.path)
+        if Config.IMAGE_SERVER_SECRET:
+            signature = parse_qs(url.query).get("s", [""])[0]
+            if not hmac.compare_digest(signature, _signature(url.path)):
+                return self._status(403)
+        path = unquote(url.path)
+        if path.startswith("/i/"):
+            name = _image_name(path[3:])
+            if name is None:
+                return self._status(404)
+            return self._send_file(self.storage.get_image_access(name), head)
+        if path.startswith("/t/"):
+            gallery = _safe_name(path[3:])
+            if gallery is None or "/" in gallery:
+                return self._status(404)
+            return self._send_gallery(gallery, head)
+        return self._status(404)
+
+    def _status(self, status, headers=()):
+        self.send_response(status)
+        for name, value in headers:
+            self.send_header(name, value)
+        if status != 304:
+            self.send_header("Content-Length", "0")
+        self.end_headers()
+        metrics.inc("ptm_image_server_responses_total", status=status)
+
+    def _send_file(self, full_path, head):
+        try:
+            f = open(full_path, "rb")
+        except (FileNotFoundError, IsADirectoryError):
+            return self._status(404)
+        with f:
+            stat = os.fstat(f.fileno())
+            size = stat.st_size
+            # Stored images are never rewritten in place, so size and mtime identify them
+            etag = f'"{size:x}-{stat.st_mtime_ns:x}"'
+            headers = [
+                ("ETag", etag),
+                ("Last-Modified", formatdate(stat.st_mtime, usegmt=True)),
+                ("Cache-Control", f"private, max-age={Config.IMAGE_SERVER_MAX_AGE}"),
+                ("Accept-Ranges", "bytes"),
+            ]
+            if self._not_modified(etag, stat.st_mtime):
+                return self._status(304, headers)
+
+            status, start, length = 200, 0, size
+            byte_range = self._byte_range(size, etag)
+            if byte_range == "unsatisfiable":
+                return self._status(416, [("Content-Range", f"bytes */{size}")])
+            if byte_range is not None:
+                status, (start, length) = 206, byte_range
+                headers.append(("Content-Range", f"bytes {start}-{start + length - 1}/{size}"))
+
+            content_type = mimetypes.guess_type(full_path)[0] or "application/octet-stream"
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(length))
+            for name, value in headers:
+                self.send_header(name, value)
+            self.end_headers()
+            metrics.inc("ptm_image_server_responses_total", status=status)
+            if not head and length:
+                # socket.sendfile() uses os.sendfile(): the kernel copies file to socket
+                self.connection.sendfile(f, start, length)
+                metrics.inc("ptm_image_server_bytes_total", length)
+
+    def _not_modified(self, etag, mtime):
+        if_none_match = self.headers.get("If-None-Match")
+        if if_none_match is not None:
+            return if_none_match.strip() == "*" or etag in (
+                tag.strip().removeprefix("W/") for tag in if_none_match.split(",")
+            )
+        if_modified_since = self.headers.get("If-Modified-Since")
+        if if_modified_since:
+            try:
+                return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+            except (TypeError, ValueError):
+                return False
+        return False
+
+    def _byte_range(self, size, etag):
+        """
+        Return (start, length) for a single satisfiable "bytes=" range, "unsatisfiable",
+        or None to send the whole file (no, multiple or stale If-Range ranges).
+        """
+        value = self.headers.get("Range", "")
+        if not value.startswith("bytes=") or "," in value:
+            return None
+        if_range = self.headers.get("If-Range")
+        if if_range is not None and if_range.strip() != etag:
+            return None
+        first, _, last = value[len("bytes=") :].strip().partition("-")
+        try:
+            if not first:
+                suffix = int(last)
+                if suffix <= 0:
+                    return "unsatisfiable"
+                start, end = max(0, size - suffix), size - 1
+            else:
+                start = int(first)
+                end = min(int(last), size - 1) if last else size - 1
+        except ValueError:
+            return None
+        if start >= size or end < start:
+            return "unsatisfiable"
+        return start, end - start + 1
+
+    def _send_gallery(self, gallery, head):
+        try:
+            with open(self.storage.get_image_access(gallery_name(gallery)), "rb") as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return self._status(404)
+        body = _render_gallery(manifest).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "private, no-cache")
+        self.end_headers()
+        metrics.inc("ptm_image_server_responses_total", status=200)
+        if not head:
+            self.wfile.write(body)
+
+
+def _render_gallery(manifest):
+    ticket = manifest.get("ticket") or {}
+    rows = "".join(
+        f"<tr><th>{html.escape(label)}</th><td>{html.escape(str(ticket[key]))}</td></tr>"
+        for key, label in (
+            ("ticketNo", "Ticket No"),
+            ("dateHappen", "Date"),
+            ("licensePlate", "License Plate"),
+            ("location", "Location"),
+            ("offense", "Offense"),
+            ("fineAmount", "Fine Amount"),
+            ("paidStatus", "Paid Status"),
+        )
+        if ticket.get(key)
+    )
+    figures = "".join(
+        f'<a href="{html.escape(_link("/i/" + image))}">'
+        f'<img src="{html.escape(_link("/i/" + preview))}" loading="lazy" alt=""></a>'
+        for image, preview in zip(manifest["images"], manifest["previews"])
+    )
+    title = html.escape(f"Ticket {ticket.get('ticketNo', '')}")
+    return (
+        '<!doctype html><html><head><meta charset="utf-8">'
+        '<meta name="viewport" content="width=device-width, initial-scale=1">'
+        f"<title>{title}</title><style>"
+        "body{font-family:sans-serif;margin:1em}th{text-align:left;padding-right:1em}"
+        "img{max-width:100%;margin:.5em 0;display:block}"
+        f"</style></head><body><h1>{title}</h1><table>{rows}</table>{figures}</body></html>"
+    )
+
+
+_LOOPBACK = ("127.0.0.1", "::1", "localhost")
+
+
+def start_server(storage, port=None):
+    """
+    Serve stored images (/i/<name>) and ticket galleries (/t/<gallery id>) on
+    IMAGE_SERVER_PORT from a background thread. Returns the server, or None when
+    the storage backend is not local files.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    if Config.STORAGE_BACKEND != "file":
+        log_json(40, "The image server needs STORAGE_BACKEND=file")
+        return None
+    if not Config.IMAGE_SERVER_SECRET and Config.IMAGE_SERVER_HOST not in _LOOPBACK:
+        log_json(
+            40,
+            "The image server needs IMAGE_SERVER_SECRET to listen beyond loopback",
+            host=Config.IMAGE_SERVER_HOST,
+        )
+        return None
+    if Config.PUBLIC_BASE_URL and not Config.IMAGE_SERVER_SECRET:
+        log_json(30, "PUBLIC_BASE_URL is ignored without IMAGE_SERVER_SECRET; sending attachments")
+
+    class ImageRequestHandler(_ImageRequestHandler, BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+    ImageRequestHandler.storage = storage
+    server = ThreadingHTTPServer(
+        (Config.IMAGE_SERVER_HOST, port or Config.IMAGE_SERVER_PORT), ImageRequestHandler
+    )
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="image-server", daemon=True).start()
+    log_json(20, "Image server started", port=server.server_address[1])
+    return server
+
+
+if __name__ == "__main__":
+    # Standalone mode, for deployments that run the notifier from cron
+    from storage import get_storage
+
+    if start_server(get_storage()) is not None:
+        while True:
+            time.sleep(3600)
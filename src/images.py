@@ -0,0 +1,152 @@
+import io
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from config import Config
+from logger import log_json
+
+# (magic prefix, extension, content type)
+_SIGNATURES = (
+    (b"\x89PNG\r\n\x1a\n", "png", "image/png"),
+    (b"\xff\xd8\xff", "jpg", "image/jpeg"),
+    (b"GIF87a", "gif", "image/gif"),
+    (b"GIF89a", "gif", "image/gif"),
+    (b"BM", "bmp", "image/bmp"),
+)
+_ENCODINGS = {
+    "jpeg": ("JPEG", "jpg", "image/jpeg"),
+    "webp": ("WEBP", "webp", "image/webp"),
+    "png": ("PNG", "png", "image/png"),
+}
+
+
+def sniff_format(data):
+    """
+    Return (extension, content_type) from the image's magic bytes.
+    Unknown data keeps the historical PNG naming.
+    """
+    for magic, extension, content_type in _SIGNATURES:
+        if data.startswith(magic):
+            return extension, content_type
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "webp", "image/webp"
+    return "png", "image/png"
+
+
+class ProcessedImage:
+    def __init__(self, data, extension, content_type, thumbnail=None):
+        self.data = data
+        self.extension = extension
+        self.content_type = content_type
+        # (bytes, extension, content_type) or None
+        self.thumbnail = thumbnail
+
+
+def _settings():
+    # Passed to the workers explicitly: spawned workers do not see Config changes
+    # made in this process after import
+    return {
+        "recompress": Config.IMAGE_RECOMPRESS,
+        "thumbnails": Config.IMAGE_THUMBNAILS,
+        "format": Config.IMAGE_FORMAT,
+        "quality": Config.IMAGE_QUALITY,
+        "thumbnail_size": Config.THUMBNAIL_SIZE,
+    }
+
+
+def _encode(image, fmt, quality, max_size=None):
+    pil_format, extension, content_type = _ENCODINGS[fmt]
+    if max_size:
+        image = image.copy()
+        image.thumbnail((max_size, max_size))
+    if pil_format == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+    out = io.BytesIO()
+    image.save(out, pil_format, quality=quality)
+    return out.getvalue(), extension, content_type
+
+
+def process_image(img_bytes, settings=None):
+    """
+    Sniff, optionally recompress and thumbnail one image. Runs in a worker process.
+    """
+    settings = settings or _settings()
+    extension, content_type = sniff_format(img_bytes)
+    if not (settings["recompress"] or settings["thumbnails"]):
+        return ProcessedImage(img_bytes, extension, content_type)
+
+    from PIL import Image
+
+    try:
+        image = Image.open(io.BytesIO(img_bytes))
+        image.load()
+    except Exception as e:
+        # Store what the API sent even if it is not an image Pillow understands
+        log_json(30, "Could not decode image, storing as-is", error=str(e))
+        return ProcessedImage(img_bytes, extension, content_type)
+
+    thumbnail = None
+    if settings["thumbnails"]:
+        thumbnail = _encode(
+            image, settings["format"], settings["quality"], settings["thumbnail_size"]
+        )
+    if settings["recompress"]:
+        data, new_extension, new_content_type = _encode(
+            image, settings["format"], settings["quality"]
+        )
+        # Keep the original when recompressing would not make it smaller
+        if len(data) < len(img_bytes):
+            img_bytes, extension, content_type = data, new_extension, new_content_type
+    return ProcessedImage(img_bytes, extension, content_type, thumbnail)
+
+
+class ImageProcessor:
+    """
+    Runs process_image() in a process pool so encoding does not hold up the I/O threads.
+    Without recompression or thumbnails only the (cheap) format sniffing runs, inline.
+    Created at startup (see main.py), so missing Pillow fails the run right away.
+    """
+
+    def __init__(self):
+        self.pool = None
+        self.settings = _settings()
+        if not (self.settings["recompress"] or self.settings["thumbnails"]):
+            return
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            raise Exception(
+                "IMAGE_RECOMPRESS and IMAGE_THUMBNAILS need Pillow (pip install pillow)"
+            )
+        if Config.STREAM_EVIDENCE:
+            log_json(
+                30,
+                "STREAM_EVIDENCE stores images as received; recompression and thumbnails "
+                "only apply to buffered evidence",
+            )
+        # Workers must not be forked from a process that already runs HTTP and upload
+        # threads, which may hold locks at the time of the fork
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+        self.pool = ProcessPoolExecutor(max_workers=Config.IMAGE_WORKERS, mp_context=context)
+
+    def submit(self, img_bytes):
+        if self.pool is not None:
+            return self.pool.submit(process_image, img_bytes, self.settings)
+        future = Future()
+        future.set_result(process_image(img_bytes, self.settings))
+        return future
+
+
+_processor = None
+_processor_lock = threading.Lock()
+
+
+def get_image_processor():
+    global _processor
+    if _processor is None:
+        with _processor_lock:
+            if _processor is None:
+                _processor = ImageProcessor()
+    return _processor
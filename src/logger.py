@@ -1,19 +1,82 @@
-import json
+import atexit
 import logging
+import os
+import queue
+import time
+from logging.handlers import QueueHandler, QueueListener
+
+from config import Config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+    import json
+
+
+def _dumps(record):
+    if orjson is not None:
+        return orjson.dumps(record, default=str, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(record, default=str, ensure_ascii=False, separators=(",", ":"))
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Renders {"timestamp", "level", "message"} lines, where message is the dict
+    passed to log_json(). Serialisation happens here, i.e. on the listener thread.
+    """
+
+    def format(self, record):
+        timestamp = time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(record.created))
+        message = record.msg if isinstance(record.msg, dict) else {"msg": record.getMessage()}
+        return _dumps(
+            {
+                "timestamp": f"{timestamp}.{int(record.msecs):03d}",
+                "level": record.levelname,
+                "message": message,
+            }
+        )
+
+
+class _DeferredQueueHandler(QueueHandler):
+    def prepare(self, record):
+        # The stock handler formats here, on the caller's thread; leave that to the listener
+        return record
+
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
+logger.setLevel(Config.LOG_LEVEL)
+logger.propagate = False
 handler = logging.StreamHandler()
-handler.setFormatter(
-    logging.Formatter(
-        '{"timestamp":"%(asctime)s","level":"%(levelname)s","message":%(message)s}',
-        datefmt="%Y-%m-%dT%H:%M:%S",
-    )
-)
-logger.addHandler(handler)
+handler.setFormatter(JsonFormatter())
+
+if Config.LOG_ASYNC:
+    _queue = queue.SimpleQueue()
+    logger.addHandler(_DeferredQueueHandler(_queue))
+    _listener = QueueListener(_queue, handler)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+    def _log_directly():
+        # The listener thread does not survive fork(), so child processes (image
+        # workers) write synchronously instead
+        logger.handlers.clear()
+        logger.addHandler(handler)
+
+    os.register_at_fork(after_in_child=_log_directly)
+else:
+    logger.addHandler(handler)
 
 
 def log_json(level, msg, **kwargs):
+    # Filtered levels cost one check; the record is serialised only if it is emitted
+    if not logger.isEnabledFor(level):
+        return
     record = {"msg": msg}
-    record.update(kwargs)
-    logger.log(level, json.dumps(record))
+    for key, value in kwargs.items():
+        # Serialised later on the listener thread: snapshot containers the caller may
+        # keep mutating (one level deep, which covers the values passed in this repo)
+        if isinstance(value, (list, dict, set)):
+            value = value.copy()
+        record[key] = value
+    logger.log(level, record)
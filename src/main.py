@@ -1,11 +1,50 @@
+import argparse
+
+import metrics
+from accounts import load_accounts
+from archive import close_archive
+from config import Config
+from daemon import Daemon
+from fleet import run_fleet
+from images import get_image_processor
 from logger import log_json
+from outbox import close_outbox
+from state_store import close_all
 from storage import get_storage
 from ticket_processor import TicketProcessor
 from token_manager import TokenManager
 
 
-def main():
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="PTM ticket notifier")
+    parser.add_argument(
+        "--fleet",
+        action="store_true",
+        help="process every account from ACCOUNTS_FILE/ACCOUNTS concurrently",
+    )
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help="keep running and schedule polls for every account internally",
+    )
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
     try:
+        # Fails fast on missing Pillow, before any ticket is fetched
+        get_image_processor()
+        if args.daemon:
+            daemon = Daemon(load_accounts(), get_storage())
+            daemon.install_signal_handlers()
+            daemon.run()
+            return
+
+        if args.fleet:
+            run_fleet(load_accounts(), get_storage())
+            return
+
         token_manager = TokenManager()
         accessToken, refreshToken, expiresAt = token_manager.get_valid_token()
 
@@ -14,6 +53,12 @@ def main():
         processor.process_tickets()
     except Exception as e:
         log_json(40, "Unhandled error", error=str(e))
+    finally:
+        close_outbox()
+        close_archive()
+        close_all()
+        if Config.METRICS_TEXTFILE:
+            metrics.write_textfile()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,155 @@
+import bisect
+import os
+import threading
+
+from config import Config
+from logger import log_json
+
+# Metrics are only collected when something will export them; otherwise every
+# recording call returns on its first line.
+ENABLED = Config.METRICS_ENABLED
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# name: (type, help)
+METRICS = {
+    "ptm_http_requests_total": ("counter", "PTM API requests by endpoint and status."),
+    "ptm_http_request_seconds": ("histogram", "PTM API request latency by endpoint."),
+    "ptm_auth_total": ("counter", "Token acquisitions by kind and result."),
+    "ptm_auth_seconds": ("histogram", "Token acquisition latency by kind."),
+    "ptm_tickets_processed_total": ("counter", "New tickets processed."),
+    "ptm_ticket_changes_total": ("counter", "Status changes detected on processed tickets."),
+    "ptm_images_decoded_total": ("counter", "Evidence images decoded."),
+    "ptm_image_bytes_decoded_total": ("counter", "Bytes of evidence images decoded."),
+    "ptm_images_uploaded_total": ("counter", "Images written to storage by backend."),
+    "ptm_image_bytes_uploaded_total": ("counter", "Bytes written to storage by backend."),
+    "ptm_upload_seconds": ("histogram", "Latency of storing one image by backend."),
+    "ptm_notifications_total": ("counter", "Notification deliveries by result."),
+    "ptm_notification_seconds": ("histogram", "Notification delivery latency."),
+    "ptm_image_server_responses_total": ("counter", "Image server responses by status."),
+    "ptm_image_server_bytes_total": ("counter", "Image bytes sent by the image server."),
+}
+
+_lock = threading.Lock()
+# (name, labels) -> value for counters, [bucket counts..., sum] for histograms
+_values = {}
+# name -> (help, callable returning {labels: value})
+_gauges = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def inc(name, value=1, **labels):
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        _values[key] = _values.get(key, 0) + value
+
+
+def observe(name, value, **labels):
+    if not ENABLED:
+        return
+    key = _key(name, labels)
+    with _lock:
+        series = _values.get(key)
+        if series is None:
+            series = _values[key] = [0] * (len(LATENCY_BUCKETS) + 2)
+        # Buckets are stored non-cumulatively and summed when rendering
+        series[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        series[-1] += value
+
+
+def add_gauge(name, help_text, collect):
+    """
+    Register a gauge whose values are read by calling collect() at export time.
+    """
+    if ENABLED:
+        _gauges[name] = (help_text, collect)
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for k, v in pairs
+    )
+    return "{" + ",".join(f'{k}="{v}"' for k, v in escaped) + "}"
+
+
+def render():
+    """
+    Return all metrics in the Prometheus text exposition format.
+    """
+    with _lock:
+        snapshot = {key: list(v) if isinstance(v, list) else v for key, v in _values.items()}
+
+    by_name = {}
+    for (name, labels), value in sorted(snapshot.items()):
+        by_name.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name, (kind, help_text) in METRICS.items():
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} {kind}")
+        for labels, value in by_name.get(name, []):
+            if kind == "counter":
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+                continue
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS + ("+Inf",), value):
+                cumulative += count
+                le = (("le", bound),)
+                lines.append(f"{name}_bucket{_format_labels(labels, le)} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {value[-1]}")
+            lines.append(f"{name}_count{_format_labels(labels)} {cumulative}")
+
+    for name, (help_text, collect) in sorted(_gauges.items()):
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} gauge")
+        for labels, value in sorted(collect().items()):
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def start_server(port=None):
+    """
+    Serve /metrics on METRICS_PORT from a background thread. Returns the server.
+    """
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split("?")[0] not in ("/", "/metrics"):
+                self.send_error(404)
+                return
+            body = render().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((Config.METRICS_HOST, port or Config.METRICS_PORT), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="metrics", daemon=True).start()
+    log_json(20, "Metrics endpoint started", port=server.server_address[1])
+    return server
+
+
+def write_textfile(filename=None):
+    """
+    Atomically write the metrics to METRICS_TEXTFILE, e.g. for node_exporter's
+    textfile collector.
+    """
+    filename = filename or Config.METRICS_TEXTFILE
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "w") as f:
+        f.write(render())
+    os.replace(tmp_filename, filename)
@@ -1,36 +1,119 @@
-import apprise
+import os
+import threading
+import time
 
+import metrics
 from config import Config
 from logger import log_json
 
 
+class Notifier:
+    """
+    Long-lived notification sender.
+    Apprise and the APPRISE_URL are set up once and reused for every message; delivery
+    goes through Apprise's async API on an event loop owned by this notifier.
+    """
+
+    def __init__(self):
+        self.apobj = None
+        self.loop = None
+        if Config.APPRISE_URL:
+            import apprise
+
+            self.apobj = apprise.Apprise()
+            self.apobj.add(Config.APPRISE_URL)
+        else:
+            log_json(40, "No APPRISE_URL configured; skipping notifications")
+
+    def send(self, message, attachments=None, title="New Ticket Notification"):
+        """
+        Deliver one notification and return whether it succeeded.
+        :param message: The notification message.
+        :param attachments: List of file paths or URLs to attach.
+        """
+        if self.apobj is None:
+            return True
+        if self.loop is None:
+            import asyncio
+
+            self.loop = asyncio.new_event_loop()
+
+        attachments = attachments or []
+        started = time.monotonic()
+        success = False
+        try:
+            success = self.loop.run_until_complete(
+                self.apobj.async_notify(body=message, title=title, attach=attachments)
+            )
+            if success:
+                log_json(
+                    20, "Notification sent successfully", message=message, attachments=attachments
+                )
+            else:
+                log_json(
+                    40, "Failed to send notification", message=message, attachments=attachments
+                )
+            return success
+        except Exception as e:
+            log_json(40, "Failed to send notification", error=str(e))
+            return False
+        finally:
+            metrics.observe("ptm_notification_seconds", time.monotonic() - started)
+            metrics.inc("ptm_notifications_total", result="ok" if success else "error")
+
+    def compose_digest(self, items):
+        """
+        Combine (message, attachments) pairs into one (message, attachments, title),
+        keeping the attachments within NOTIFY_MAX_ATTACHMENTS/NOTIFY_MAX_ATTACHMENT_BYTES.
+        """
+        if len(items) == 1:
+            message, attachments = items[0]
+            return message, attachments, "New Ticket Notification"
+
+        message = "\n\n".join(message for message, _ in items)
+        attachments = [
+            attachment for _, item_attachments in items for attachment in item_attachments
+        ]
+        attached = self._limit_attachments(attachments)
+        if len(attached) < len(attachments):
+            message += f"\n\n(+{len(attachments) - len(attached)} more images not attached)"
+        return message, attached, f"{len(items)} New Ticket Notifications"
+
+    def _limit_attachments(self, attachments):
+        # Chat services reject oversized uploads; only local files have a known size
+        attached = []
+        total = 0
+        for attachment in attachments[: Config.NOTIFY_MAX_ATTACHMENTS]:
+            size = os.path.getsize(attachment) if os.path.isfile(attachment) else 0
+            if total + size > Config.NOTIFY_MAX_ATTACHMENT_BYTES:
+                break
+            total += size
+            attached.append(attachment)
+        return attached
+
+    def close(self):
+        if self.loop is not None:
+            self.loop.close()
+            self.loop = None
+
+
+_notifier = None
+_notifier_lock = threading.Lock()
+
+
+def get_notifier():
+    global _notifier
+    if _notifier is None:
+        with _notifier_lock:
+            if _notifier is None:
+                _notifier = Notifier()
+    return _notifier
+
+
 def send_notification(message, attachments=None):
     """
     Send notifications using Apprise.
     :param message: The notification message.
     :param attachments: List of file paths to attach.
     """
-    if not Config.APPRISE_URL:
-        log_json(40, "No APPRISE_URL configured; skipping notification")
-        return
-
-    apobj = apprise.Apprise()
-    apobj.add(Config.APPRISE_URL)
-
-    try:
-        # Send the notification with optional attachments
-        success = apobj.notify(
-            body=message,
-            title="New Ticket Notification",
-            attach=attachments or [],  # Apprise expects file paths for attachments
-        )
-        if success:
-            log_json(
-                20, "Notification sent successfully", message=message, attachments=attachments or []
-            )
-        else:
-            log_json(
-                40, "Failed to send notification", message=message, attachments=attachments or []
-            )
-    except Exception as e:
-        log_json(40, "Failed to send notification", error=str(e))
+    return get_notifier().send(message, attachments)
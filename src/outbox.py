@@ -0,0 +1,282 @@
+import json
+import os
+import random
+import threading
+import time
+import uuid
+
+import image_server
+from config import Config
+from logger import log_json
+from notifier import get_notifier
+
+
+class Outbox:
+    """
+    Durable notification queue.
+    enqueue() writes each rendered notification to OUTBOX_DIR/pending and returns; a
+    background worker delivers them, retrying failures with exponential backoff and
+    moving entries that keep failing to OUTBOX_DIR/dead. Entries left over from an
+    earlier run are picked up again, so a failed delivery never requires re-fetching
+    the ticket from the API.
+
+    Image references are stored as storage filenames and resolved when sending, so
+    S3 links are always fresh.
+
+    Several processes may share OUTBOX_DIR: an entry is claimed by renaming it to
+    <id>.sending before delivery, so only one of them sends it. Claims left by a
+    crashed process are released after OUTBOX_CLAIM_TIMEOUT seconds.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.pending_dir = os.path.join(Config.OUTBOX_DIR, "pending")
+        self.dead_dir = os.path.join(Config.OUTBOX_DIR, "dead")
+        os.makedirs(self.pending_dir, exist_ok=True)
+        os.makedirs(self.dead_dir, exist_ok=True)
+
+        self.notifier = get_notifier()
+        self.lock = threading.Lock()
+        self.wake = threading.Condition(self.lock)
+        self.flush_requested = False
+        self.stopping = False
+        self.thread = threading.Thread(target=self._run, name="outbox", daemon=True)
+        self.thread.start()
+
+    def enqueue(self, message, images):
+        """
+        Persist a notification for delivery.
+        :param message: The notification text.
+        :param images: Storage filenames to attach (file mode) or link (s3 mode).
+        """
+        entry = {
+            "id": f"{time.time_ns()}-{uuid.uuid4().hex[:8]}",
+            "message": message,
+            "images": images,
+            "attempts": 0,
+            "nextAttempt": 0,
+        }
+        self._write(os.path.join(self.pending_dir, entry["id"] + ".json"), entry)
+        with self.lock:
+            self.wake.notify()
+
+    def poll_complete(self):
+        with self.lock:
+            self.flush_requested = True
+            self.wake.notify()
+
+    def close(self):
+        """
+        Make one last delivery attempt for everything due, then stop the worker.
+        Entries still failing stay on disk for the next run.
+        """
+        with self.lock:
+            self.stopping = True
+            self.wake.notify()
+        self.thread.join()
+        self.notifier.close()
+
+    def _write(self, path, entry):
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _load_pending(self):
+        entries = []
+        for name in sorted(os.listdir(self.pending_dir)):
+            path = os.path.join(self.pending_dir, name)
+            if name.endswith(".sending"):
+                # A released claim is picked up in this same pass
+                path = self._release_stale(path)
+                if path is None:
+                    continue
+                name = os.path.basename(path)
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(path, "r") as f:
+                    entries.append((path, json.load(f)))
+            except FileNotFoundError:
+                # Claimed or delivered by another process since listdir()
+                continue
+            except (OSError, ValueError) as e:
+                log_json(40, "Unreadable outbox entry", path=path, error=str(e))
+                self._move(path, os.path.join(self.dead_dir, name))
+        return entries
+
+    def _move(self, source, destination):
+        # Entries can vanish under us when another process shares OUTBOX_DIR
+        try:
+            os.replace(source, destination)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _claim(self, path, entry):
+        """
+        Take an entry for delivery by renaming it to <id>.sending; returns the new
+        path, or None if another process claimed it first.
+        """
+        claimed = path[: -len(".json")] + ".sending"
+        try:
+            # The claim's mtime tells other processes when it becomes stale
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        if not self._move(path, claimed):
+            return None
+        with open(claimed, "r") as f:
+            current = json.load(f)
+        if current["attempts"] != entry["attempts"]:
+            # Another process tried and rescheduled it after we read it; leave it be
+            self._move(claimed, path)
+            return None
+        return claimed
+
+    def _release_stale(self, claimed):
+        # Returns the released entry's path, or None if the claim is still live
+        try:
+            age = time.time() - os.path.getmtime(claimed)
+        except FileNotFoundError:
+            return None
+        if age < Config.OUTBOX_CLAIM_TIMEOUT:
+            return None
+        log_json(30, "Releasing stale outbox claim", path=claimed)
+        released = claimed[: -len(".sending")] + ".json"
+        return released if self._move(claimed, released) else None
+
+    def _run(self):
+        while True:
+            with self.lock:
+                stopping = self.stopping
+                flush = self.flush_requested or stopping
+                self.flush_requested = False
+
+            try:
+                next_due = self._deliver_due(flush)
+            except Exception as e:
+                # The worker must outlive any one failure, or nothing is delivered again
+                log_json(40, "Outbox delivery pass failed", error=str(e))
+                next_due = time.time() + Config.OUTBOX_BACKOFF_BASE
+
+            with self.lock:
+                if stopping:
+                    return
+                if not self.stopping and not self.flush_requested:
+                    timeout = None if next_due is None else max(0, next_due - time.time())
+                    self.wake.wait(timeout)
+
+    def _deliver_due(self, flush):
+        """
+        Deliver every entry that is due and return the time the next one becomes due.
+        """
+        now = time.time()
+        entries = self._load_pending()
+        due = []
+        next_due = None
+        for path, entry in entries:
+            ready_at = entry["nextAttempt"]
+            if Config.NOTIFY_DIGEST and not entry["attempts"] and not flush:
+                # Fresh digest entries wait for the end of the poll or the digest window
+                if not Config.NOTIFY_DIGEST_WINDOW:
+                    continue
+                ready_at = int(entry["id"].split("-")[0]) / 1e9 + Config.NOTIFY_DIGEST_WINDOW
+            if ready_at <= now:
+                claimed = self._claim(path, entry)
+                if claimed is not None:
+                    due.append((claimed, entry))
+            elif next_due is None or ready_at < next_due:
+                next_due = ready_at
+
+        if not due:
+            return next_due
+        if Config.NOTIFY_DIGEST:
+            batches = [due]
+        else:
+            batches = [[item] for item in due]
+
+        for batch in batches:
+            try:
+                items = [self._render(entry) for _, entry in batch]
+                message, attachments, title = self.notifier.compose_digest(items)
+                sent = self.notifier.send(message, attachments, title)
+            except Exception as e:
+                log_json(40, "Notification rendering or delivery failed", error=str(e))
+                sent = False
+            if sent:
+                for claimed, _ in batch:
+                    try:
+                        os.remove(claimed)
+                    except FileNotFoundError:
+                        pass
+                continue
+            for claimed, entry in batch:
+                try:
+                    retry_at = self._retry(claimed, entry)
+                except OSError as e:
+                    log_json(40, "Could not reschedule notification", id=entry["id"], error=str(e))
+                    continue
+                if retry_at is not None and (next_due is None or retry_at < next_due):
+                    next_due = retry_at
+        return next_due
+
+    def _render(self, entry):
+        if image_server.LINKS_ENABLED:
+            # One stable gallery link instead of attachments, if the gallery exists
+            gallery = image_server.gallery_id(entry["images"])
+            if gallery and os.path.exists(
+                self.storage.get_image_access(image_server.gallery_name(gallery))
+            ):
+                return entry["message"] + "\n" + image_server.gallery_url(gallery), []
+        access = [self.storage.get_image_access(name) for name in entry["images"]]
+        if Config.STORAGE_BACKEND == "file":
+            return entry["message"], access
+        # S3 mode: include image URLs in the message
+        return entry["message"] + "\n" + "\n".join(access), []
+
+    def _retry(self, claimed, entry):
+        # Rescheduled entries are released back to pending/ under their original name
+        name = entry["id"] + ".json"
+        entry["attempts"] += 1
+        if entry["attempts"] >= Config.OUTBOX_MAX_ATTEMPTS:
+            self._write(claimed, entry)
+            self._move(claimed, os.path.join(self.dead_dir, name))
+            log_json(40, "Notification moved to dead letters", id=entry["id"])
+            return None
+        delay = min(
+            Config.OUTBOX_BACKOFF_MAX, Config.OUTBOX_BACKOFF_BASE * 2 ** (entry["attempts"] - 1)
+        )
+        entry["nextAttempt"] = time.time() + random.uniform(delay / 2, delay)
+        self._write(claimed, entry)
+        self._move(claimed, os.path.join(self.pending_dir, name))
+        log_json(
+            30,
+            "Notification delivery failed, will retry",
+            id=entry["id"],
+            attempts=entry["attempts"],
+        )
+        return entry["nextAttempt"]
+
+
+_outbox = None
+_outbox_lock = threading.Lock()
+
+
+def get_outbox(storage):
+    global _outbox
+    if _outbox is None:
+        with _outbox_lock:
+            if _outbox is None:
+                _outbox = Outbox(storage)
+    return _outbox
+
+
+def close_outbox():
+    global _outbox
+    with _outbox_lock:
+        if _outbox is not None:
+            _outbox.close()
+            _outbox = None
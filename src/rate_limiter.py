@@ -0,0 +1,266 @@
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+
+import metrics
+from config import Config
+from logger import log_json
+
+
+class TokenBucket:
+    """
+    Classic token bucket: `rate` requests per second on average with bursts of up to
+    `burst`. A rate of 0 disables the limit.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def pause(self, seconds):
+        # Honour a server Retry-After: no tokens are handed out until it has passed
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif not self.rate:
+                    return
+                else:
+                    self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                    self.updated = now
+                    if self.tokens >= 1:
+                        self.tokens -= 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class AimdLimiter:
+    """
+    Concurrency limit adjusted by additive increase / multiplicative decrease:
+    every healthy response (fast enough, not throttled) adds 1/limit, so the limit
+    grows by about one per round of requests; a 429, 5xx or timeout halves it, at most
+    once per observed latency so one burst of failures counts as one signal.
+    """
+
+    def __init__(self, initial, minimum, maximum, latency_target):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.latency_target = latency_target
+        self.inflight = 0
+        self.last_decrease = 0.0
+        self.latency_ewma = None
+        self.condition = threading.Condition()
+
+    def acquire(self):
+        with self.condition:
+            while self.inflight >= int(self.limit):
+                self.condition.wait()
+            self.inflight += 1
+
+    def set_maximum(self, maximum):
+        with self.condition:
+            self.maximum = max(self.minimum, maximum)
+            self.limit = min(self.limit, self.maximum)
+            self.condition.notify_all()
+
+    def release(self, latency, healthy):
+        with self.condition:
+            self.inflight -= 1
+            if latency is not None:
+                if self.latency_ewma is None:
+                    self.latency_ewma = latency
+                else:
+                    self.latency_ewma = 0.8 * self.latency_ewma + 0.2 * latency
+            now = time.monotonic()
+            if not healthy:
+                if now - self.last_decrease > (self.latency_ewma or 0):
+                    self.limit = max(self.minimum, self.limit / 2)
+                    self.last_decrease = now
+            elif latency is not None and latency <= self.latency_target:
+                self.limit = min(self.maximum, self.limit + 1 / self.limit)
+            self.condition.notify_all()
+
+
+class Endpoint:
+    def __init__(self, name, rate, max_concurrency):
+        self.name = name
+        self.bucket = TokenBucket(rate, Config.RATE_LIMIT_BURST)
+        self.concurrency = AimdLimiter(
+            Config.AIMD_INITIAL_CONCURRENCY,
+            Config.AIMD_MIN_CONCURRENCY,
+            max_concurrency,
+            Config.AIMD_LATENCY_TARGET,
+        )
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=500)
+        self.requests = 0
+        self.throttled = 0
+        self.errors = 0
+
+    def record(self, latency, status):
+        with self.lock:
+            self.requests += 1
+            self.latencies.append(latency)
+            if status == 429:
+                self.throttled += 1
+            elif status is None or status >= 500:
+                self.errors += 1
+
+    def snapshot(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            counts = {
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "errors": self.errors,
+            }
+
+        def percentile(p):
+            if not latencies:
+                return None
+            return round(latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000, 1)
+
+        ewma = self.concurrency.latency_ewma
+        return {
+            "rate": self.bucket.rate,
+            "concurrencyLimit": round(self.concurrency.limit, 2),
+            "inflight": self.concurrency.inflight,
+            **counts,
+            "latencyEwmaMs": None if ewma is None else round(ewma * 1000, 1),
+            "latencyP50Ms": percentile(0.5),
+            "latencyP95Ms": percentile(0.95),
+        }
+
+
+def _parse_rate_limits(spec):
+    # "ticketDetail=5,imageevidence=2"
+    limits = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        name, _, rate = item.partition("=")
+        limits[name.strip()] = float(rate)
+    return limits
+
+
+def retry_after(response):
+    """
+    Seconds from a Retry-After header (delta-seconds or HTTP date), or None.
+    """
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class Governor:
+    """
+    Client-side governor for the PTM API: a token bucket (RATE_LIMIT_RPS, or the
+    per-endpoint RATE_LIMITS) and an AIMD concurrency limit per endpoint, where the
+    endpoint is the last path segment of the URL (allTickets, ticketDetail, ...).
+    """
+
+    def __init__(self):
+        self.rates = _parse_rate_limits(Config.RATE_LIMITS)
+        self.endpoints = {}
+        # Accounts processed at the same time (fleet and daemon mode)
+        self.accounts = 1
+        self.lock = threading.Lock()
+        metrics.add_gauge(
+            "ptm_concurrency_limit",
+            "Current AIMD concurrency limit by endpoint.",
+            lambda: self._gauge(lambda endpoint: round(endpoint.concurrency.limit, 2)),
+        )
+        metrics.add_gauge(
+            "ptm_inflight_requests",
+            "PTM API requests in flight by endpoint.",
+            lambda: self._gauge(lambda endpoint: endpoint.concurrency.inflight),
+        )
+
+    def endpoint(self, url):
+        name = url.rstrip("/").rsplit("/", 1)[-1]
+        with self.lock:
+            endpoint = self.endpoints.get(name)
+            if endpoint is None:
+                rate = self.rates.get(name, Config.RATE_LIMIT_RPS)
+                endpoint = self.endpoints[name] = Endpoint(name, rate, self._max_concurrency())
+            return endpoint
+
+    def _max_concurrency(self):
+        # A higher limit than the callers can reach would never take effect
+        if Config.AIMD_MAX_CONCURRENCY:
+            return Config.AIMD_MAX_CONCURRENCY
+        workers = max(1, Config.TICKET_CONCURRENCY, Config.BACKFILL_CONCURRENCY)
+        return workers * self.accounts
+
+    def set_accounts(self, accounts):
+        """
+        Scale the default concurrency limit to the number of accounts polled in parallel.
+        """
+        with self.lock:
+            self.accounts = max(1, accounts)
+            for endpoint in self.endpoints.values():
+                endpoint.concurrency.set_maximum(self._max_concurrency())
+
+    def acquire(self, endpoint):
+        endpoint.bucket.acquire()
+        endpoint.concurrency.acquire()
+        return time.monotonic()
+
+    def release(self, endpoint, started, status=None, delay=None, hold=False):
+        """
+        Record the outcome of a request started at `started`.
+        :param status: The HTTP status, or None if the request failed without one.
+        :param delay: Retry-After seconds sent by the server, if any.
+        :param hold: Keep the concurrency slot (for a streamed body still being read)
+            and return a function that frees it; it may be called more than once.
+        """
+        latency = time.monotonic() - started
+        endpoint.record(latency, status)
+        metrics.observe("ptm_http_request_seconds", latency, endpoint=endpoint.name)
+        metrics.inc("ptm_http_requests_total", endpoint=endpoint.name, status=status or "error")
+        healthy = status is not None and status != 429 and status < 500
+        if delay:
+            endpoint.bucket.pause(delay)
+            log_json(30, "Server asked to slow down", endpoint=endpoint.name, seconds=delay)
+        if not hold:
+            endpoint.concurrency.release(latency, healthy)
+            return None
+
+        # The latency to the headers still drives the limit; only the slot is held
+        pending = [True]
+        lock = threading.Lock()
+
+        def finish():
+            with lock:
+                if not pending:
+                    return
+                pending.clear()
+            endpoint.concurrency.release(latency, healthy)
+
+        return finish
+
+    def snapshot(self):
+        with self.lock:
+            return {name: endpoint.snapshot() for name, endpoint in self.endpoints.items()}
+
+    def _gauge(self, value):
+        with self.lock:
+            return {(("endpoint", name),): value(e) for name, e in self.endpoints.items()}
@@ -0,0 +1,152 @@
+"""
+Reports and exports over the ticket archive (ARCHIVE_DB).
+
+    python report.py plates                      # tickets and unpaid fines per plate
+    python report.py accounts --since 2025-01-01 # the same per account
+    python report.py export --format csv -o tickets.csv --status PENDING
+    python report.py sql "SELECT offense, count(*) FROM tickets GROUP BY offense"
+
+Exports stream rows from an index-ordered cursor, so memory use stays flat
+however large the archive is.
+"""
+
+import argparse
+import csv
+import json
+import sys
+
+from archive import COLUMNS, connect_readonly
+
+FETCH_SIZE = 1000
+
+
+def _filters(args):
+    """
+    Build the WHERE clause shared by all reports from the command line filters.
+    """
+    clauses, params = [], []
+    if args.citizen:
+        clauses.append("citizen_id = ?")
+        params.append(args.citizen)
+    if args.plate:
+        clauses.append("plate = ?")
+        params.append(args.plate)
+    if args.status:
+        clauses.append("paid_status = ?")
+        params.append(args.status)
+    if args.since:
+        clauses.append("date_happen >= ?")
+        params.append(args.since)
+    if args.until:
+        # Dates are ISO text; anything on the --until day sorts before the next one
+        clauses.append("date_happen < ? || 'T99'")
+        params.append(args.until)
+    return (" WHERE " + " AND ".join(clauses) if clauses else ""), params
+
+
+def _rows(cursor):
+    while True:
+        batch = cursor.fetchmany(FETCH_SIZE)
+        if not batch:
+            return
+        yield from batch
+
+
+def _write(out, fmt, names, rows):
+    if fmt == "csv":
+        writer = csv.writer(out)
+        writer.writerow(names)
+        for row in rows:
+            writer.writerow(row)
+    elif fmt == "jsonl":
+        for row in rows:
+            out.write(json.dumps(dict(zip(names, row)), ensure_ascii=False) + "\n")
+    else:
+        # Aligned text for the terminal; summaries are small enough to buffer
+        rows = [["" if v is None else str(v) for v in row] for row in rows]
+        widths = [max([len(n)] + [len(r[i]) for r in rows]) for i, n in enumerate(names)]
+        for row in [list(names)] + rows:
+            out.write("  ".join(v.ljust(w) for v, w in zip(row, widths)).rstrip() + "\n")
+
+
+def _summary(connection, args, group_by):
+    where, params = _filters(args)
+    if group_by == "plate":
+        # Tickets only seen in allTickets have no plate until their detail is fetched
+        missing = connection.execute(
+            f"SELECT count(*) FROM tickets{where}{' AND' if where else ' WHERE'} plate IS NULL",
+            params,
+        ).fetchone()[0]
+        if missing:
+            print(
+                f"{missing} ticket(s) without a plate yet (no ticketDetail) are not listed; "
+                "see the accounts report",
+                file=sys.stderr,
+            )
+        where += f"{' AND' if where else ' WHERE'} plate IS NOT NULL"
+    query = f"""
+        SELECT {group_by},
+               count(*) AS tickets,
+               coalesce(sum(fine_amount), 0) AS fines,
+               sum(paid_status = ?) AS unpaid_tickets,
+               coalesce(sum(CASE WHEN paid_status = ? THEN fine_amount END), 0) AS unpaid_fines
+        FROM tickets{where}
+        GROUP BY {group_by}
+        ORDER BY unpaid_fines DESC, tickets DESC
+    """
+    cursor = connection.execute(query, [args.unpaid_status, args.unpaid_status] + params)
+    return [d[0] for d in cursor.description], _rows(cursor)
+
+
+def _export(connection, args):
+    where, params = _filters(args)
+    # date_happen is indexed, so the ordered scan streams without a sort step
+    cursor = connection.execute(
+        f"SELECT {', '.join(COLUMNS)} FROM tickets{where} ORDER BY date_happen", params
+    )
+    return COLUMNS, _rows(cursor)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="PTM ticket archive reports")
+    parser.add_argument("report", choices=("plates", "accounts", "export", "sql"))
+    parser.add_argument("query", nargs="?", help="SQL for the sql report (read-only)")
+    parser.add_argument("--db", help="archive file (default ARCHIVE_DB)")
+    parser.add_argument("--format", choices=("table", "csv", "jsonl"))
+    parser.add_argument("-o", "--output", help="write to a file instead of stdout")
+    parser.add_argument("--citizen", help="only this account")
+    parser.add_argument("--plate", help="only this license plate")
+    parser.add_argument("--status", help="only this paid status")
+    parser.add_argument("--since", help="offence date from, YYYY-MM-DD")
+    parser.add_argument("--until", help="offence date to (inclusive), YYYY-MM-DD")
+    parser.add_argument(
+        "--unpaid-status", default="PENDING", help="paidStatus counted as unpaid (PENDING)"
+    )
+    args = parser.parse_intermixed_args(argv)
+
+    connection = connect_readonly(args.db)
+    try:
+        if args.report == "plates":
+            names, rows = _summary(connection, args, "plate")
+        elif args.report == "accounts":
+            names, rows = _summary(connection, args, "citizen_id")
+        elif args.report == "export":
+            names, rows = _export(connection, args)
+        else:
+            if not args.query:
+                parser.error("the sql report needs a query")
+            cursor = connection.execute(args.query)
+            names, rows = [d[0] for d in cursor.description or ()], _rows(cursor)
+
+        fmt = args.format or ("jsonl" if args.report == "export" else "table")
+        if args.output:
+            with open(args.output, "w", newline="", encoding="utf-8") as out:
+                _write(out, fmt, names, rows)
+        else:
+            _write(sys.stdout, fmt, names, rows)
+    finally:
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
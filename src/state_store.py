@@ -0,0 +1,222 @@
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+
+from config import Config
+from logger import log_json
+from utils import load_state, save_state
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f"Cannot serialise {type(value).__name__}")
+
+
+def _decode(key, value):
+    if key == "expiresAt" and isinstance(value, str):
+        return datetime.fromisoformat(value)
+    return value
+
+
+class StateStore:
+    """
+    Persistent state: a JSON snapshot (the classic state.json) plus an append-only
+    journal of changes next to it. Every change is one fsync'd journal line; the
+    journal is folded back into the snapshot every STATE_COMPACT_EVERY entries.
+
+    Several processes may share one state file. Appends hold a shared lock on
+    filename.lock; loading, refresh() and compaction hold it exclusively, so they never
+    see a half-written line and compaction can fold in the others' writes first.
+    """
+
+    # Keys held as sets (stored as lists in the snapshot) and as keyed maps
+    SETS = ("processedTickets",)
+    MAPS = ("tickets", "checkpoints")
+
+    def __init__(self, filename, sets=None, maps=None):
+        self.filename = filename
+        self.journal_file = filename + ".journal"
+        self.lock = threading.RLock()
+        self.values = {}
+        self.sets = {name: set() for name in (self.SETS if sets is None else sets)}
+        self.maps = {name: {} for name in (self.MAPS if maps is None else maps)}
+        self.journal_entries = 0
+        self.lock_file = open(filename + ".lock", "a")
+        with self._file_lock(fcntl.LOCK_EX):
+            self._load()
+        self.journal = open(self.journal_file, "a")
+
+    @contextmanager
+    def _file_lock(self, operation):
+        fcntl.flock(self.lock_file.fileno(), operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    def _load(self):
+        # A plain state.json from before the journal existed loads as a snapshot
+        for key, value in load_state(self.filename).items():
+            if key in self.sets:
+                self.sets[key] = set(value)
+            elif key in self.maps:
+                self.maps[key] = value
+            else:
+                self.values[key] = value
+
+        if not os.path.exists(self.journal_file):
+            return
+        good_offset = 0
+        with open(self.journal_file, "rb") as f:
+            for line in f:
+                try:
+                    self._apply(json.loads(line))
+                except ValueError:
+                    # Torn write from a crash; drop it and everything after it
+                    log_json(30, "Truncating damaged state journal", file=self.journal_file)
+                    break
+                good_offset += len(line)
+                self.journal_entries += 1
+        if good_offset != os.path.getsize(self.journal_file):
+            with open(self.journal_file, "r+b") as f:
+                f.truncate(good_offset)
+
+    def _apply(self, entry):
+        op = entry["op"]
+        if op == "set":
+            for key, value in entry["values"].items():
+                self.values[key] = _decode(key, value)
+        elif op == "add":
+            self.sets[entry["set"]].add(entry["member"])
+        elif op == "discard":
+            self.sets[entry["set"]].discard(entry["member"])
+        elif op == "put":
+            self.maps[entry["map"]][entry["key"]] = entry["value"]
+        elif op == "remove":
+            self.maps[entry["map"]].pop(entry["key"], None)
+        else:
+            raise ValueError(f"Unknown state op {op}")
+
+    def _commit(self, entry):
+        line = json.dumps(entry, default=_encode) + "\n"
+        with self._file_lock(fcntl.LOCK_SH):
+            self.journal.write(line)
+            self.journal.flush()
+            if Config.STATE_FSYNC:
+                os.fsync(self.journal.fileno())
+        self._apply(json.loads(line))
+        self.journal_entries += 1
+        if self.journal_entries >= Config.STATE_COMPACT_EVERY:
+            self.compact()
+
+    def get(self, key, default=None):
+        with self.lock:
+            return self.values.get(key, default)
+
+    def update(self, **values):
+        with self.lock:
+            self._commit({"op": "set", "values": values})
+
+    def contains(self, name, member):
+        with self.lock:
+            return member in self.sets[name]
+
+    def members(self, name):
+        with self.lock:
+            return set(self.sets[name])
+
+    def add(self, name, member):
+        with self.lock:
+            if member not in self.sets[name]:
+                self._commit({"op": "add", "set": name, "member": member})
+
+    def discard(self, name, member):
+        with self.lock:
+            if member in self.sets[name]:
+                self._commit({"op": "discard", "set": name, "member": member})
+
+    def get_item(self, name, key, default=None):
+        with self.lock:
+            return self.maps[name].get(key, default)
+
+    def items(self, name):
+        with self.lock:
+            return dict(self.maps[name])
+
+    def put(self, name, key, value):
+        with self.lock:
+            self._commit({"op": "put", "map": name, "key": key, "value": value})
+
+    def remove(self, name, key):
+        with self.lock:
+            if key in self.maps[name]:
+                self._commit({"op": "remove", "map": name, "key": key})
+
+    def refresh(self):
+        """
+        Reload the snapshot and journal from disk to pick up changes made by other
+        processes sharing this state file.
+        """
+        with self.lock, self._file_lock(fcntl.LOCK_EX):
+            self._reload()
+
+    def _reload(self):
+        self.values = {}
+        self.sets = {name: set() for name in self.sets}
+        self.maps = {name: {} for name in self.maps}
+        self.journal_entries = 0
+        self._load()
+
+    def compact(self):
+        """
+        Write a fresh snapshot atomically and start an empty journal.
+        """
+        with self.lock, self._file_lock(fcntl.LOCK_EX):
+            # Fold in other processes' journal entries so compaction cannot drop them
+            self._reload()
+            snapshot = dict(self.values)
+            for name, members in self.sets.items():
+                snapshot[name] = sorted(members)
+            snapshot.update(self.maps)
+            save_state(self.filename, snapshot)
+            self.journal.close()
+            # Truncate in place and reopen in append mode: other processes keep their
+            # O_APPEND handles, and so must this one, or it would write at its own
+            # offset over lines they append after the truncate
+            os.truncate(self.journal_file, 0)
+            self.journal = open(self.journal_file, "a")
+            self.journal_entries = 0
+            log_json(10, "State compacted", file=self.filename)
+
+    def close(self):
+        with self.lock:
+            if self.journal_entries:
+                self.compact()
+            self.journal.close()
+            self.lock_file.close()
+
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def open_state(filename, sets=None, maps=None):
+    """
+    Return the shared StateStore for filename, so every component of a run sees one view.
+    """
+    with _stores_lock:
+        store = _stores.get(filename)
+        if store is None:
+            store = _stores[filename] = StateStore(filename, sets, maps)
+        return store
+
+
+def close_all():
+    with _stores_lock:
+        for store in _stores.values():
+            store.close()
+        _stores.clear()
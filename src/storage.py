@@ -1,16 +1,75 @@
+import hashlib
+import io
 import os
+import re
+import shutil
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 
-import boto3
-
+import metrics
 from config import Config
 from logger import log_json
+from state_store import open_state
+
+
+def _record_upload(backend, size, started):
+    metrics.observe("ptm_upload_seconds", time.monotonic() - started, backend=backend)
+    metrics.inc("ptm_images_uploaded_total", backend=backend)
+    metrics.inc("ptm_image_bytes_uploaded_total", size, backend=backend)
+
+
+class SpooledImageWriter:
+    """
+    Spools streamed chunks to a temporary file (in memory while small) and hands it to
+    the storage backend's upload_fileobj() on commit().
+    """
+
+    def __init__(self, storage, filename, content_type=None):
+        self.storage = storage
+        self.filename = filename
+        self.content_type = content_type
+        self.file = tempfile.SpooledTemporaryFile(max_size=Config.STREAM_SPOOL_SIZE)
+
+    def write(self, chunk):
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.seek(0)
+        self.storage.upload_fileobj(self.filename, self.file, self.content_type)
+        self.file.close()
+
+    def abort(self):
+        self.file.close()
 
 
 class StorageBase:
-    def upload_image(self, filename, img_bytes):
+    def upload_image(self, filename, img_bytes, content_type=None):
         raise NotImplementedError()
 
+    def upload_fileobj(self, filename, fileobj, content_type=None):
+        self.upload_image(filename, fileobj.read(), content_type)
+
+    def upload_images(self, images, on_stored=None):
+        """
+        Store a batch of (filename, img_bytes, content_type) tuples, e.g. all images of
+        one ticket. Backends that can upload concurrently override this.
+        :param on_stored: Called with each filename once that image is durably stored.
+        """
+        for filename, img_bytes, content_type in images:
+            self.upload_image(filename, img_bytes, content_type)
+            if on_stored is not None:
+                on_stored(filename)
+
+    def open_image_writer(self, filename, content_type=None):
+        """
+        Return a writer accepting image chunks via write(); the image is stored on
+        commit() and discarded on abort().
+        """
+        return SpooledImageWriter(self, filename, content_type)
+
     def get_image_access(self, filename):
         """
         Return either a local file path (file mode) or a pre-signed URL (s3 mode).
@@ -19,7 +78,14 @@ class StorageBase:
 
 
 class S3Storage(StorageBase):
+    # Buckets already checked or created by this process
+    _known_buckets = set()
+
     def __init__(self):
+        # boto3 is slow to import; only load it when the S3 backend is selected
+        import boto3
+        from boto3.s3.transfer import TransferConfig
+
         if Config.S3_ENDPOINT:
             self.client = boto3.client(
                 "s3",
@@ -33,50 +99,459 @@ class S3Storage(StorageBase):
                 aws_access_key_id=Config.S3_ACCESS_KEY,
                 aws_secret_access_key=Config.S3_SECRET_KEY,
             )
+        # Large objects go multipart; parts of one object upload in parallel
+        self.transfer_config = TransferConfig(
+            multipart_threshold=Config.S3_MULTIPART_THRESHOLD,
+            multipart_chunksize=Config.S3_MULTIPART_CHUNKSIZE,
+            max_concurrency=Config.S3_MAX_CONCURRENCY,
+        )
+        # Separate objects (a ticket's images) upload in parallel through this pool
+        self.pool = ThreadPoolExecutor(
+            max_workers=Config.S3_MAX_CONCURRENCY, thread_name_prefix="s3"
+        )
+        self.presigned = {}
+        self.presigned_lock = threading.Lock()
         self._ensure_bucket()
 
     def _ensure_bucket(self):
-        buckets = self.client.list_buckets()
-        bucket_names = [b["Name"] for b in buckets["Buckets"]]
-        if Config.S3_BUCKET_NAME not in bucket_names:
+        from botocore.exceptions import ClientError
+
+        if Config.S3_BUCKET_NAME in S3Storage._known_buckets:
+            return
+        try:
+            self.client.head_bucket(Bucket=Config.S3_BUCKET_NAME)
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in ("404", "NoSuchBucket"):
+                raise
             self.client.create_bucket(Bucket=Config.S3_BUCKET_NAME)
             log_json(20, "Created S3 bucket", bucket=Config.S3_BUCKET_NAME)
+        S3Storage._known_buckets.add(Config.S3_BUCKET_NAME)
+
+    def upload_image(self, filename, img_bytes, content_type=None):
+        self.upload_fileobj(filename, io.BytesIO(img_bytes), content_type)
 
-    def upload_image(self, filename, img_bytes):
-        # PNG instead of JPG
-        self.client.put_object(
-            Bucket=Config.S3_BUCKET_NAME, Key=filename, Body=img_bytes, ContentType="image/png"
+    def upload_fileobj(self, filename, fileobj, content_type=None):
+        started = time.monotonic()
+        if metrics.ENABLED:
+            start = fileobj.tell()
+            size = fileobj.seek(0, os.SEEK_END) - start
+            fileobj.seek(start)
+        self.client.upload_fileobj(
+            fileobj,
+            Config.S3_BUCKET_NAME,
+            filename,
+            ExtraArgs={"ContentType": content_type or "image/png"},
+            Config=self.transfer_config,
         )
         log_json(20, "Image uploaded to S3", objectName=filename)
+        if metrics.ENABLED:
+            _record_upload("s3", size, started)
+
+    def upload_images(self, images, on_stored=None):
+        futures = {self.pool.submit(self.upload_image, *image): image[0] for image in images}
+        try:
+            for future in as_completed(futures):
+                future.result()
+                if on_stored is not None:
+                    on_stored(futures[future])
+        finally:
+            for future in futures:
+                future.cancel()
 
     def get_image_access(self, filename):
-        # Generate a pre-signed URL valid for (e.g. 1 hour)
+        # Pre-signed URLs are reused until they get close to expiry
+        now = time.monotonic()
+        with self.presigned_lock:
+            cached = self.presigned.get(filename)
+            if cached and cached[1] - now > Config.S3_PRESIGN_EXPIRY * 0.1:
+                return cached[0]
         url = self.client.generate_presigned_url(
-            "get_object", Params={"Bucket": Config.S3_BUCKET_NAME, "Key": filename}, ExpiresIn=3600
+            "get_object",
+            Params={"Bucket": Config.S3_BUCKET_NAME, "Key": filename},
+            ExpiresIn=Config.S3_PRESIGN_EXPIRY,
         )
+        with self.presigned_lock:
+            self.presigned[filename] = (url, now + Config.S3_PRESIGN_EXPIRY)
         return url
 
 
+_DATED_NAME = re.compile(r"(\d{4})(\d{2})\d{2}_")
+_MIGRATED_MARKER = ".sharded"
+# Extensions images and thumbnails are stored under (see images.sniff_format())
+_IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".bmp", ".webp")
+
+
+def shard_path(filename):
+    """
+    Map a storage name to its path under FILE_STORAGE_PATH. Dated names
+    ("20240131_<ticketNo>_1.jpg") go under YYYY/MM/ within their directory, other
+    top-level names under a two-character hash prefix, and names that already live
+    in a subdirectory (e.g. dedup blobs) are kept as they are.
+    """
+    directory, name = os.path.split(filename)
+    match = _DATED_NAME.match(name)
+    if match:
+        return os.path.join(directory, match.group(1), match.group(2), name)
+    if directory:
+        return filename
+    return os.path.join(hashlib.sha1(name.encode()).hexdigest()[:2], name)
+
+
+def _open_temp(full_path):
+    # Hidden, unique name next to the target so the final rename stays on one filesystem
+    directory, name = os.path.split(full_path)
+    tmp_path = os.path.join(directory, f".{name}.{os.getpid()}.{threading.get_ident()}.tmp")
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o666)
+    return os.fdopen(fd, "wb"), tmp_path
+
+
+def _fsync_directories(directories):
+    for directory in directories:
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+
 class FileStorage(StorageBase):
+    """
+    Local image archive. Images are written to a temporary file and renamed into
+    place, so a crash never leaves a truncated image under its real name. With
+    FILE_STORAGE_LAYOUT=sharded, names are spread over subdirectories by
+    shard_path(); archives written flat are moved over by a background thread.
+    """
+
+    # Archive paths whose migration was started by this process
+    _migrations = set()
+
     def __init__(self):
         self.path = Config.FILE_STORAGE_PATH
         if not os.path.exists(self.path):
             os.makedirs(self.path, exist_ok=True)
             log_json(20, "Created local directory for images", directory=self.path)
+        self.sharded = Config.FILE_STORAGE_LAYOUT == "sharded"
+        self.migrating = self.sharded and not os.path.exists(
+            os.path.join(self.path, _MIGRATED_MARKER)
+        )
+        if self.migrating and self.path not in FileStorage._migrations:
+            FileStorage._migrations.add(self.path)
+            threading.Thread(target=self._migrate, name="file-migrate", daemon=True).start()
+
+    def _relative_path(self, filename):
+        return shard_path(filename) if self.sharded else filename
 
-    def upload_image(self, filename, img_bytes):
-        full_path = os.path.join(self.path, filename)
-        with open(full_path, "wb") as f:
-            f.write(img_bytes)
+    def _full_path(self, filename):
+        full_path = os.path.join(self.path, self._relative_path(filename))
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        return full_path
+
+    def upload_image(self, filename, img_bytes, content_type=None):
+        self.upload_images([(filename, img_bytes, content_type)])
+
+    def upload_fileobj(self, filename, fileobj, content_type=None):
+        started = time.monotonic()
+        full_path = self._full_path(filename)
+        f, tmp_path = _open_temp(full_path)
+        try:
+            with f:
+                shutil.copyfileobj(fileobj, f)
+                size = f.tell()
+                if Config.FILE_STORAGE_FSYNC:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, full_path)
+        except BaseException:
+            _remove_quietly(tmp_path)
+            raise
+        if Config.FILE_STORAGE_FSYNC:
+            _fsync_directories([os.path.dirname(full_path)])
         log_json(20, "Image saved locally", path=full_path)
+        _record_upload("file", size, started)
+
+    def upload_images(self, images, on_stored=None):
+        # All images of a ticket are written first, then synced and renamed together,
+        # with each directory synced once per batch rather than once per image. Images
+        # only count as stored after that sync, so on_stored() runs for the whole batch.
+        started = time.monotonic()
+        written = []
+        try:
+            for filename, img_bytes, content_type in images:
+                full_path = self._full_path(filename)
+                f, tmp_path = _open_temp(full_path)
+                written.append((full_path, tmp_path, len(img_bytes)))
+                with f:
+                    f.write(img_bytes)
+                    if Config.FILE_STORAGE_FSYNC:
+                        f.flush()
+                        os.fsync(f.fileno())
+        except BaseException:
+            for full_path, tmp_path, size in written:
+                _remove_quietly(tmp_path)
+            raise
+        for full_path, tmp_path, size in written:
+            os.replace(tmp_path, full_path)
+        if Config.FILE_STORAGE_FSYNC:
+            _fsync_directories({os.path.dirname(full_path) for full_path, _, _ in written})
+        for (filename, _, _), (full_path, tmp_path, size) in zip(images, written):
+            log_json(20, "Image saved locally", path=full_path)
+            _record_upload("file", size, started)
+            if on_stored is not None:
+                on_stored(filename)
+
+    def open_image_writer(self, filename, content_type=None):
+        return FileImageWriter(self._full_path(filename))
 
     def get_image_access(self, filename):
-        # Return local file path
-        return os.path.join(self.path, filename)
+        # Return local file path, computed from the layout. Until the flat archive
+        # is migrated, an image may still be at its old path.
+        full_path = os.path.join(self.path, self._relative_path(filename))
+        if self.migrating and not os.path.exists(full_path):
+            legacy_path = os.path.join(self.path, filename)
+            if os.path.exists(legacy_path):
+                return legacy_path
+        return full_path
+
+    def _migrate(self):
+        """
+        Move images stored by the flat layout (directly in FILE_STORAGE_PATH or one
+        directory below it, e.g. thumbs/) to their sharded paths. Each move is a
+        rename, so images stay readable throughout and an interrupted migration
+        resumes on the next start. Only image files move: FILE_STORAGE_PATH may be
+        shared with the state file, archive and other data.
+        """
+        moved = 0
+        try:
+            directories = [self.path] + [
+                entry.path for entry in os.scandir(self.path) if entry.is_dir()
+            ]
+            for directory in directories:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.name.startswith(".") or not entry.is_file(follow_symlinks=False):
+                            continue
+                        if not entry.name.lower().endswith(_IMAGE_EXTENSIONS):
+                            continue
+                        relative = os.path.relpath(entry.path, self.path)
+                        target = shard_path(relative)
+                        if target != relative and self._move(entry.path, target):
+                            moved += 1
+            with open(os.path.join(self.path, _MIGRATED_MARKER), "w"):
+                pass
+        except Exception as e:
+            log_json(40, "Image archive migration failed", error=str(e), moved=moved)
+            return
+        self.migrating = False
+        if moved:
+            log_json(20, "Image archive migrated to sharded layout", moved=moved)
+
+    def _move(self, source, target):
+        full_path = os.path.join(self.path, target)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        try:
+            if os.path.exists(full_path):
+                # Stored again since the upgrade; the sharded copy wins
+                os.remove(source)
+                return False
+            os.rename(source, full_path)
+        except FileNotFoundError:
+            # Moved by another process sharing the archive
+            return False
+        return True
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class FileImageWriter:
+    def __init__(self, full_path):
+        self.full_path = full_path
+        self.file, self.tmp_path = _open_temp(full_path)
+        self.started = time.monotonic()
+
+    def write(self, chunk):
+        self.file.write(chunk)
+
+    def commit(self):
+        size = self.file.tell()
+        if Config.FILE_STORAGE_FSYNC:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+        self.file.close()
+        os.replace(self.tmp_path, self.full_path)
+        if Config.FILE_STORAGE_FSYNC:
+            _fsync_directories([os.path.dirname(self.full_path)])
+        log_json(20, "Image saved locally", path=self.full_path)
+        _record_upload("file", size, self.started)
+
+    def abort(self):
+        self.file.close()
+        _remove_quietly(self.tmp_path)
+
+
+class DedupStorage(StorageBase):
+    """
+    Content-addressed wrapper around a backend. Each distinct image is stored once
+    under its SHA-256 digest and ticket filenames become references in a local index,
+    so content that is already stored is skipped without asking the backend.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self.index = open_state(Config.DEDUP_INDEX_FILE, sets=(), maps=("blobs", "refs"))
+        self.lock = threading.Lock()
+        self.pending = {}
+
+    def upload_image(self, filename, img_bytes, content_type=None):
+        digest = hashlib.sha256(img_bytes).hexdigest()
+        self._store(
+            filename,
+            digest,
+            lambda blob: self.backend.upload_image(blob, img_bytes, content_type),
+        )
+
+    def upload_fileobj(self, filename, fileobj, content_type=None, digest=None):
+        if digest is None:
+            sha = hashlib.sha256()
+            for chunk in iter(lambda: fileobj.read(Config.STREAM_CHUNK_SIZE), b""):
+                sha.update(chunk)
+            fileobj.seek(0)
+            digest = sha.hexdigest()
+        self._store(
+            filename,
+            digest,
+            lambda blob: self.backend.upload_fileobj(blob, fileobj, content_type),
+        )
+
+    def open_image_writer(self, filename, content_type=None):
+        return DedupImageWriter(self, filename, content_type)
+
+    def upload_images(self, images, on_stored=None):
+        # Claim every digest first, upload only new content as one backend batch, and
+        # only then wait for content that other workers are uploading (never while
+        # holding claims of our own, so two batches cannot wait on each other)
+        refs = []
+        claimed = {}
+        waiting = {}
+        for filename, img_bytes, content_type in images:
+            digest = hashlib.sha256(img_bytes).hexdigest()
+            refs.append((filename, digest, img_bytes, content_type))
+            if digest in claimed or digest in waiting:
+                continue
+            blob, event = self._claim(digest)
+            if event is not None:
+                waiting[digest] = event
+            elif blob is None:
+                claimed[digest] = (self._blob_name(digest, filename), img_bytes, content_type)
+
+        # Each new blob is indexed, and its references reported, as soon as it is stored
+        digests = {blob: digest for digest, (blob, _, _) in claimed.items()}
+
+        def blob_stored(blob):
+            digest = digests[blob]
+            self.index.put("blobs", digest, blob)
+            for filename, ref_digest, _, _ in refs:
+                if ref_digest == digest:
+                    self.index.put("refs", filename, blob)
+                    if on_stored is not None:
+                        on_stored(filename)
+
+        try:
+            self.backend.upload_images(list(claimed.values()), blob_stored)
+        finally:
+            self._release(claimed)
+        for event in waiting.values():
+            event.wait()
+
+        for filename, digest, img_bytes, content_type in refs:
+            if digest in claimed:
+                continue
+            blob = self.index.get_item("blobs", digest)
+            if blob is None:
+                # The other uploader failed; store it ourselves
+                self.upload_image(filename, img_bytes, content_type)
+            else:
+                log_json(20, "Image already stored, skipping upload", objectName=filename)
+                self.index.put("refs", filename, blob)
+            if on_stored is not None:
+                on_stored(filename)
+
+    def _blob_name(self, digest, filename):
+        return f"blobs/{digest[:2]}/{digest}{os.path.splitext(filename)[1]}"
+
+    def _claim(self, digest):
+        """
+        Return (blob, None) if the content is stored, (None, event) if another worker is
+        uploading it, or (None, None) once this caller has claimed the upload.
+        """
+        with self.lock:
+            blob = self.index.get_item("blobs", digest)
+            event = self.pending.get(digest)
+            if blob is None and event is None:
+                self.pending[digest] = threading.Event()
+            return blob, event
+
+    def _release(self, digests):
+        with self.lock:
+            for digest in digests:
+                self.pending.pop(digest).set()
+
+    def _store(self, filename, digest, upload):
+        while True:
+            blob, event = self._claim(digest)
+            if event is None:
+                break
+            # Another worker is uploading the same content; wait and re-check
+            event.wait()
+        if blob is not None:
+            log_json(20, "Image already stored, skipping upload", objectName=filename)
+            self.index.put("refs", filename, blob)
+            return
+
+        blob = self._blob_name(digest, filename)
+        try:
+            upload(blob)
+            self.index.put("blobs", digest, blob)
+        finally:
+            self._release([digest])
+        self.index.put("refs", filename, blob)
+
+    def get_image_access(self, filename):
+        blob = self.index.get_item("refs", filename)
+        if blob is None:
+            # Another process (e.g. a cron run next to a standalone image server) may
+            # have stored it since the index was loaded
+            self.index.refresh()
+            blob = self.index.get_item("refs", filename, filename)
+        return self.backend.get_image_access(blob)
+
+
+class DedupImageWriter(SpooledImageWriter):
+    def __init__(self, storage, filename, content_type=None):
+        super().__init__(storage, filename, content_type)
+        self.sha = hashlib.sha256()
+
+    def write(self, chunk):
+        self.sha.update(chunk)
+        self.file.write(chunk)
+
+    def commit(self):
+        self.file.seek(0)
+        self.storage.upload_fileobj(
+            self.filename, self.file, self.content_type, digest=self.sha.hexdigest()
+        )
+        self.file.close()
 
 
 def get_storage():
     if Config.STORAGE_BACKEND == "file":
-        return FileStorage()
+        storage = FileStorage()
     else:
-        return S3Storage()
+        storage = S3Storage()
+    if Config.STORAGE_DEDUP:
+        storage = DedupStorage(storage)
+    return storage
@@ -1,47 +1,79 @@
+import hashlib
 import json
-from datetime import datetime
-
-import requests
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
 
+import image_server
+import metrics
+from accounts import default_account
+from archive import get_archive
 from config import Config
+from evidence_stream import IMAGE_KEY, Base64Sink, EvidenceScanner, iter_envelope_value, iter_text
+from http_client import get_client, unwrap
+from images import get_image_processor, sniff_format
 from logger import log_json
-from notifier import send_notification
-from utils import current_req_dtm, load_state, parse_date_dmy, random_uuid, save_state
+from outbox import get_outbox
+from state_store import open_state
+from utils import current_req_dtm, parse_date_dmy
+
+
+# ticketDetail fields whose changes are reported for already processed tickets
+TRACKED_FIELDS = ("paidStatus", "fineAmount")
+
+
+class _ResumableWriter:
+    """
+    Wraps a streamed image's storage writer to checkpoint the image once it is
+    committed. Without a writer, the image is already stored and is discarded.
+    """
+
+    def __init__(self, writer, on_commit):
+        self.writer = writer
+        self.on_commit = on_commit
+
+    def write(self, chunk):
+        if self.writer is not None:
+            self.writer.write(chunk)
+
+    def commit(self):
+        if self.writer is not None:
+            self.writer.commit()
+            self.on_commit()
+
+    def abort(self):
+        if self.writer is not None:
+            self.writer.abort()
 
 
 class TicketProcessor:
-    def __init__(self, accessToken, storage):
+    def __init__(self, accessToken, storage, account=None):
         self.accessToken = accessToken
         self.storage = storage
-        self.state = load_state(Config.STATE_FILE)
+        self.account = account or default_account()
+        self.state = open_state(self.account.state_file)
+        self.client = get_client()
+        self.archive = get_archive()
 
     def common_headers(self):
-        return {
-            "reqBy": "ETICKET",
-            "reqDtm": current_req_dtm(),
-            "reqID": random_uuid(),
-            "src": "ETICKET",
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.accessToken}",
-        }
+        return self.client.headers(self.accessToken)
 
-    def get_all_tickets(self, paidStatus=""):
+    def get_all_tickets(self, paidStatus="", fromDate=None, toDate=None):
         payload = {
-            "fromDate": self._one_year_ago_str(),
-            "toDate": self._today_str(),
+            "fromDate": fromDate or self._one_year_ago_str(),
+            "toDate": toDate or self._today_str(),
             "reqDtm": current_req_dtm(),
-            "citizen": Config.CITIZEN_ID,
+            "citizen": self.account.citizen_id,
             "paidStatus": paidStatus,
         }
-        response = requests.post(
-            Config.BASE_URL_ALLTICKETS, headers=self.common_headers(), json=payload
+        response = self.client.post(
+            Config.BASE_URL_ALLTICKETS, payload, accessToken=self.accessToken
         )
         if response.status_code != 200:
             log_json(40, "allTickets failed", status=response.status_code)
             raise Exception("allTickets failed")
-
-        outer = response.json()
-        data = json.loads(outer["value"])
+        data = unwrap(response)
         if data["status"] != "000" and data["msgEn"] != "Not found Ticket":
             log_json(40, "allTickets error", msgEn=data["msgEn"])
             raise Exception(f"allTickets error: {data['msgEn']}")
@@ -51,14 +83,13 @@ class TicketProcessor:
 
     def get_ticket_detail(self, ticketNo):
         payload = {"ticketNo": ticketNo, "reqDtm": current_req_dtm()}
-        response = requests.post(
-            Config.BASE_URL_TICKETDETAIL, headers=self.common_headers(), json=payload
+        response = self.client.post(
+            Config.BASE_URL_TICKETDETAIL, payload, accessToken=self.accessToken
         )
         if response.status_code != 200:
             log_json(40, "ticketDetail failed", status=response.status_code)
             raise Exception("ticketDetail failed")
-        outer = response.json()
-        data = json.loads(outer["value"])
+        data = unwrap(response)
         if data["status"] != "000":
             log_json(40, "ticketDetail error", msgEn=data["msgEn"])
             raise Exception(f"ticketDetail error: {data['msgEn']}")
@@ -66,94 +97,483 @@ class TicketProcessor:
 
     def get_image_evidence(self, ticketNo):
         payload = {
-            "citizen": Config.CITIZEN_ID,
+            "citizen": self.account.citizen_id,
             "ticketNo": ticketNo,
             "reqDtm": current_req_dtm(),
         }
-        response = requests.post(
-            Config.BASE_URL_IMAGEEVIDENCE, headers=self.common_headers(), json=payload
+        response = self.client.post(
+            Config.BASE_URL_IMAGEEVIDENCE, payload, accessToken=self.accessToken
         )
         if response.status_code != 200:
             log_json(40, "imageevidence failed", status=response.status_code)
             raise Exception("imageevidence failed")
-        outer = response.json()
-        data = json.loads(outer["value"])
+        data = unwrap(response)
         if data["status"] != "000":
             log_json(40, "imageevidence error", msgEn=data["msgEn"])
             raise Exception(f"imageevidence error: {data['msgEn']}")
         return data
 
+    def stream_image_evidence(self, ticketNo, filename_for, stored=None, on_stored=None):
+        """
+        Stream the imageevidence response into storage without materialising it.
+        Each upImageN field is base64-decoded chunk by chunk into the storage writer
+        for filename_for(N, extension), with the extension sniffed from its first bytes.
+        Returns the stored filenames in image order.
+        :param stored: {N: filename} of images already stored; they are skipped.
+        :param on_stored: Called with (N, filename) as each new image is committed.
+        """
+        stored = stored or {}
+        payload = {
+            "citizen": self.account.citizen_id,
+            "ticketNo": ticketNo,
+            "reqDtm": current_req_dtm(),
+        }
+        response = self.client.post(
+            Config.BASE_URL_IMAGEEVIDENCE, payload, accessToken=self.accessToken, stream=True
+        )
+        try:
+            if response.status_code != 200:
+                log_json(40, "imageevidence failed", status=response.status_code)
+                raise Exception("imageevidence failed")
+
+            names = {}
+
+            def open_sink(index):
+                def open_writer(head):
+                    if index in stored:
+                        names[index] = stored[index]
+                        return _ResumableWriter(None, None)
+                    extension, content_type = sniff_format(head)
+                    name = names[index] = filename_for(index, extension)
+                    writer = self.storage.open_image_writer(name, content_type)
+                    if on_stored is None:
+                        return writer
+                    return _ResumableWriter(writer, lambda: on_stored(index, name))
+
+                return Base64Sink(open_writer)
+
+            scanner = EvidenceScanner(open_sink)
+            try:
+                chunks = response.iter_content(chunk_size=Config.STREAM_CHUNK_SIZE)
+                for text in iter_envelope_value(iter_text(chunks)):
+                    scanner.feed(text)
+                data = scanner.finish()
+            except BaseException:
+                scanner.abort()
+                raise
+        finally:
+            response.close()
+
+        if data["status"] != "000":
+            log_json(40, "imageevidence error", msgEn=data["msgEn"])
+            raise Exception(f"imageevidence error: {data['msgEn']}")
+
+        stored = [int(IMAGE_KEY.match(key).group(1)) for key, ok in scanner.stored.items() if ok]
+        return [names[index] for index in sorted(stored)]
+
+    def fetch_tickets(self):
+        """
+        Fetch ticket headers: a partitioned backfill if the account has not been
+        backfilled BACKFILL_DAYS deep yet, otherwise the full one-year window or, in
+        incremental sync mode, a short overlapping window since the last seen ticket
+        date. Returns (batches, full_sync, backfill), where batches yields lists of
+        tickets as they arrive.
+        """
+        backfilled = self.state.get("backfillDays")
+        if backfilled is None:
+            # Accounts synced before backfills existed have their year already; states
+            # from before lastFullSync existed only show it through processed tickets
+            synced = self.state.get("lastFullSync") or self.state.members("processedTickets")
+            backfilled = 365 if synced else 0
+        if Config.BACKFILL_WINDOW_DAYS > 0 and backfilled < Config.BACKFILL_DAYS:
+            return self._backfill_batches(), Config.BACKFILL_DAYS >= 365, True
+
+        highWater = self.state.get("syncHighWater")
+        lastFullSync = self.state.get("lastFullSync")
+        full_sync = (
+            Config.SYNC_MODE != "incremental"
+            or not highWater
+            or not lastFullSync
+            or datetime.now() - datetime.fromisoformat(lastFullSync)
+            >= timedelta(hours=Config.FULL_SYNC_INTERVAL_HOURS)
+        )
+        if full_sync:
+            tickets = self.get_all_tickets()
+        else:
+            since = datetime.fromisoformat(highWater) - timedelta(days=Config.SYNC_OVERLAP_DAYS)
+            tickets = self.get_all_tickets(fromDate=since.strftime("%d/%m/%Y"))
+        log_json(20, "Retrieved tickets", count=len(tickets), fullSync=full_sync)
+        return [tickets], full_sync, False
+
+    def _backfill_batches(self):
+        """
+        Split the last BACKFILL_DAYS into BACKFILL_WINDOW_DAYS windows, fetch them
+        BACKFILL_CONCURRENCY at a time, newest first, and yield each window's
+        tickets as soon as it arrives.
+        """
+        today = datetime.now()
+        start = today - timedelta(days=Config.BACKFILL_DAYS)
+        windows = []
+        toDate = today
+        while toDate >= start:
+            fromDate = max(start, toDate - timedelta(days=Config.BACKFILL_WINDOW_DAYS - 1))
+            windows.append((fromDate.strftime("%d/%m/%Y"), toDate.strftime("%d/%m/%Y")))
+            toDate = fromDate - timedelta(days=1)
+        log_json(20, "Backfill started", days=Config.BACKFILL_DAYS, windows=len(windows))
+
+        workers = max(1, min(Config.BACKFILL_CONCURRENCY, len(windows)))
+        with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="backfill") as pool:
+            futures = {
+                pool.submit(self.get_all_tickets, fromDate=fromDate, toDate=toDate): (
+                    fromDate,
+                    toDate,
+                )
+                for fromDate, toDate in windows
+            }
+            try:
+                for future in as_completed(futures):
+                    tickets = future.result()
+                    fromDate, toDate = futures[future]
+                    log_json(
+                        20,
+                        "Retrieved tickets",
+                        count=len(tickets),
+                        fromDate=fromDate,
+                        toDate=toDate,
+                    )
+                    yield tickets
+            finally:
+                for future in futures:
+                    future.cancel()
+
+    def _advance_sync(self, tickets, full_sync, backfill=False):
+        # Only called once every fetched ticket is committed, so nothing is skipped
+        dates = [d for d in (self._ticket_date(t) for t in tickets) if d]
+        highWater = self.state.get("syncHighWater")
+        if dates and (not highWater or max(dates).isoformat() > highWater):
+            highWater = max(dates).isoformat()
+        elif not highWater:
+            # No tickets yet: the sync itself covered everything up to today
+            highWater = datetime.now().date().isoformat()
+        values = {"syncHighWater": highWater}
+        if full_sync:
+            values["lastFullSync"] = datetime.now().isoformat()
+        if backfill:
+            values["backfillDays"] = Config.BACKFILL_DAYS
+        self.state.update(**values)
+
+    def _ticket_date(self, ticket):
+        # allTickets filters on the offence date, so prefer it over the posting date
+        for key in ("dateHappen", "createDate"):
+            value = ticket.get(key)
+            if value:
+                try:
+                    return parse_date_dmy(value.split(" ")[0]).date()
+                except ValueError:
+                    continue
+        return None
+
     def process_tickets(self):
-        tickets = self.get_all_tickets()
-        log_json(20, "Retrieved tickets", count=len(tickets))
+        batches, full_sync, backfill = self.fetch_tickets()
+
+        tickets = []
+        seen = set()
+        outbox = None
+        # (header, upload) in commit order, and (header, detail) for changed tickets
+        pending = deque()
+        changes = []
+        new_count = 0
+        workers = max(1, Config.TICKET_CONCURRENCY)
+        fetch_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fetch")
+        upload_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="upload")
+        # Tickets between fetch and upload; fetched evidence waits in memory until its
+        # upload runs, so it must not pile up when storage is slower than the API
+        in_flight = threading.BoundedSemaphore(2 * workers)
+        try:
+            # Each batch (one backfill window, or the whole list) is fed into the
+            # pipeline as soon as it arrives
+            for batch in batches:
+                # Backfill windows can share a ticket; the first copy wins
+                batch = [t for t in batch if t["ticketNo"] not in seen]
+                seen.update(t["ticketNo"] for t in batch)
+                tickets.extend(batch)
+                if self.archive is not None:
+                    self.archive.record_headers(self.account.citizen_id, batch)
+
+                new_tickets, changed_tickets = self._classify(batch)
+                if outbox is None and (new_tickets or changed_tickets):
+                    outbox = get_outbox(self.storage)
+                # Changed tickets only need their detail; stored evidence is reused
+                changes += [
+                    (t, fetch_pool.submit(self.get_ticket_detail, t["ticketNo"]))
+                    for t in changed_tickets
+                ]
+                for t in new_tickets:
+                    in_flight.acquire()
+                    fetch = fetch_pool.submit(self._fetch_ticket, t["ticketNo"])
+                    upload = upload_pool.submit(self._store_ticket, fetch)
+                    upload.add_done_callback(lambda _: in_flight.release())
+                    pending.append((t, upload))
+                new_count += len(new_tickets)
 
-        processedTickets = self.state.get("processedTickets", [])
-        new_tickets = [t for t in tickets if t["ticketNo"] not in processedTickets]
+                # Commit what is already stored while later windows are still arriving
+                while pending and pending[0][1].done():
+                    self._commit_ticket(*pending.popleft(), outbox)
 
-        if not new_tickets:
+            # Commit in ticket order, each only once its images are stored
+            while pending:
+                self._commit_ticket(*pending.popleft(), outbox)
+            for ticket, change in changes:
+                self._commit_change(ticket, change.result(), outbox)
+        finally:
+            fetch_pool.shutdown(cancel_futures=True)
+            upload_pool.shutdown(cancel_futures=True)
+            if outbox is not None:
+                outbox.poll_complete()
+
+        if full_sync:
+            # Checkpoints of tickets the API no longer lists will never be resumed
+            for ticketNo in self.state.items("checkpoints").keys() - seen:
+                self.state.remove("checkpoints", ticketNo)
+        self._advance_sync(tickets, full_sync, backfill)
+        if not new_count and not changes:
             log_json(20, "No new tickets to process")
-            return
+            return 0
+        log_json(20, "Processing complete", changed=len(changes))
+        log_json(20, "API governor", endpoints=self.client.governor.snapshot())
+        return new_count
 
-        for ticket in new_tickets:
-            ticketNo = ticket["ticketNo"]
-            detail = self.get_ticket_detail(ticketNo)
+    def _classify(self, tickets):
+        """
+        Split ticket headers into new tickets and processed tickets whose entry changed.
+        """
+        new_tickets = []
+        changed_tickets = []
+        for t in tickets:
+            if not self.state.contains("processedTickets", t["ticketNo"]):
+                new_tickets.append(t)
+                continue
+            record = self.state.get_item("tickets", t["ticketNo"])
+            if record is None:
+                # Processed before changes were tracked; start from the current header,
+                # so the first later change has a status to compare against
+                record = {field: t[field] for field in TRACKED_FIELDS if field in t}
+                record["fingerprint"] = self._fingerprint(t)
+                self.state.put("tickets", t["ticketNo"], record)
+            elif record["fingerprint"] != self._fingerprint(t):
+                changed_tickets.append(t)
+        return new_tickets, changed_tickets
 
-            # Extract key ticket information
-            ticket_info = {
-                "ticketNo": ticketNo,
-                "dateHappen": detail["dateHappen"],
-                "fineAmount": detail.get("fineAmount"),
-                "licensePlate": detail.get("plate"),
-                "location": detail.get("road"),
-                "offense": detail.get("accuse1Desc"),
-                "paidStatus": detail.get("paidStatus"),
-                "limitSpeed": detail.get("limitSpeed"),
-                "speed": detail.get("speed"),
-                "lane": detail.get("lane"),
-                "orderDivision": detail.get("orderDivision"),
-                "createDate": detail.get("createDate"),
-                "orderName": detail.get("orderName"),
-            }
-            log_json(20, "Processing ticket", ticketInfo=ticket_info)
+    def _commit_ticket(self, header, upload, outbox):
+        ticket_info, images, attachments = upload.result()
+        ticketNo = ticket_info["ticketNo"]
+
+        # Persisted to the outbox before the ticket counts as processed, so a
+        # crash in between can at worst repeat a notification, never lose it
+        if not self.state.get_item("checkpoints", ticketNo, {}).get("notified"):
+            outbox.enqueue(self._format_notification_message(ticket_info, len(images)), attachments)
+            self._checkpoint(ticketNo, notified=True)
+
+        self.state.put(
+            "tickets",
+            ticketNo,
+            {
+                "fingerprint": self._fingerprint(header),
+                "images": images,
+                "attachments": attachments,
+                **{field: ticket_info[field] for field in TRACKED_FIELDS},
+            },
+        )
+        # Add ticket to processed list
+        self.state.add("processedTickets", ticketNo)
+        self.state.remove("checkpoints", ticketNo)
+        if self.archive is not None:
+            self.archive.record_ticket(self.account.citizen_id, ticket_info, images)
+        metrics.inc("ptm_tickets_processed_total")
 
-            # Prepare date for image filenames
-            date_str = detail["dateHappen"].split(" ")[0]  # e.g., "01/12/2024"
-            happen_dt = parse_date_dmy(date_str)
-            date_for_name = happen_dt.strftime("%Y%m%d")
+    def _fingerprint(self, ticket):
+        # Compact digest of the allTickets entry; any change to it triggers a detail refetch
+        encoded = json.dumps(ticket, sort_keys=True, ensure_ascii=False).encode()
+        return hashlib.sha1(encoded).hexdigest()[:16]
 
-            # Get and save image evidence
+    def _commit_change(self, ticket, detail, outbox):
+        ticketNo = ticket["ticketNo"]
+        record = self.state.get_item("tickets", ticketNo)
+        ticket_info = self._ticket_info(ticketNo, detail)
+        # A field the record never had (seeded from a header without it) is unknown,
+        # so its first fetched value is reported rather than silently adopted
+        changes = {
+            field: (record.get(field, "unknown"), ticket_info[field])
+            for field in TRACKED_FIELDS
+            if field not in record or record[field] != ticket_info[field]
+        }
+        if changes:
+            log_json(20, "Ticket changed", ticketNo=ticketNo, changes=changes)
+            metrics.inc("ptm_ticket_changes_total")
+            outbox.enqueue(
+                self._format_change_message(ticket_info, changes, len(record.get("images", []))),
+                record.get("attachments", []),
+            )
+        record = dict(record, fingerprint=self._fingerprint(ticket))
+        record.update((field, ticket_info[field]) for field in TRACKED_FIELDS)
+        self.state.put("tickets", ticketNo, record)
+        if self.archive is not None:
+            self.archive.record_ticket(self.account.citizen_id, ticket_info)
+
+    def _ticket_info(self, ticketNo, detail):
+        # Extract key ticket information
+        return {
+            "ticketNo": ticketNo,
+            "dateHappen": detail["dateHappen"],
+            "fineAmount": detail.get("fineAmount"),
+            "licensePlate": detail.get("plate"),
+            "location": detail.get("road"),
+            "offense": detail.get("accuse1Desc"),
+            "paidStatus": detail.get("paidStatus"),
+            "limitSpeed": detail.get("limitSpeed"),
+            "speed": detail.get("speed"),
+            "lane": detail.get("lane"),
+            "orderDivision": detail.get("orderDivision"),
+            "createDate": detail.get("createDate"),
+            "orderName": detail.get("orderName"),
+        }
+
+    def _checkpoint(self, ticketNo, **values):
+        """
+        Record completed stages of a ticket in the "checkpoints" state map, so an
+        interrupted run resumes it instead of starting over. Removed once the ticket
+        is processed.
+        """
+        record = dict(self.state.get_item("checkpoints", ticketNo, {}))
+        record.update(values)
+        self.state.put("checkpoints", ticketNo, record)
+
+    def _fetch_ticket(self, ticketNo):
+        # Stages completed by an interrupted earlier run are not repeated
+        checkpoint = self.state.get_item("checkpoints", ticketNo, {})
+        detail = checkpoint.get("detail")
+        if detail is None:
+            detail = self.get_ticket_detail(ticketNo)
+            self._checkpoint(ticketNo, detail=detail)
+        else:
+            log_json(
+                20,
+                "Resuming ticket from checkpoint",
+                ticketNo=ticketNo,
+                imagesStored=len(checkpoint.get("images", {})),
+                allImagesStored=bool(checkpoint.get("imagesComplete")),
+            )
+        # Streamed evidence is fetched by the upload stage, straight into storage.
+        # Encrypted responses have to be decrypted whole, so they are never streamed.
+        stream = Config.STREAM_EVIDENCE and not Config.PTM_ENCRYPTION
+        if stream or checkpoint.get("imagesComplete"):
+            image_data = None
+        else:
             image_data = self.get_image_evidence(ticketNo)
-            images = []
-            attachments = []
+        return ticketNo, detail, image_data
+
+    def _store_ticket(self, fetch):
+        ticketNo, detail, image_data = fetch.result()
+        ticket_info = self._ticket_info(ticketNo, detail)
+        log_json(20, "Processing ticket", ticketInfo=ticket_info)
+
+        # Prepare date for image filenames
+        date_str = detail["dateHappen"].split(" ")[0]  # e.g., "01/12/2024"
+        happen_dt = parse_date_dmy(date_str)
+        date_for_name = happen_dt.strftime("%Y%m%d")
+
+        def filename_for(index, extension):
+            return f"{date_for_name}_{ticketNo}_{index}.{extension}"
+
+        # Images stored by an earlier run: index -> [filename, thumbnail or None]
+        checkpoint = self.state.get_item("checkpoints", ticketNo, {})
+        stored = {int(i): entry for i, entry in checkpoint.get("images", {}).items()}
+
+        def checkpoint_images(entries, complete=False):
+            images = {str(i): entry for i, entry in entries.items()}
+            self._checkpoint(ticketNo, images=images, imagesComplete=complete)
+
+        # Save image evidence
+        batch = []
+        # Buffered images are checkpointed one by one, once the image and its
+        # thumbnail are both stored: storage filename -> image index, and the number
+        # of files each index still waits for
+        durable = dict(stored)
+        files = {}
+        waiting = {}
+        if checkpoint.get("imagesComplete"):
+            pass
+        elif image_data is None:
+
+            def on_stored(index, filename):
+                stored[index] = [filename, None]
+                checkpoint_images(stored)
+
+            streamed = self.stream_image_evidence(
+                ticketNo,
+                filename_for,
+                {i: entry[0] for i, entry in stored.items()},
+                on_stored,
+            )
+            # Every image in the response must be checkpointed before the ticket counts
+            # as complete, or a rerun would never fetch the missing ones
+            missing = set(streamed) - {entry[0] for entry in stored.values()}
+            if missing:
+                log_json(40, "Streamed images not stored", ticketNo=ticketNo, missing=missing)
+                raise Exception(f"Streamed images not stored for ticket {ticketNo}")
+        else:
+            # Encoding runs in the image worker pool
+            processor = get_image_processor()
+            pending = []
             for i in range(1, 10):
                 key = f"upImage{i}"
-                if key in image_data and image_data[key]:
+                if key in image_data and image_data[key] and i not in stored:
                     img_data = image_data[key]
                     img_bytes = self._decode_image(img_data)
-                    filename = f"{date_for_name}_{ticketNo}_{i}.png"
-                    self.storage.upload_image(filename, img_bytes)
-                    images.append(filename)
-                    # Attachments depend on storage backend
-                    attachments.append(self.storage.get_image_access(filename))  # S3 URL
-
-            # Add ticket to processed list
-            processedTickets.append(ticketNo)
-            self.state["processedTickets"] = processedTickets
-            save_state(Config.STATE_FILE, self.state)
-
-            # Notify with ticket information
-            if Config.STORAGE_BACKEND == "file":
-                send_notification(
-                    self._format_notification_message(ticket_info, len(images)),
-                    attachments=attachments,
-                )
-            else:
-                # S3 mode: include image URLs in the message
-                urls = "\n".join(attachments)
-                message = self._format_notification_message(ticket_info, len(images)) + "\n" + urls
-                send_notification(message)
+                    metrics.inc("ptm_images_decoded_total")
+                    metrics.inc("ptm_image_bytes_decoded_total", len(img_bytes))
+                    pending.append((i, processor.submit(img_bytes)))
+            for i, future in pending:
+                processed = future.result()
+                filename = filename_for(i, processed.extension)
+                batch.append((filename, processed.data, processed.content_type))
+                stored[i] = [filename, None]
+                files[filename] = i
+                if processed.thumbnail:
+                    thumb_bytes, thumb_extension, thumb_type = processed.thumbnail
+                    thumbname = f"thumbs/{filename.rsplit('.', 1)[0]}.{thumb_extension}"
+                    batch.append((thumbname, thumb_bytes, thumb_type))
+                    stored[i][1] = thumbname
+                    files[thumbname] = i
+                waiting[i] = 2 if processed.thumbnail else 1
+
+        images = [stored[i][0] for i in sorted(stored)]
+        # Images to attach or link; thumbnails are preferred when present
+        attachments = [stored[i][1] or stored[i][0] for i in sorted(stored)]
+        if image_server.LINKS_ENABLED and images:
+            batch.append(self._gallery(ticket_info, images, attachments))
+
+        def on_uploaded(filename):
+            i = files.get(filename)
+            if i is None:
+                return
+            waiting[i] -= 1
+            if not waiting[i]:
+                durable[i] = stored[i]
+                checkpoint_images(durable)
 
-        log_json(20, "Processing complete")
+        if batch:
+            # The whole ticket goes to storage as one batch so backends can upload in parallel
+            self.storage.upload_images(batch, on_uploaded)
+        if not checkpoint.get("imagesComplete"):
+            checkpoint_images(stored, complete=True)
+        return ticket_info, images, attachments
+
+    def _gallery(self, ticket_info, images, previews):
+        # Manifest for the image server's gallery page, stored alongside the images
+        name = image_server.gallery_name(image_server.gallery_id(images))
+        manifest = image_server.gallery_manifest(ticket_info, images, previews)
+        return name, manifest, "application/json"
 
     def _format_notification_message(self, ticket_info, image_count):
         """
@@ -184,6 +604,21 @@ class TicketProcessor:
 
         return text_msg
 
+    def _format_change_message(self, ticket_info, changes, image_count):
+        """
+        Format the notification for a processed ticket whose status changed.
+        """
+        labels = {"paidStatus": "Paid Status", "fineAmount": "Fine Amount"}
+        text_msg = f"Ticket status changed:\n"
+        text_msg += f"- Ticket No: {ticket_info['ticketNo']}\n"
+        text_msg += f"- Date: {ticket_info['dateHappen']}\n"
+        text_msg += f"- License Plate: {ticket_info['licensePlate']}\n"
+        for field, (old, new) in changes.items():
+            text_msg += f"- {labels[field]}: {old} -> {new}\n"
+        text_msg += f"- Images: {image_count}"
+
+        return text_msg
+
     def _decode_image(self, b64_str):
         import base64
 
@@ -1,69 +1,117 @@
-import json
+import threading
+import time
 from datetime import datetime, timedelta
 
-import requests
-
+import metrics
+from accounts import default_account
 from config import Config
+from http_client import get_client, unwrap
 from logger import log_json
-from utils import current_req_dtm, load_state, random_uuid, save_state
+from state_store import open_state
+from utils import current_req_dtm, file_lock
 
 
-class TokenManager:
-    def __init__(self):
-        self.state = load_state(Config.STATE_FILE)
+# One lock per state file, so threads sharing an account refresh its token once
+_token_locks = {}
+_token_locks_lock = threading.Lock()
+
+
+def _token_lock(state_file):
+    with _token_locks_lock:
+        return _token_locks.setdefault(state_file, threading.Lock())
+
 
-    def get_valid_token(self):
+class TokenManager:
+    """
+    Single-flight token acquisition: a valid token is served from the shared state
+    without locking. Otherwise one thread per process takes the account's file lock
+    (state_file.token.lock) and re-reads the state, so only the first of several
+    threads or processes refreshes and the others reuse its result.
+    """
+
+    def __init__(self, account=None):
+        self.account = account or default_account()
+        self.state = open_state(self.account.state_file)
+        self.client = get_client()
+
+    def get_valid_token(self, min_remaining=None):
+        """
+        Return (accessToken, refreshToken, expiresAt), refreshing or authenticating if
+        the token has less than min_remaining (default NEAR_EXPIRY_THRESHOLD) seconds left.
+        """
+        if min_remaining is None:
+            min_remaining = Config.NEAR_EXPIRY_THRESHOLD
+        token = self._cached_token(min_remaining)
+        if token:
+            return token
+
+        with _token_lock(self.account.state_file):
+            with file_lock(self.account.state_file + ".token.lock"):
+                # Another thread or process may have refreshed while we waited
+                self.state.refresh()
+                token = self._cached_token(min_remaining)
+                if token:
+                    log_json(20, "Using token refreshed by another worker")
+                    return token
+                return self._acquire_token()
+
+    def _cached_token(self, min_remaining):
+        accessToken = self.state.get("accessToken")
+        expiresAt = self.state.get("expiresAt")
+        if not accessToken or not expiresAt:
+            return None
+        remaining = (expiresAt - datetime.utcnow()).total_seconds()
+        if remaining < min_remaining:
+            return None
+        log_json(20, "Token valid", remaining_seconds=remaining)
+        return accessToken, self.state.get("refreshToken"), expiresAt
+
+    def _acquire_token(self):
         accessToken = self.state.get("accessToken")
         refreshToken = self.state.get("refreshToken")
         expiresAt = self.state.get("expiresAt")
 
         if not accessToken or not expiresAt:
             log_json(20, "No valid token, authenticating")
-            return self.authenticate()
-
-        now = datetime.utcnow()
-        remaining = (expiresAt - now).total_seconds()
-        if remaining < Config.NEAR_EXPIRY_THRESHOLD:
-            log_json(20, "Token near expiry, refreshing")
-            new_access, new_refresh, new_expiresAt = self.refresh_access_token(
-                accessToken, refreshToken
-            )
-            if not new_access:
-                log_json(20, "Refresh failed, re-authenticating")
-                return self.authenticate()
-            return new_access, new_refresh, new_expiresAt
-        else:
-            log_json(20, "Token valid", remaining_seconds=remaining)
-            return accessToken, refreshToken, expiresAt
+            return self._timed("authenticate", self.authenticate)
 
-    def authenticate(self):
-        headers = {
-            "reqBy": "ETICKET",
-            "reqDtm": current_req_dtm(),
-            "reqID": random_uuid(),
-            "src": "ETICKET",
-            "Content-Type": "application/json",
-        }
+        log_json(20, "Token near expiry, refreshing")
+        new_access, new_refresh, new_expiresAt = self._timed(
+            "refresh", self.refresh_access_token, accessToken, refreshToken
+        )
+        if not new_access:
+            log_json(20, "Refresh failed, re-authenticating")
+            return self._timed("authenticate", self.authenticate)
+        return new_access, new_refresh, new_expiresAt
+
+    def _timed(self, kind, acquire, *args):
+        started = time.monotonic()
+        result = "error"
+        try:
+            token = acquire(*args)
+            if token[0]:
+                result = "ok"
+            return token
+        finally:
+            metrics.observe("ptm_auth_seconds", time.monotonic() - started, kind=kind)
+            metrics.inc("ptm_auth_total", kind=kind, result=result)
 
+    def authenticate(self):
         payload = {
-            "citizen": Config.CITIZEN_ID,
-            "password": Config.USER_PASSWORD,
+            "citizen": self.account.citizen_id,
+            "password": self.account.password,
             "grant_type": "password",
             "reqDtm": current_req_dtm(),
         }
 
-        response = requests.post(
-            Config.BASE_URL_AUTH,
-            headers=headers,
-            auth=(Config.USERNAME, Config.PASSWORD),
-            json=payload,
+        response = self.client.post(
+            Config.BASE_URL_AUTH, payload, auth=(Config.USERNAME, Config.PASSWORD)
         )
         if response.status_code != 200:
             log_json(40, "Authentication failed", status=response.status_code)
             raise Exception("Authentication failed")
 
-        outer = response.json()
-        data = json.loads(outer["value"])
+        data = unwrap(response)
         accessToken = data.get("accessToken")
         refreshToken = data.get("refreshToken")
         expiresIn = data.get("expiresIn", 0)
@@ -73,10 +121,7 @@ class TokenManager:
             raise Exception("No access token found")
 
         expiresAt = datetime.utcnow() + timedelta(seconds=expiresIn)
-        self.state["accessToken"] = accessToken
-        self.state["refreshToken"] = refreshToken
-        self.state["expiresAt"] = expiresAt
-        save_state(Config.STATE_FILE, self.state)
+        self.state.update(accessToken=accessToken, refreshToken=refreshToken, expiresAt=expiresAt)
         log_json(20, "Authenticated successfully")
         return accessToken, refreshToken, expiresAt
 
@@ -84,28 +129,21 @@ class TokenManager:
         if not refreshToken:
             return None, None, None
 
-        headers = {
-            "reqBy": "ETICKET",
-            "reqDtm": current_req_dtm(),
-            "reqID": random_uuid(),
-            "src": "ETICKET",
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {accessToken}",
-        }
-
         payload = {
             "grant_type": "refresh_token",
             "refresh_token": refreshToken,
             "reqDtm": current_req_dtm(),
-            "citizen": Config.CITIZEN_ID,
+            "citizen": self.account.citizen_id,
         }
 
-        response = requests.post(Config.BASE_URL_REFRESH, headers=headers, json=payload)
+        # Refresh tokens may rotate server-side, so never replay this call
+        response = self.client.post(
+            Config.BASE_URL_REFRESH, payload, accessToken=accessToken, idempotent=False
+        )
         if response.status_code != 200:
             return None, None, None
 
-        outer = response.json()
-        data = json.loads(outer["value"])
+        data = unwrap(response)
         if data.get("status") != "000":
             return None, None, None
 
@@ -116,9 +154,6 @@ class TokenManager:
             return None, None, None
 
         expiresAt = datetime.utcnow() + timedelta(seconds=expiresIn)
-        self.state["accessToken"] = new_access
-        self.state["refreshToken"] = new_refresh
-        self.state["expiresAt"] = expiresAt
-        save_state(Config.STATE_FILE, self.state)
+        self.state.update(accessToken=new_access, refreshToken=new_refresh, expiresAt=expiresAt)
         log_json(20, "Token refreshed successfully")
         return new_access, new_refresh, expiresAt
@@ -1,6 +1,8 @@
+import fcntl
 import json
 import os
 import uuid
+from contextlib import contextmanager
 from datetime import datetime
 
 
@@ -26,10 +28,31 @@ def load_state(filename):
 
 
 def save_state(filename, state):
+    state = dict(state)
     if "expiresAt" in state and isinstance(state["expiresAt"], datetime):
         state["expiresAt"] = state["expiresAt"].isoformat()
-    with open(filename, "w") as f:
+    # Write to a temp file and rename so a crash never leaves a truncated state file
+    tmp_filename = f"{filename}.tmp"
+    with open(tmp_filename, "w") as f:
         json.dump(state, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_filename, filename)
+
+
+@contextmanager
+def file_lock(filename):
+    """
+    Hold an exclusive advisory lock on filename (created if missing), shared by every
+    process on the host. Locks taken through different open files of the same path
+    exclude each other even within one process, so never nest two on one path.
+    """
+    with open(filename, "a") as f:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f.fileno(), fcntl.LOCK_UN)
 
 
 def parse_date_dmy(date_str):
@@ -0,0 +1,136 @@
+import base64
+import json
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from evidence_stream import (  # noqa: E402
+    Base64Sink,
+    EvidenceScanner,
+    iter_envelope_value,
+    iter_text,
+)
+
+JPEG = b"\xff\xd8\xff\xe0" + bytes(range(256)) * 3
+WEBP = b"RIFF\x10\x00\x00\x00WEBPVP8 " + bytes(range(100))
+
+
+class _Writer:
+    def __init__(self, head):
+        self.head = head
+        self.data = b""
+        self.committed = False
+        self.aborted = False
+
+    def write(self, chunk):
+        self.data += chunk
+
+    def commit(self):
+        self.committed = True
+
+    def abort(self):
+        self.aborted = True
+
+
+def _body(inner):
+    # The imageevidence envelope: the inner object is a JSON string, with the base64
+    # "/" escaped the way the server sends it
+    value = json.dumps(inner, ensure_ascii=False).replace("/", "\\/")
+    return json.dumps({"value": value}, ensure_ascii=False).encode()
+
+
+def _parse(chunks, writers=None):
+    writers = {} if writers is None else writers
+
+    def open_sink(index):
+        def open_writer(head):
+            writer = writers[index] = _Writer(head)
+            return writer
+
+        return Base64Sink(open_writer)
+
+    scanner = EvidenceScanner(open_sink)
+    try:
+        for text in iter_envelope_value(iter_text(chunks)):
+            scanner.feed(text)
+        return scanner.finish(), scanner.stored, writers
+    except BaseException:
+        scanner.abort()
+        raise
+
+
+class EvidenceParserTest(unittest.TestCase):
+    def setUp(self):
+        encoded = base64.b64encode(JPEG).decode()
+        self.inner = {
+            "status": "000",
+            "msgEn": 'OK "quoted" ทดสอบ\n',
+            "count": 2,
+            "extra": {"nested": ["a", "}"]},
+            # Line-wrapped base64, as some servers send it
+            "upImage1": "\n".join(encoded[i : i + 76] for i in range(0, len(encoded), 76)),
+            "upImage2": "",
+            "upImage3": base64.b64encode(WEBP).decode(),
+        }
+        self.body = _body(self.inner)
+
+    def check(self, result):
+        fields, stored, writers = result
+        self.assertEqual(
+            fields,
+            {key: value for key, value in self.inner.items() if not key.startswith("upImage")},
+        )
+        self.assertEqual(stored, {"upImage1": True, "upImage2": False, "upImage3": True})
+        self.assertEqual(sorted(writers), [1, 3])
+        self.assertEqual(writers[1].data, JPEG)
+        self.assertEqual(writers[3].data, WEBP)
+        # The writer is opened with enough bytes to sniff the format
+        self.assertTrue(WEBP.startswith(writers[3].head))
+        self.assertGreaterEqual(len(writers[3].head), 12)
+        self.assertTrue(writers[1].committed and writers[3].committed)
+
+    def test_every_split_point(self):
+        for split in range(1, len(self.body)):
+            with self.subTest(split=split):
+                self.check(_parse([self.body[:split], self.body[split:]]))
+
+    def test_single_byte_chunks(self):
+        self.check(_parse([self.body[i : i + 1] for i in range(len(self.body))]))
+
+    def test_unicode_escapes_across_chunks(self):
+        self.inner["msgEn"] = "ทด 🚗"
+        value = json.dumps(self.inner).replace("/", "\\/")
+        self.body = json.dumps({"value": value}).encode()
+        for split in range(1, len(self.body)):
+            with self.subTest(split=split):
+                self.check(_parse([self.body[:split], self.body[split:]]))
+
+    def test_malformed(self):
+        cases = {
+            "no value": b'{"other": "x"}',
+            "truncated envelope": self.body[: len(self.body) // 2],
+            "truncated object": _body(self.inner)[:-3] + b'"}',
+            "not an object": json.dumps({"value": json.dumps([1, 2])}).encode(),
+            "missing colon": json.dumps({"value": '{"status" "000"}'}).encode(),
+            "bad separator": json.dumps({"value": '{"status": "000"; "x": 1}'}).encode(),
+            "trailing data": json.dumps({"value": '{"status": "000"} x'}).encode(),
+            "bad scalar": json.dumps({"value": '{"count": 12x}'}).encode(),
+        }
+        for name, body in cases.items():
+            with self.subTest(name):
+                with self.assertRaises(ValueError):
+                    _parse([body])
+
+    def test_truncated_image_is_aborted(self):
+        writers = {}
+        with self.assertRaises(ValueError):
+            _parse([self.body[: self.body.index(b"upImage3") + 50]], writers)
+        self.assertTrue(writers[1].committed)
+        self.assertTrue(writers[3].aborted)
+        self.assertFalse(writers[3].committed)
+
+
+if __name__ == "__main__":
+    unittest.main()
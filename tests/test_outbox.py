@@ -0,0 +1,182 @@
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import outbox  # noqa: E402
+from config import Config  # noqa: E402
+
+
+class FakeNotifier:
+    def __init__(self):
+        self.sent = []
+        self.results = []
+        self.started = threading.Event()
+        self.proceed = threading.Event()
+        self.proceed.set()
+        self.closed = False
+
+    def compose_digest(self, items):
+        return "\n\n".join(message for message, _ in items), [], "title"
+
+    def send(self, message, attachments=None, title=None):
+        self.started.set()
+        self.proceed.wait()
+        self.sent.append(message)
+        return self.results.pop(0) if self.results else True
+
+    def close(self):
+        self.closed = True
+
+
+class OutboxTestCase(unittest.TestCase):
+    SETTINGS = {
+        "NOTIFY_DIGEST": False,
+        "STORAGE_BACKEND": "file",
+        "OUTBOX_MAX_ATTEMPTS": 3,
+        "OUTBOX_BACKOFF_BASE": 0.05,
+        "OUTBOX_BACKOFF_MAX": 0.1,
+        "OUTBOX_CLAIM_TIMEOUT": 600,
+    }
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.saved = {name: getattr(Config, name) for name in [*self.SETTINGS, "OUTBOX_DIR"]}
+        for name, value in self.SETTINGS.items():
+            setattr(Config, name, value)
+        Config.OUTBOX_DIR = self.directory.name
+        self.notifier = FakeNotifier()
+        self.get_notifier = outbox.get_notifier
+        outbox.get_notifier = lambda: self.notifier
+        self.outbox = None
+
+    def tearDown(self):
+        if self.outbox is not None:
+            self.notifier.proceed.set()
+            self.outbox.close()
+        outbox.get_notifier = self.get_notifier
+        for name, value in self.saved.items():
+            setattr(Config, name, value)
+        self.directory.cleanup()
+
+    def pending(self):
+        return sorted(os.listdir(os.path.join(self.directory.name, "pending")))
+
+    def dead(self):
+        return sorted(os.listdir(os.path.join(self.directory.name, "dead")))
+
+    def write_entry(self, name, message, **fields):
+        os.makedirs(os.path.join(self.directory.name, "pending"), exist_ok=True)
+        path = os.path.join(self.directory.name, "pending", name)
+        entry = {"id": name.split(".")[0], "message": message, "images": []}
+        entry.update({"attempts": 0, "nextAttempt": 0}, **fields)
+        with open(path, "w") as f:
+            json.dump(entry, f)
+        return path
+
+    def wait_for(self, condition, timeout=5):
+        deadline = time.monotonic() + timeout
+        while not condition():
+            if time.monotonic() > deadline:
+                self.fail("Timed out waiting for the outbox")
+            time.sleep(0.01)
+
+
+class OutboxClaimTest(OutboxTestCase):
+    def test_stale_claim_is_released_and_delivered(self):
+        stale = self.write_entry("1-stale.sending", "stale")
+        old = time.time() - Config.OUTBOX_CLAIM_TIMEOUT - 1
+        os.utime(stale, (old, old))
+        # A live claim belongs to another process and must be left alone
+        self.write_entry("2-live.sending", "live")
+
+        # Released and delivered by the first pass, without waiting for a wakeup
+        self.outbox = outbox.Outbox(None)
+        self.wait_for(lambda: self.notifier.sent == ["stale"])
+        self.outbox.close()
+        self.outbox = None
+
+        self.assertEqual(self.notifier.sent, ["stale"])
+        self.assertEqual(self.pending(), ["2-live.sending"])
+
+    def test_entry_claimed_elsewhere_is_not_sent(self):
+        self.outbox = outbox.Outbox(None)
+        path = self.write_entry("1-a.json", "a")
+        # Another process retried it after this one read it
+        self.assertIsNone(self.outbox._claim(path, {"attempts": 1}))
+        self.assertEqual(self.pending(), ["1-a.json"])
+        self.assertEqual(self.outbox._claim(path, {"attempts": 0}), path[:-5] + ".sending")
+
+
+class OutboxRetryTest(OutboxTestCase):
+    def test_failures_back_off_then_go_to_dead_letters(self):
+        self.notifier.results = [False] * Config.OUTBOX_MAX_ATTEMPTS
+        self.outbox = outbox.Outbox(None)
+        self.outbox.enqueue("failing", [])
+        self.wait_for(lambda: self.dead())
+
+        self.assertEqual(self.notifier.sent, ["failing"] * Config.OUTBOX_MAX_ATTEMPTS)
+        self.assertEqual(self.pending(), [])
+        with open(os.path.join(self.directory.name, "dead", self.dead()[0])) as f:
+            self.assertEqual(json.load(f)["attempts"], Config.OUTBOX_MAX_ATTEMPTS)
+
+    def test_backoff_doubles_up_to_the_maximum(self):
+        Config.OUTBOX_BACKOFF_BASE = 100
+        Config.OUTBOX_BACKOFF_MAX = 300
+        Config.OUTBOX_MAX_ATTEMPTS = 10
+        self.outbox = outbox.Outbox(None)
+        for attempts, (low, high) in enumerate([(50, 100), (100, 200), (150, 300), (150, 300)]):
+            claimed = self.write_entry("1-a.sending", "a", attempts=attempts)
+            entry = {"id": "1-a", "message": "a", "images": [], "attempts": attempts}
+            before = time.time()
+            retry_at = self.outbox._retry(claimed, entry)
+            self.assertGreaterEqual(retry_at - before, low)
+            self.assertLessEqual(retry_at - time.time(), high)
+            # Released back to pending/ with the new schedule
+            with open(os.path.join(self.directory.name, "pending", "1-a.json")) as f:
+                saved = json.load(f)
+            self.assertEqual(saved["attempts"], attempts + 1)
+            self.assertEqual(saved["nextAttempt"], retry_at)
+            os.remove(os.path.join(self.directory.name, "pending", "1-a.json"))
+
+
+class OutboxCloseTest(OutboxTestCase):
+    def start_blocked_send(self, result):
+        self.notifier.proceed.clear()
+        self.notifier.results = [result]
+        self.outbox = outbox.Outbox(None)
+        self.outbox.enqueue("in flight", [])
+        self.assertTrue(self.notifier.started.wait(5))
+
+        closer = threading.Thread(target=self.outbox.close)
+        closer.start()
+        closer.join(0.2)
+        # close() waits for the delivery in progress
+        self.assertTrue(closer.is_alive())
+        self.assertEqual(self.pending()[0].rsplit(".", 1)[1], "sending")
+        self.notifier.proceed.set()
+        closer.join(5)
+        self.assertFalse(closer.is_alive())
+        self.assertTrue(self.notifier.closed)
+        self.outbox = None
+
+    def test_close_waits_for_delivery_in_flight(self):
+        self.start_blocked_send(True)
+        self.assertEqual(self.notifier.sent, ["in flight"])
+        self.assertEqual(self.pending(), [])
+
+    def test_close_keeps_failed_delivery_for_next_run(self):
+        self.start_blocked_send(False)
+        self.assertEqual(len(self.pending()), 1)
+        self.assertTrue(self.pending()[0].endswith(".json"))
+        with open(os.path.join(self.directory.name, "pending", self.pending()[0])) as f:
+            self.assertEqual(json.load(f)["attempts"], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
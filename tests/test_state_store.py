@@ -0,0 +1,45 @@
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+from config import Config  # noqa: E402
+from state_store import StateStore  # noqa: E402
+
+
+class StateStoreCompactionTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.filename = os.path.join(self.directory.name, "state.json")
+        self.compact_every = Config.STATE_COMPACT_EVERY
+        Config.STATE_COMPACT_EVERY = 1000
+
+    def tearDown(self):
+        Config.STATE_COMPACT_EVERY = self.compact_every
+        self.directory.cleanup()
+
+    def test_compaction_keeps_appending_after_other_writers(self):
+        # Two stores on one file stand in for two processes sharing the state
+        a = StateStore(self.filename)
+        b = StateStore(self.filename)
+        a.add("processedTickets", "A0")
+        b.add("processedTickets", "B0")
+        a.add("processedTickets", "A1")
+        a.compact()
+        b.add("processedTickets", "B1")
+        a.add("processedTickets", "A2")
+        b.add("processedTickets", "B2")
+        a.add("processedTickets", "A3")
+
+        reloaded = StateStore(self.filename)
+        self.assertEqual(
+            reloaded.members("processedTickets"), {"A0", "A1", "A2", "A3", "B0", "B1", "B2"}
+        )
+        for store in (a, b, reloaded):
+            store.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,183 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+sys.path.insert(0, SRC)
+
+import state_store  # noqa: E402
+import storage  # noqa: E402
+from config import Config  # noqa: E402
+
+# Stores one image through dedup storage, as a separate cron run would
+STORE_IMAGE = """
+import sys
+sys.path.insert(0, sys.argv[1])
+import state_store
+import storage
+
+storage.get_storage().upload_images([(sys.argv[2], b"\\xff\\xd8\\xffimage", "image/jpeg")])
+state_store.close_all()
+"""
+
+
+class StorageTestCase(unittest.TestCase):
+    SETTINGS = {}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "images")
+        settings = {
+            "STORAGE_BACKEND": "file",
+            "FILE_STORAGE_PATH": self.path,
+            "FILE_STORAGE_LAYOUT": "sharded",
+            "STORAGE_DEDUP": False,
+            "DEDUP_INDEX_FILE": os.path.join(self.directory.name, "image_index.json"),
+            **self.SETTINGS,
+        }
+        self.saved = {name: getattr(Config, name) for name in settings}
+        for name, value in settings.items():
+            setattr(Config, name, value)
+
+    def tearDown(self):
+        state_store.close_all()
+        for name, value in self.saved.items():
+            setattr(Config, name, value)
+        self.directory.cleanup()
+
+
+class DedupIndexRefreshTest(StorageTestCase):
+    SETTINGS = {"STORAGE_DEDUP": True}
+
+    def test_refs_written_by_another_process_are_found(self):
+        # A long-running reader, like the standalone image server
+        reader = storage.get_storage()
+        name = "20260101_T1_1.jpg"
+        env = dict(
+            os.environ,
+            STORAGE_BACKEND="file",
+            FILE_STORAGE_PATH=self.path,
+            STORAGE_DEDUP="true",
+            DEDUP_INDEX_FILE=Config.DEDUP_INDEX_FILE,
+            LOG_LEVEL="ERROR",
+        )
+        subprocess.run([sys.executable, "-c", STORE_IMAGE, SRC, name], env=env, check=True)
+
+        with open(reader.get_image_access(name), "rb") as f:
+            self.assertEqual(f.read(), b"\xff\xd8\xffimage")
+
+
+class ShardMigrationTest(StorageTestCase):
+    def test_only_images_are_migrated(self):
+        # FILE_STORAGE_PATH shared with the state directory
+        os.makedirs(os.path.join(self.path, "thumbs"))
+        os.makedirs(os.path.join(self.path, "outbox"))
+        images = ["20260131_T1_1.jpg", "thumbs/20260131_T1_1.webp", "legacy.png"]
+        others = [
+            "state.json",
+            "state.json.journal",
+            "state.json.lock",
+            "archive.db",
+            "image_index.json",
+            "outbox/1792320551892066433-c01a1c8f.json",
+        ]
+        for name in images + others:
+            with open(os.path.join(self.path, name), "wb") as f:
+                f.write(name.encode())
+
+        file_storage = storage.FileStorage()
+        deadline = time.monotonic() + 10
+        while file_storage.migrating and time.monotonic() < deadline:
+            time.sleep(0.01)
+        self.assertFalse(file_storage.migrating)
+
+        for name in others:
+            self.assertTrue(os.path.isfile(os.path.join(self.path, name)), name)
+        for name in images:
+            self.assertFalse(os.path.exists(os.path.join(self.path, name)), name)
+            with open(file_storage.get_image_access(name), "rb") as f:
+                self.assertEqual(f.read(), name.encode())
+        self.assertTrue(os.path.isfile(os.path.join(self.path, "2026", "01", images[0])))
+
+
+class SlowBackend(storage.StorageBase):
+    def __init__(self, failures=0):
+        self.uploads = []
+        self.blobs = {}
+        self.failures = failures
+        self.lock = threading.Lock()
+
+    def upload_image(self, filename, img_bytes, content_type=None):
+        # Slow enough for every other worker to find the content claimed
+        time.sleep(0.05)
+        with self.lock:
+            self.uploads.append(filename)
+            if self.failures:
+                self.failures -= 1
+                raise Exception("upload failed")
+        self.blobs[filename] = img_bytes
+
+    def get_image_access(self, filename):
+        return filename
+
+
+class DedupClaimRaceTest(StorageTestCase):
+    def store_concurrently(self, dedup, names, data):
+        # Half of the workers store single images, half store them as a batch
+        stored = []
+        errors = []
+        barrier = threading.Barrier(len(names))
+
+        def store(i, name):
+            barrier.wait()
+            try:
+                if i % 2:
+                    dedup.upload_image(name, data, "image/jpeg")
+                    stored.append(name)
+                else:
+                    dedup.upload_images([(name, data, "image/jpeg")], stored.append)
+            except Exception as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=store, args=item) for item in enumerate(names)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return stored, errors
+
+    def test_same_content_is_uploaded_once(self):
+        backend = SlowBackend()
+        dedup = storage.DedupStorage(backend)
+        names = [f"20260101_T{i}_1.jpg" for i in range(8)]
+        stored, errors = self.store_concurrently(dedup, names, b"\xff\xd8\xffsame")
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(backend.uploads), 1)
+        self.assertEqual(sorted(stored), names)
+        for name in names:
+            self.assertEqual(dedup.get_image_access(name), backend.uploads[0])
+
+    def test_waiters_take_over_a_failed_upload(self):
+        backend = SlowBackend(failures=1)
+        dedup = storage.DedupStorage(backend)
+        names = [f"20260101_T{i}_1.jpg" for i in range(4)]
+        stored, errors = self.store_concurrently(dedup, names, b"\xff\xd8\xffsame")
+
+        # Only the worker whose upload failed sees the error; the others store the
+        # content themselves, once
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(len(backend.uploads), 2)
+        self.assertEqual(len(stored), 3)
+        blob = backend.uploads[1]
+        self.assertIn(blob, backend.blobs)
+        for name in stored:
+            self.assertEqual(dedup.get_image_access(name), blob)
+
+
+if __name__ == "__main__":
+    unittest.main()
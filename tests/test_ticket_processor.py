@@ -0,0 +1,223 @@
+import base64
+import json
+import os
+import sys
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import state_store  # noqa: E402
+import ticket_processor  # noqa: E402
+from config import Config  # noqa: E402
+from storage import StorageBase  # noqa: E402
+
+IMAGES = {i: b"\xff\xd8\xff\xe0" + bytes([i]) * 64 for i in range(1, 6)}
+
+
+def _evidence():
+    evidence = {"status": "000", "msgEn": "OK"}
+    for i, data in IMAGES.items():
+        evidence[f"upImage{i}"] = base64.b64encode(data).decode()
+    return evidence
+
+
+class MemoryStorage(StorageBase):
+    def __init__(self, fail_after=None):
+        self.images = {}
+        self.uploads = []
+        self.fail_after = fail_after
+
+    def upload_image(self, filename, img_bytes, content_type=None):
+        if self.fail_after is not None and len(self.uploads) >= self.fail_after:
+            raise Exception("simulated crash")
+        self.uploads.append(filename)
+        self.images[filename] = img_bytes
+
+    def get_image_access(self, filename):
+        return filename
+
+
+class FakeOutbox:
+    def __init__(self):
+        self.messages = []
+
+    def enqueue(self, message, images):
+        self.messages.append((message, images))
+
+    def poll_complete(self):
+        pass
+
+
+class StreamedResponse:
+    status_code = 200
+
+    def __init__(self, body):
+        self.body = body
+
+    def iter_content(self, chunk_size):
+        for start in range(0, len(self.body), chunk_size):
+            yield self.body[start : start + chunk_size]
+
+    def close(self):
+        pass
+
+
+class FakeClient:
+    # Answers the streamed imageevidence request; the governor is the real one
+    def __init__(self, client, calls):
+        self.governor = client.governor
+        self.calls = calls
+
+    def post(self, url, payload, accessToken=None, stream=False):
+        self.calls.append(("imageevidence", payload["ticketNo"]))
+        return StreamedResponse(json.dumps({"value": json.dumps(_evidence())}).encode())
+
+
+class FakeApiProcessor(ticket_processor.TicketProcessor):
+    """
+    TicketProcessor with the PTM API calls answered locally.
+    """
+
+    tickets = []
+
+    def __init__(self, storage, calls):
+        super().__init__("token", storage)
+        self.client = FakeClient(self.client, calls)
+        self.calls = calls
+
+    def get_all_tickets(self, paidStatus="", fromDate=None, toDate=None):
+        self.calls.append(("allTickets", fromDate, toDate))
+        return list(self.tickets)
+
+    def get_ticket_detail(self, ticketNo):
+        self.calls.append(("ticketDetail", ticketNo))
+        return {"dateHappen": "31/01/2026 10:00", "plate": "AB1234", "paidStatus": "N"}
+
+    def get_image_evidence(self, ticketNo):
+        self.calls.append(("imageevidence", ticketNo))
+        return _evidence()
+
+
+class ProcessorTestCase(unittest.TestCase):
+    SETTINGS = {}
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        settings = {
+            "STATE_FILE": os.path.join(self.directory.name, "state.json"),
+            "CITIZEN_ID": "1100000000000",
+            "SYNC_MODE": "full",
+            "BACKFILL_WINDOW_DAYS": 0,
+            "STREAM_EVIDENCE": False,
+            "PTM_ENCRYPTION": False,
+            "ARCHIVE_ENABLED": False,
+            "IMAGE_RECOMPRESS": False,
+            "IMAGE_THUMBNAILS": False,
+            "TICKET_CONCURRENCY": 2,
+            "STREAM_CHUNK_SIZE": Config.STREAM_CHUNK_SIZE,
+            **self.SETTINGS,
+        }
+        self.saved = {name: getattr(Config, name) for name in settings}
+        for name, value in settings.items():
+            setattr(Config, name, value)
+        self.outbox = FakeOutbox()
+        self.get_outbox = ticket_processor.get_outbox
+        ticket_processor.get_outbox = lambda storage: self.outbox
+        self.calls = []
+
+    def tearDown(self):
+        ticket_processor.get_outbox = self.get_outbox
+        state_store.close_all()
+        for name, value in self.saved.items():
+            setattr(Config, name, value)
+        self.directory.cleanup()
+
+    def processor(self, storage=None):
+        # Every run starts from the state on disk, as a new process would
+        state_store.close_all()
+        return FakeApiProcessor(storage or MemoryStorage(), self.calls)
+
+
+class ResumeTest(ProcessorTestCase):
+    def test_rerun_uploads_only_the_remaining_images(self):
+        self.check_resume()
+
+    def test_rerun_streams_only_the_remaining_images(self):
+        Config.STREAM_EVIDENCE = True
+        Config.STREAM_CHUNK_SIZE = 50
+        self.check_resume()
+
+    def check_resume(self):
+        FakeApiProcessor.tickets = [{"ticketNo": "T1", "dateHappen": "31/01/2026"}]
+        crashing = MemoryStorage(fail_after=3)
+        with self.assertRaisesRegex(Exception, "simulated crash"):
+            self.processor(crashing).process_tickets()
+        self.assertEqual(len(crashing.uploads), 3)
+        self.assertEqual(self.outbox.messages, [])
+
+        storage = MemoryStorage()
+        processor = self.processor(storage)
+        checkpoint = processor.state.get_item("checkpoints", "T1")
+        self.assertEqual(sorted(checkpoint["images"]), ["1", "2", "3"])
+        self.assertEqual(processor.process_tickets(), 1)
+
+        self.assertEqual(storage.uploads, ["20260131_T1_4.jpg", "20260131_T1_5.jpg"])
+        # The detail came from the checkpoint
+        self.assertEqual(self.calls.count(("ticketDetail", "T1")), 1)
+        ((message, images),) = self.outbox.messages
+        self.assertEqual(images, [f"20260131_T1_{i}.jpg" for i in IMAGES])
+        self.assertTrue(processor.state.contains("processedTickets", "T1"))
+        self.assertIsNone(processor.state.get_item("checkpoints", "T1"))
+
+
+class BackfillTest(ProcessorTestCase):
+    SETTINGS = {"BACKFILL_DAYS": 30, "BACKFILL_WINDOW_DAYS": 7, "BACKFILL_CONCURRENCY": 2}
+
+    def setUp(self):
+        super().setUp()
+        FakeApiProcessor.tickets = []
+
+    def windows(self):
+        return [call[1:] for call in self.calls if call[0] == "allTickets"]
+
+    def test_new_account_is_backfilled_in_windows(self):
+        batches, full_sync, backfill = self.processor().fetch_tickets()
+        list(batches)
+        self.assertTrue(backfill)
+        self.assertFalse(full_sync)
+
+        windows = sorted(
+            (datetime.strptime(f, "%d/%m/%Y"), datetime.strptime(t, "%d/%m/%Y"))
+            for f, t in self.windows()
+        )
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        self.assertEqual(windows[0][0], today - timedelta(days=30))
+        self.assertEqual(windows[-1][1], today)
+        for (_, previous_to), (next_from, _) in zip(windows, windows[1:]):
+            self.assertEqual(next_from - previous_to, timedelta(days=1))
+        self.assertTrue(all(t - f < timedelta(days=7) for f, t in windows))
+
+    def test_backfill_is_recorded_once_complete(self):
+        self.processor().process_tickets()
+        self.calls.clear()
+        _, _, backfill = self.processor().fetch_tickets()
+        self.assertFalse(backfill)
+        self.assertEqual(self.windows(), [(None, None)])
+
+    def test_accounts_with_a_full_sync_are_not_backfilled(self):
+        processor = self.processor()
+        processor.state.update(lastFullSync=datetime.now().isoformat())
+        _, _, backfill = processor.fetch_tickets()
+        self.assertFalse(backfill)
+
+    def test_state_from_before_last_full_sync_is_not_backfilled(self):
+        processor = self.processor()
+        processor.state.add("processedTickets", "T0")
+        _, _, backfill = processor.fetch_tickets()
+        self.assertFalse(backfill)
+
+
+if __name__ == "__main__":
+    unittest.main()